@@ -1,16 +1,35 @@
+import asyncio
 import logging.config
 import os
 from contextlib import asynccontextmanager
+from datetime import time
 from pathlib import Path
+from typing import Optional
 
 import uvicorn
 import yaml
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from pydantic import confloat, conint
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 import naturalness
-from app.route import health, imagery
+from app.compression import CompressionMiddleware
+from app.load_shedding import LoadShedder, LoadSheddingMiddleware
+from app.profiling import ProfileFormat, ProfilingMiddleware, RequestProfiler
+from app.response_cache import ResponseCache, ResponseCacheMiddleware
+from app.route import health, imagery, metrics
+from app.route.common import TimeRange
+from app.route.health import ReadinessPolicy
+from app.scheduling import FairScheduler, load_client_policies
+from naturalness import metrics as naturalness_metrics
+from naturalness.batch import BatchImageryStore
+from naturalness.cache import CacheBackend, CacheBackendType, FileSystemCacheBackend, S3CacheBackend
 from naturalness.imagery_store_operator import SentinelHubOperator
+from naturalness.prefetch import prefetch_daily
+from naturalness.product import ProductImageryStore
+from naturalness.pu_calibration import PuCalibration
+from naturalness.retry import Hedger, RetryPolicy
+from naturalness.tracing import TracingExporter, configure_tracing
 
 log = logging.getLogger(__name__)
 
@@ -21,6 +40,63 @@ class Settings(BaseSettings):
 
     sentinelhub_api_id: str
     sentinelhub_api_secret: str
+    sentinelhub_base_url: Optional[str] = None
+
+    cache_backend: Optional[CacheBackendType] = None
+    cache_shared_dir: Optional[Path] = None
+    cache_s3_bucket: Optional[str] = None
+    cache_s3_prefix: str = 'imagery'
+    cache_s3_endpoint_url: Optional[str] = None
+    cache_local_max_bytes: Optional[conint(gt=0)] = None
+
+    retry_max_attempts: conint(ge=1) = 3
+    retry_base_delay: confloat(ge=0.0) = 0.5
+    retry_max_delay: confloat(ge=0.0) = 30.0
+    hedge_percentile: Optional[confloat(gt=0.0, lt=1.0)] = None
+    hedge_min_samples: conint(ge=1) = 20
+
+    tracing_exporter: Optional[TracingExporter] = None
+    tracing_file: Path = Path('./traces/spans.jsonl')
+
+    profiling_admin_token: Optional[str] = None
+    profiling_sample_rate: confloat(ge=0.0, le=1.0) = 0.0
+    profiling_dir: Path = Path('./profiles')
+    profiling_format: ProfileFormat = ProfileFormat.HTML
+
+    prefetch_targets: Optional[Path] = None
+    prefetch_time: time = time(hour=3)
+    prefetch_concurrency: conint(ge=1) = 2
+    prefetch_pu_budget: Optional[confloat(ge=0.0)] = None
+
+    timeseries_concurrency: conint(ge=1) = 4
+
+    product_dir: Path = Path('./products')
+    serve_products: bool = False
+
+    request_timeout: Optional[confloat(gt=0.0)] = None
+    response_cache: bool = False
+    response_cache_dir: Path = Path('./cache/responses')
+    response_cache_max_bytes: Optional[conint(gt=0)] = None
+    response_cache_max_age: conint(ge=0) = 86400
+
+    batch_output_url: Optional[str] = None
+    batch_output_dir: Optional[Path] = None
+    batch_s3_endpoint_url: Optional[str] = None
+    batch_min_pixels: Optional[conint(gt=0)] = 25_000_000
+    batch_min_pus: Optional[confloat(gt=0.0)] = None
+    batch_tiling_grid: conint(ge=0, le=2) = 1
+    batch_poll_interval: confloat(gt=0.0) = 10.0
+    batch_timeout: confloat(gt=0.0) = 3600.0
+
+    max_in_flight_per_route: conint(ge=1) = 8
+    max_queued_per_route: conint(ge=0) = 16
+    queue_timeout: confloat(gt=0.0) = 10.0
+    retry_after_seconds: conint(ge=1) = 5
+    readiness_max_upstream_error_rate: confloat(ge=0.0, le=1.0) = 0.5
+    readiness_min_free_disk_bytes: conint(ge=0) = 1_000_000_000
+
+    client_policies: Optional[Path] = None
+    scheduler_max_concurrency: conint(ge=1) = 8
 
     model_config = SettingsConfigDict(env_file='.env')
 
@@ -40,6 +116,55 @@ tags_metadata = [
 ]
 
 
+def create_cache_backend(settings: Settings) -> Optional[CacheBackend]:
+    match settings.cache_backend:
+        case None:
+            return None
+        case CacheBackendType.FILESYSTEM:
+            if settings.cache_shared_dir is None:
+                raise ValueError('The filesystem cache backend requires the CACHE_SHARED_DIR setting')
+            return FileSystemCacheBackend(root=settings.cache_shared_dir)
+        case CacheBackendType.S3:
+            if settings.cache_s3_bucket is None:
+                raise ValueError('The S3 cache backend requires the CACHE_S3_BUCKET setting')
+            return S3CacheBackend(
+                bucket=settings.cache_s3_bucket,
+                prefix=settings.cache_s3_prefix,
+                endpoint_url=settings.cache_s3_endpoint_url,
+            )
+        case _:
+            raise ValueError(f'Cache backend {settings.cache_backend} is not supported')
+
+
+def create_batch_bucket(settings: Settings) -> CacheBackend:
+    """The bucket batch jobs deliver to, or a directory standing in for it (e.g. the bucket of the local stub)"""
+    if settings.batch_output_dir is not None:
+        return FileSystemCacheBackend(root=settings.batch_output_dir)
+    bucket, _, prefix = settings.batch_output_url.removeprefix('s3://').partition('/')
+    return S3CacheBackend(bucket=bucket, prefix=prefix, endpoint_url=settings.batch_s3_endpoint_url)
+
+
+def create_imagery_store(settings: Settings) -> SentinelHubOperator:
+    return SentinelHubOperator(
+        api_id=settings.sentinelhub_api_id,
+        api_secret=settings.sentinelhub_api_secret,
+        script_path=settings.conf_path / 'eval_scripts',
+        cache_dir=Path('./cache') / 'imagery',
+        pu_calibration=PuCalibration(calibration_dir=Path('./cache') / 'pu_calibration'),
+        base_url=settings.sentinelhub_base_url,
+        cache_backend=create_cache_backend(settings=settings),
+        local_cache_max_bytes=settings.cache_local_max_bytes,
+        retry_policy=RetryPolicy(
+            max_attempts=settings.retry_max_attempts,
+            base_delay=settings.retry_base_delay,
+            max_delay=settings.retry_max_delay,
+        ),
+        hedger=None
+        if settings.hedge_percentile is None
+        else Hedger(percentile=settings.hedge_percentile, min_samples=settings.hedge_min_samples),
+    )
+
+
 @asynccontextmanager
 async def configure_dependencies(app: FastAPI):
     """
@@ -54,17 +179,86 @@ async def configure_dependencies(app: FastAPI):
     # noinspection PyArgumentList
     settings = Settings()
 
-    app.state.imagery_store = SentinelHubOperator(
-        api_id=settings.sentinelhub_api_id,
-        api_secret=settings.sentinelhub_api_secret,
-        script_path=settings.conf_path / 'eval_scripts',
-        cache_dir=Path('./cache') / 'imagery',
+    tracer_provider = configure_tracing(exporter=settings.tracing_exporter, file_path=settings.tracing_file)
+
+    if settings.profiling_admin_token is not None or settings.profiling_sample_rate > 0.0:
+        app.state.request_profiler = RequestProfiler(
+            profile_dir=settings.profiling_dir,
+            admin_token=settings.profiling_admin_token,
+            sample_rate=settings.profiling_sample_rate,
+            profile_format=settings.profiling_format,
+        )
+
+    operator = create_imagery_store(settings=settings)
+    app.state.imagery_store = operator
+    if settings.batch_output_url is not None:
+        app.state.imagery_store = BatchImageryStore(
+            operator=operator,
+            bucket=create_batch_bucket(settings=settings),
+            output_url=settings.batch_output_url,
+            min_pixels=settings.batch_min_pixels,
+            min_pus=settings.batch_min_pus,
+            tiling_grid=settings.batch_tiling_grid,
+            poll_interval=settings.batch_poll_interval,
+            timeout=settings.batch_timeout,
+        )
+    if settings.serve_products:
+        app.state.imagery_store = ProductImageryStore(
+            product_dir=settings.product_dir, fallback=app.state.imagery_store
+        )
+    app.state.timeseries_concurrency = settings.timeseries_concurrency
+
+    app.state.request_timeout = settings.request_timeout
+    if settings.response_cache:
+        app.state.response_cache = ResponseCache(
+            routes=imagery.router.routes,
+            cache_dir=settings.response_cache_dir,
+            max_age=settings.response_cache_max_age,
+            max_bytes=settings.response_cache_max_bytes,
+        )
+    app.state.load_shedder = LoadShedder(
+        routes=imagery.router.routes,
+        max_in_flight=settings.max_in_flight_per_route,
+        max_queued=settings.max_queued_per_route,
+        queue_timeout=settings.queue_timeout,
+        retry_after=settings.retry_after_seconds,
+    )
+    if settings.client_policies is not None:
+        app.state.scheduler = FairScheduler(
+            clients=load_client_policies(settings.client_policies),
+            max_concurrency=settings.scheduler_max_concurrency,
+        )
+    app.state.readiness_policy = ReadinessPolicy(
+        cache_dir=Path('./cache'),
+        max_upstream_error_rate=settings.readiness_max_upstream_error_rate,
+        min_free_disk_bytes=settings.readiness_min_free_disk_bytes,
     )
 
+    prefetch_task = None
+    if settings.prefetch_targets is not None:
+        time_range = TimeRange()
+        prefetch_task = asyncio.create_task(
+            prefetch_daily(
+                imagery_store=operator,
+                targets_file=settings.prefetch_targets,
+                at=settings.prefetch_time,
+                lock_file=Path('./cache') / 'prefetch.lock',
+                start_date=time_range.start_date.isoformat(),
+                end_date=time_range.end_date.isoformat(),
+                max_workers=settings.prefetch_concurrency,
+                pu_budget=settings.prefetch_pu_budget,
+            )
+        )
+
     log.info('Initialisation completed')
 
     yield
 
+    if prefetch_task is not None:
+        prefetch_task.cancel()
+    if tracer_provider is not None:
+        tracer_provider.shutdown()
+
 
 app = FastAPI(
     title='Naturalness Utility',
@@ -83,6 +277,24 @@ app = FastAPI(
 )
 app.include_router(imagery.router)
 app.include_router(health.router)
+app.include_router(metrics.router)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(LoadSheddingMiddleware)
+app.add_middleware(ResponseCacheMiddleware)
+app.add_middleware(CompressionMiddleware)
+
+
+@app.middleware('http')
+async def record_response_size(request: Request, call_next):
+    response = await call_next(request)
+
+    route = request.scope.get('route')
+    if route is not None and 'content-length' in response.headers:
+        naturalness_metrics.RESPONSE_SIZE.labels(index=request.path_params.get('index', ''), route=route.path).observe(
+            int(response.headers['content-length'])
+        )
+    return response
+
 
 if __name__ == '__main__':
     # the settings must be provided in an .env file or as env vars by the programmer that recreates the cashed data
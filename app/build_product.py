@@ -0,0 +1,57 @@
+import argparse
+import logging.config
+
+import yaml
+
+from app.api import Settings, create_imagery_store
+from app.route.common import TimeRange
+from naturalness.imagery_store_operator import Index
+from naturalness.product import build_product
+
+log = logging.getLogger(__name__)
+
+
+def parse_args() -> argparse.Namespace:
+    default_time_range = TimeRange()
+    parser = argparse.ArgumentParser(
+        description='Build precomputed products of a region that are served without downloads'
+    )
+    parser.add_argument('--name', required=True, help='the name of the region, used in the file names')
+    parser.add_argument(
+        '--bbox',
+        type=float,
+        nargs=4,
+        required=True,
+        metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'),
+        help='the region in WGS 84',
+    )
+    parser.add_argument('--index', type=Index, action='append', help='the indices to build, defaults to NATURALNESS')
+    parser.add_argument('--start-date', default=default_time_range.start_date.isoformat())
+    parser.add_argument('--end-date', default=default_time_range.end_date.isoformat())
+    parser.add_argument(
+        '--resolution', type=int, action='append', help='the resolutions to build, can be repeated, defaults to 90'
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # noinspection PyArgumentList
+    settings = Settings()
+    logging.basicConfig(level=settings.log_level.upper())
+    with open(settings.conf_path / 'logging.yaml') as file:
+        logging.config.dictConfig(yaml.safe_load(file))
+
+    imagery_store = create_imagery_store(settings=settings)
+    for index in args.index or [Index.NATURALNESS]:
+        for resolution in args.resolution or [90]:
+            build_product(
+                imagery_store=imagery_store,
+                output_dir=settings.product_dir,
+                name=args.name,
+                index=index,
+                bbox=tuple(args.bbox),
+                start_date=args.start_date,
+                end_date=args.end_date,
+                resolution=resolution,
+            )
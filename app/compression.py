@@ -0,0 +1,94 @@
+import gzip
+from enum import StrEnum
+from typing import List, Optional
+
+import anyio.to_thread
+import zstandard
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+COMPRESSIBLE_MEDIA_TYPES = ('application/json', 'application/geo+json')
+
+
+class ContentEncoding(StrEnum):
+    ZSTD = 'zstd'
+    GZIP = 'gzip'
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[ContentEncoding]:
+    """The supported encoding the client prefers, zstd on ties, or `None` if it accepts none of them"""
+    preferences = {}
+    for part in accept_encoding.split(','):
+        coding, _, parameters = part.strip().partition(';')
+        quality = 1.0
+        if parameters.strip().startswith('q='):
+            try:
+                quality = float(parameters.strip()[2:])
+            except ValueError:
+                continue
+        preferences[coding.strip().lower()] = quality
+
+    candidates = [(preferences.get(encoding, 0.0), encoding) for encoding in ContentEncoding]
+    quality, encoding = max(candidates, key=lambda candidate: candidate[0])
+    return encoding if quality > 0.0 else None
+
+
+def compress(body: bytes, encoding: ContentEncoding) -> bytes:
+    match encoding:
+        case ContentEncoding.ZSTD:
+            return zstandard.ZstdCompressor(level=3).compress(body)
+        case ContentEncoding.GZIP:
+            return gzip.compress(body, compresslevel=6)
+        case _:
+            raise ValueError(f'Content encoding {encoding} is not supported')
+
+
+class CompressionMiddleware:
+    """
+    Compress JSON responses with the content encoding negotiated via `Accept-Encoding` (zstd or gzip). The ETag of a
+    compressed response is weakened, as its bytes differ from the uncompressed response.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        encoding = None
+        if scope['type'] == 'http':
+            encoding = negotiate_encoding(Headers(scope=scope).get('accept-encoding', ''))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Optional[Message] = None
+        chunks: List[bytes] = []
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start_message
+            if message['type'] == 'http.response.start':
+                headers = Headers(raw=message['headers'])
+                media_type = headers.get('content-type', '').partition(';')[0].strip()
+                if media_type in COMPRESSIBLE_MEDIA_TYPES and 'content-encoding' not in headers:
+                    # held back until the size of the body tells whether compressing it pays off
+                    start_message = message
+                    return
+            elif message['type'] == 'http.response.body' and start_message is not None:
+                chunks.append(message.get('body', b''))
+                if message.get('more_body', False):
+                    return
+
+                body = b''.join(chunks)
+                headers = MutableHeaders(scope=start_message)
+                headers.add_vary_header('Accept-Encoding')
+                if len(body) >= self.minimum_size:
+                    body = await anyio.to_thread.run_sync(compress, body, encoding)
+                    headers['content-encoding'] = encoding
+                    headers['content-length'] = str(len(body))
+                    if 'etag' in headers and not headers['etag'].startswith('W/'):
+                        headers['etag'] = f'W/{headers["etag"]}'
+                await send(start_message)
+                message = {'type': 'http.response.body', 'body': body}
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
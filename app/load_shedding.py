@@ -0,0 +1,114 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from starlette.responses import JSONResponse
+from starlette.routing import BaseRoute, Match
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from naturalness import metrics
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class RouteLoad:
+    semaphore: asyncio.Semaphore
+    in_flight: int = 0
+    queued: int = 0
+
+
+@dataclass
+class LoadShedder:
+    """
+    Bound the number of requests processed (`max_in_flight`) and waiting (`max_queued`) per route. Requests exceeding
+    the queue or waiting longer than `queue_timeout` seconds are shed, i.e. answered with 503 and a `Retry-After` header
+    instead of piling up behind blocked SentinelHub downloads.
+    """
+
+    routes: List[BaseRoute]
+    max_in_flight: int = 8
+    max_queued: int = 16
+    queue_timeout: float = 10.0
+    retry_after: int = 5
+    _load: Dict[str, RouteLoad] = field(default_factory=dict, init=False)
+
+    def route_path(self, scope: Scope) -> Optional[str]:
+        """The path template of the guarded route handling the request, if any"""
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return None
+
+    def load(self, route: str) -> RouteLoad:
+        if route not in self._load:
+            self._load[route] = RouteLoad(semaphore=asyncio.Semaphore(self.max_in_flight))
+        return self._load[route]
+
+    def loads(self) -> Dict[str, RouteLoad]:
+        return {route.path: self.load(route.path) for route in self.routes}
+
+    def saturated(self, route: str) -> bool:
+        """Whether the next request to the route would be shed"""
+        load = self.load(route)
+        return load.in_flight >= self.max_in_flight and load.queued >= self.max_queued
+
+    async def acquire(self, route: str) -> Optional[str]:
+        """
+        Wait for a free slot of the route.
+
+        :return: the reason if the request is shed, `None` once it may be processed
+        """
+        load = self.load(route)
+        if load.semaphore.locked():
+            if load.queued >= self.max_queued:
+                return 'queue_full'
+            load.queued += 1
+            try:
+                await asyncio.wait_for(load.semaphore.acquire(), timeout=self.queue_timeout)
+            except TimeoutError:
+                return 'queue_timeout'
+            finally:
+                load.queued -= 1
+        else:
+            await load.semaphore.acquire()
+        load.in_flight += 1
+        return None
+
+    def release(self, route: str) -> None:
+        load = self.load(route)
+        load.in_flight -= 1
+        load.semaphore.release()
+
+
+class LoadSheddingMiddleware:
+    """Guard the routes of the `LoadShedder` in `app.state.load_shedder`, all requests pass if it is not set"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        load_shedder: Optional[LoadShedder] = getattr(scope['app'].state, 'load_shedder', None)
+        route = None if scope['type'] != 'http' or load_shedder is None else load_shedder.route_path(scope)
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+
+        reason = await load_shedder.acquire(route)
+        if reason is not None:
+            log.warning(f'Shedding a request to {route} ({reason})')
+            metrics.REQUESTS_SHED.labels(route=route, reason=reason).inc()
+            response = JSONResponse(
+                {'detail': 'The service is overloaded, please retry later'},
+                status_code=503,
+                headers={'Retry-After': str(load_shedder.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            load_shedder.release(route)
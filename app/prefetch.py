@@ -0,0 +1,81 @@
+import argparse
+import logging.config
+from pathlib import Path
+
+import yaml
+
+from app.api import Settings, create_imagery_store
+from app.route.common import TimeRange
+from naturalness.imagery_store_operator import Index
+from naturalness.prefetch import PrefetchTarget, load_targets, prefetch
+
+log = logging.getLogger(__name__)
+
+
+def parse_args() -> argparse.Namespace:
+    default_time_range = TimeRange()
+    parser = argparse.ArgumentParser(description='Prefetch the imagery of areas of interest into the cache')
+    parser.add_argument(
+        '--bbox',
+        type=float,
+        nargs=4,
+        action='append',
+        default=[],
+        metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'),
+        help='an area of interest in WGS 84, can be repeated',
+    )
+    parser.add_argument(
+        '--geojson',
+        type=Path,
+        help='a GeoJSON file with areas of interest, feature properties can override '
+        '`indices`, `start_date`, `end_date`, `resolution` and `crs` (the EPSG code, by default the UTM zone)',
+    )
+    parser.add_argument('--index', type=Index, action='append', help='the indices to prefetch, defaults to all')
+    parser.add_argument('--start-date', default=default_time_range.start_date.isoformat())
+    parser.add_argument('--end-date', default=default_time_range.end_date.isoformat())
+    parser.add_argument('--resolution', type=int, default=90)
+    parser.add_argument('--concurrency', type=int, default=2, help='the number of concurrent downloads')
+    parser.add_argument('--pu-budget', type=float, help='the maximum number of PUs to spend, unlimited by default')
+    args = parser.parse_args()
+
+    if not args.bbox and args.geojson is None:
+        parser.error('at least one --bbox or a --geojson file is required')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # noinspection PyArgumentList
+    settings = Settings()
+    logging.basicConfig(level=settings.log_level.upper())
+    with open(settings.conf_path / 'logging.yaml') as file:
+        logging.config.dictConfig(yaml.safe_load(file))
+
+    indices = args.index or list(Index)
+    targets = [
+        PrefetchTarget(
+            index=index,
+            bbox=tuple(bbox),
+            start_date=args.start_date,
+            end_date=args.end_date,
+            resolution=args.resolution,
+        )
+        for bbox in args.bbox
+        for index in indices
+    ]
+    if args.geojson is not None:
+        targets += load_targets(
+            targets_file=args.geojson,
+            start_date=args.start_date,
+            end_date=args.end_date,
+            indices=indices,
+            resolution=args.resolution,
+        )
+
+    log.info(f'Prefetching {len(targets)} targets')
+    prefetch(
+        imagery_store=create_imagery_store(settings=settings),
+        targets=targets,
+        max_workers=args.concurrency,
+        pu_budget=args.pu_budget,
+    )
@@ -0,0 +1,120 @@
+import logging
+import random
+import re
+import secrets
+import uuid
+from datetime import UTC, datetime
+from enum import StrEnum
+from pathlib import Path
+from typing import Optional
+
+import anyio.to_thread
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+log = logging.getLogger(__name__)
+
+PROFILE_TOKEN_HEADER = 'X-Profile-Token'
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+
+class ProfileFormat(StrEnum):
+    HTML = 'html'
+    SPEEDSCOPE = 'speedscope'
+
+
+class RequestProfiler:
+    """
+    Decide which requests to profile and store their profiles.
+
+    Requests are profiled if they carry the admin token in the `X-Profile-Token` header or if they are randomly sampled.
+    Each profile is stored as `<request id>-<timestamp>-<suffix>.<format>` in the profile directory, the random suffix
+    prevents requests reusing an id from overwriting each other's profiles. The request id is taken from the
+    `X-Request-ID` header or generated and returned in the response headers.
+    """
+
+    def __init__(
+        self,
+        profile_dir: Path,
+        admin_token: Optional[str] = None,
+        sample_rate: float = 0.0,
+        profile_format: ProfileFormat = ProfileFormat.HTML,
+    ):
+        try:
+            import pyinstrument  # noqa: F401
+        except ImportError as e:
+            raise ImportError(
+                'Profiling requires the optional dependencies, install them via `poetry install -E profiling`'
+            ) from e
+
+        self.profile_dir = profile_dir
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        self.admin_token = admin_token
+        self.sample_rate = sample_rate
+        self.profile_format = profile_format
+
+    def should_profile(self, headers: Headers) -> bool:
+        token = headers.get(PROFILE_TOKEN_HEADER)
+        if token is not None:
+            if self.admin_token is not None and secrets.compare_digest(token, self.admin_token):
+                return True
+            log.warning('Ignoring profiling request with an invalid token')
+        return random.random() < self.sample_rate
+
+    def store(self, profiler, request_id: str) -> Path:
+        from pyinstrument.renderers import HTMLRenderer, SpeedscopeRenderer
+
+        profile_name = f'{request_id}-{datetime.now(UTC):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}'
+        match self.profile_format:
+            case ProfileFormat.HTML:
+                profile_path = self.profile_dir / f'{profile_name}.html'
+                profile_path.write_text(profiler.output(HTMLRenderer()))
+            case ProfileFormat.SPEEDSCOPE:
+                profile_path = self.profile_dir / f'{profile_name}.speedscope.json'
+                profile_path.write_text(profiler.output(SpeedscopeRenderer()))
+            case _:
+                raise ValueError(f'Profile format {self.profile_format} is not supported')
+        log.info(f'Stored profile of request {request_id} in {profile_path}')
+        return profile_path
+
+
+class ProfilingMiddleware:
+    """Run requests selected by the `RequestProfiler` in `app.state.request_profiler` under a sampling profiler"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request_profiler: Optional[RequestProfiler] = getattr(scope['app'].state, 'request_profiler', None)
+        headers = Headers(scope=scope)
+        if request_profiler is None or not request_profiler.should_profile(headers):
+            await self.app(scope, receive, send)
+            return
+
+        from pyinstrument import Profiler
+
+        request_id = headers.get(REQUEST_ID_HEADER, '')
+        if not re.fullmatch(r'[\w-]{1,64}', request_id):
+            # the request id becomes part of the file name
+            request_id = uuid.uuid4().hex
+
+        async def send_with_request_id(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                MutableHeaders(scope=message)[REQUEST_ID_HEADER] = request_id
+            await send(message)
+
+        profiler = Profiler(async_mode='enabled')
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            profiler.stop()
+            # rendering the profile takes a while, keep it off the event loop
+            try:
+                await anyio.to_thread.run_sync(request_profiler.store, profiler, request_id)
+            except Exception:
+                log.exception(f'Failed to store the profile of request {request_id}')
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+from datetime import date
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import FileResponse, Response
+from starlette.routing import BaseRoute, Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import naturalness
+from app.route.common import TimeRange
+from naturalness import metrics
+from naturalness.imagery_store_operator import CATALOG_SETTLING_PERIOD
+
+log = logging.getLogger(__name__)
+
+# headers that are set per response by the cache instead of being stored
+VOLATILE_HEADERS = ('content-length', 'etag', 'last-modified', 'cache-control')
+
+
+class ResponseCache:
+    """
+    Responses of deterministic requests stored on disk, addressed by the hash of the normalized request body.
+
+    A request is deterministic if its time range ended more than the `CATALOG_SETTLING_PERIOD` ago, i.e. no new
+    acquisitions will change its result. The hash also covers the version of the utility, so that a new release does not
+    serve responses computed by the previous one.
+    """
+
+    def __init__(self, routes: List[BaseRoute], cache_dir: Path, max_age: int = 86400, max_bytes: Optional[int] = None):
+        self.routes = routes
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def route_path(self, scope: Scope) -> Optional[str]:
+        """The path template of the cached route handling the request, if any"""
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return None
+
+    @staticmethod
+    def key(path: str, body: Dict[str, Any]) -> Optional[str]:
+        """The hash of the request, `None` if its response is not deterministic"""
+        try:
+            # the defaults of the time range are resolved, so that explicit and implicit defaults share the key
+            time_range = TimeRange.model_validate(body.get('time_range', {}))
+        except (AttributeError, ValueError):
+            # the route rejects the request
+            return None
+        if time_range.end_date + CATALOG_SETTLING_PERIOD >= date.today():
+            return None
+
+        normalized = json.dumps(
+            {
+                'version': str(naturalness.__version__),
+                'path': path,
+                'body': {**body, 'time_range': time_range.model_dump(mode='json')},
+            },
+            sort_keys=True,
+            separators=(',', ':'),
+        )
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    def cache_control(self) -> str:
+        return f'public, max-age={self.max_age}'
+
+    def _entry(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / key
+
+    def load(self, key: str) -> Optional[Response]:
+        entry = self._entry(key)
+        try:
+            headers = json.loads(entry.with_suffix('.json').read_text())
+            # the modification time marks the last use for the eviction
+            entry.touch()
+        except (FileNotFoundError, ValueError):
+            return None
+        return FileResponse(
+            path=entry,
+            headers={**headers, 'etag': f'"{key}"', 'cache-control': self.cache_control()},
+        )
+
+    def store(self, key: str, headers: Dict[str, str], content_file: Path) -> None:
+        entry = self._entry(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        # the headers are written last as they mark the entry as complete
+        os.replace(content_file, entry)
+        tmp_file = entry.with_name(f'.{key}.{uuid.uuid4().hex}.json')
+        tmp_file.write_text(json.dumps(headers))
+        os.replace(tmp_file, entry.with_suffix('.json'))
+        if self.max_bytes is not None:
+            self._evict(keep=entry)
+
+    def _evict(self, keep: Path) -> None:
+        with self._lock:
+            entries = []
+            for headers_file in self.cache_dir.glob('*/*.json'):
+                entry = headers_file.with_suffix('')
+                try:
+                    entries.append((entry.stat().st_mtime, entry.stat().st_size, entry))
+                except FileNotFoundError:
+                    continue
+
+            total_bytes = sum(size for _, size, _ in entries)
+            for _, size, entry in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                if entry == keep:
+                    continue
+                entry.with_suffix('.json').unlink(missing_ok=True)
+                entry.unlink(missing_ok=True)
+                total_bytes -= size
+                metrics.CACHE_EVICTIONS.labels(cache='response').inc()
+
+
+class ResponseCacheMiddleware:
+    """
+    Serve the deterministic requests of the routes of the `ResponseCache` in `app.state.response_cache` from the cache
+    and tag them with an ETag, answering `If-None-Match` with 304. All requests pass if it is not set.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        response_cache: Optional[ResponseCache] = getattr(scope['app'].state, 'response_cache', None)
+        route = None
+        if scope['type'] == 'http' and scope['method'] == 'POST' and response_cache is not None:
+            route = response_cache.route_path(scope)
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+
+        # the body is read ahead to compute the key and replayed to the route
+        messages: List[Message] = []
+        body = b''
+        while True:
+            message = await receive()
+            messages.append(message)
+            if message['type'] != 'http.request':
+                break
+            body += message.get('body', b'')
+            if not message.get('more_body', False):
+                break
+
+        async def replay() -> Message:
+            return messages.pop(0) if messages else await receive()
+
+        try:
+            key = ResponseCache.key(path=scope['path'], body=json.loads(body))
+        except ValueError:
+            key = None
+        if key is None:
+            await self.app(scope, replay, send)
+            return
+
+        etag = f'"{key}"'
+        if_none_match = Headers(scope=scope).get('if-none-match', '')
+        # weak comparison, compressed responses carry the weak form of the ETag
+        if etag in (tag.strip().removeprefix('W/') for tag in if_none_match.split(',')) or if_none_match.strip() == '*':
+            metrics.RESPONSE_CACHE_REQUESTS.labels(result='not_modified', route=route).inc()
+            response = Response(
+                status_code=304, headers={'etag': etag, 'cache-control': response_cache.cache_control()}
+            )
+            await response(scope, replay, send)
+            return
+
+        cached_response = response_cache.load(key)
+        if cached_response is not None:
+            metrics.RESPONSE_CACHE_REQUESTS.labels(result='hit', route=route).inc()
+            await cached_response(scope, replay, send)
+            return
+        metrics.RESPONSE_CACHE_REQUESTS.labels(result='miss', route=route).inc()
+
+        content_file = response_cache.cache_dir / f'.{key}.{uuid.uuid4().hex}'
+        stored_headers: Optional[Dict[str, str]] = None
+        content = None
+
+        async def send_and_store(message: Message) -> None:
+            nonlocal stored_headers, content
+            if message['type'] == 'http.response.start' and message['status'] == 200:
+                headers = MutableHeaders(scope=message)
+                stored_headers = {name: value for name, value in headers.items() if name not in VOLATILE_HEADERS}
+                headers['etag'] = etag
+                headers['cache-control'] = response_cache.cache_control()
+                content = open(content_file, mode='wb')
+            elif message['type'] == 'http.response.body' and content is not None:
+                content.write(message.get('body', b''))
+                if not message.get('more_body', False):
+                    content.close()
+                    content = None
+                    try:
+                        response_cache.store(key=key, headers=stored_headers, content_file=content_file)
+                    except OSError:
+                        log.exception('Storing the response in the cache failed')
+            await send(message)
+
+        try:
+            await self.app(scope, replay, send_and_store)
+        finally:
+            if content is not None:
+                content.close()
+            content_file.unlink(missing_ok=True)
@@ -1,37 +1,172 @@
+import asyncio
+import base64
 import logging
+import math
 import uuid
+from collections import Counter
 from datetime import date, timedelta
 from enum import StrEnum
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Annotated, Any, AsyncIterator, Dict, List, Optional, Tuple
 
 import geojson_pydantic
+import numpy as np
+import orjson
 import rasterio
+import sentinelhub
 import shapely
+from affine import Affine
+from fastapi import Body, Header, HTTPException
 from pydantic import BaseModel, Field, confloat, conint, model_validator
 from rasterio.crs import CRS
-from rasterstats import utils, zonal_stats
+from rasterio.features import geometry_mask
+from rasterio.windows import Window
+from rasterstats import gen_zonal_stats, utils
+from rasterstats.io import bounds_window, read_features
 from shapely.geometry import shape
 from starlette.background import BackgroundTask
-from starlette.responses import FileResponse
+from starlette.requests import Request
+from starlette.responses import FileResponse, JSONResponse
 
-from naturalness.imagery_store_operator import Index, RemoteSensingResult
+from naturalness import metrics
+from naturalness.deadline import DEADLINE, Deadline, check_deadline
+from naturalness.exception import DeadlineExceededError, RequestCancelledError
+from naturalness.imagery_store_operator import (
+    CATEGORICAL_INDICES,
+    NO_DATA_VALUES,
+    VALUE_RANGES,
+    Index,
+    RemoteSensingMosaic,
+)
+from naturalness.projection import is_supported, project_geometries, utm_crs
+from naturalness.tracing import tracer
 
 log = logging.getLogger(__name__)
 
-NO_DATA_VALUES = {
-    Index.NDVI: -999,
-    Index.WATER: 255,
-    Index.NATURALNESS: -999,
-}
-
 Aggregation = StrEnum('Aggregation', utils.VALID_STATS)
 
+DISCONNECT_POLL_INTERVAL = 0.5
+
+# the longest edge of preview rasters in pixels
+PREVIEW_MAX_EDGE = 256
+
+# the body parameters shared by the vector endpoints
+AggregationStatsBody = Annotated[List[Aggregation], Body(examples=[[Aggregation.median]])]
+VectorsBody = Annotated[
+    geojson_pydantic.FeatureCollection,
+    Body(
+        examples=[
+            {
+                'type': 'FeatureCollection',
+                'features': [
+                    {
+                        'type': 'Feature',
+                        'properties': {},
+                        'geometry': {
+                            'coordinates': [
+                                [[8.70, 49.41], [8.70, 49.42], [8.71, 49.42], [8.71, 49.41], [8.70, 49.41]]
+                            ],
+                            'type': 'Polygon',
+                        },
+                    }
+                ],
+            }
+        ]
+    ),
+]
+ResolutionBody = Annotated[conint(ge=10), Body()]
+CategoricalBody = Annotated[
+    bool, Body(description='Count the classes of categorical indices (WATER) as `class_counts` and `class_fractions`')
+]
+HistogramBinsBody = Annotated[
+    Optional[conint(ge=1, le=1000)],
+    Body(
+        description='Add a `histogram` with this number of equal-width bins over the value range of continuous '
+        'indices (NDVI: -1 to 1, NATURALNESS: 0 to 1)'
+    ),
+]
+IncludeGeometryBody = Annotated[
+    bool,
+    Body(
+        description='Return the geometries of the features. Without them, the features only carry their `id` (or '
+        'their position if they have none) and properties, which considerably shrinks the responses of large feature '
+        'collections.'
+    ),
+]
+
 
 class GeoTiffResponse(FileResponse):
     media_type = 'image/geotiff'
 
 
+class InstrumentedJSONResponse(JSONResponse):
+    """
+    Serialise pydantic models directly to JSON, all other content with orjson, and record the duration as
+    `serialization` stage.
+
+    Routes return this response instead of the model so that the complete model dump is covered, not only the final
+    encoding of the already converted content. Plain GeoJSON mappings are serialised as they are, i.e. computed feature
+    collections skip the validation of their geometries by `geojson_pydantic`. Numpy values are serialised natively and
+    NaN as `null`.
+    """
+
+    def render(self, content) -> bytes:
+        with metrics.observe_stage('serialization', index=metrics.INDEX.get()):
+            if isinstance(content, BaseModel):
+                return content.model_dump_json().encode('utf-8')
+            return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+
+async def track_request(request: Request) -> AsyncIterator[None]:
+    """Attribute the metrics recorded while processing the request to its route and index"""
+    route = request.scope['route'].path
+    index = request.path_params.get('index', '')
+    metrics.ROUTE.set(route)
+    metrics.INDEX.set(index)
+
+    in_flight = metrics.REQUESTS_IN_FLIGHT.labels(index=index, route=route)
+    in_flight.inc()
+    try:
+        yield
+    finally:
+        in_flight.dec()
+
+
+async def watch_disconnect(request: Request, deadline: Deadline, interval: float = DISCONNECT_POLL_INTERVAL) -> None:
+    """Cancel the deadline once the client disconnected"""
+    while not await request.is_disconnected():
+        await asyncio.sleep(interval)
+    log.info('The client disconnected, cancelling the request')
+    deadline.cancel()
+
+
+async def enforce_deadline(
+    request: Request,
+    x_request_timeout: Annotated[
+        Optional[confloat(gt=0.0)],
+        Header(description='Abort the request after this many seconds, capped by the timeout of the service'),
+    ] = None,
+) -> AsyncIterator[None]:
+    """
+    Bound the processing of the request by the client-supplied and the configured timeout, whichever is shorter, and
+    cancel it if the client disconnects. Downloads in progress still complete into the cache.
+    """
+    timeouts = (getattr(request.app.state, 'request_timeout', None), x_request_timeout)
+    deadline = Deadline(timeout=min((timeout for timeout in timeouts if timeout is not None), default=None))
+    DEADLINE.set(deadline)
+
+    watcher = asyncio.create_task(watch_disconnect(request=request, deadline=deadline))
+    try:
+        yield
+    except DeadlineExceededError as e:
+        raise HTTPException(status_code=504, detail=str(e)) from e
+    except RequestCancelledError as e:
+        # nobody receives the response, the status is only logged (like nginx, 499 marks a closed client connection)
+        raise HTTPException(status_code=499, detail=str(e)) from e
+    finally:
+        watcher.cancel()
+
+
 class TimeRange(BaseModel):
     start_date: Optional[date] = Field(
         title='Start Date',
@@ -61,6 +196,34 @@ class TimeRange(BaseModel):
         return self
 
 
+class TimeSeriesInterval(StrEnum):
+    MONTH = 'month'
+    QUARTER = 'quarter'
+
+
+def split_time_range(time_range: TimeRange, interval: TimeSeriesInterval) -> List[Tuple[date, date]]:
+    """
+    Split the time range into windows aligned to calendar months or quarters, so that the windows of a series remain the
+    same (and cached) when the series is extended. The first and last window are cut to the time range.
+    """
+    match interval:
+        case TimeSeriesInterval.MONTH:
+            months = 1
+        case TimeSeriesInterval.QUARTER:
+            months = 3
+        case _:
+            raise ValueError(f'Time series interval {interval} is not supported')
+
+    windows = []
+    window_start = time_range.start_date
+    while window_start <= time_range.end_date:
+        next_month = ((window_start.year * 12 + window_start.month - 1) // months + 1) * months
+        next_start = date(next_month // 12, next_month % 12 + 1, 1)
+        windows.append((window_start, min(next_start - timedelta(days=1), time_range.end_date)))
+        window_start = next_start
+    return windows
+
+
 class NaturalnessWorkUnit(BaseModel):
     """Area of interest for naturalness index"""
 
@@ -82,10 +245,68 @@ class NaturalnessWorkUnit(BaseModel):
         description='Bounding box coordinates in WGS 84 (west, south, east, north)',
         examples=[[8.70, 49.41, 8.71, 49.42]],
     )
+    preview: bool = Field(
+        title='Preview',
+        description='Return a coarse preview of at most 256 pixels per edge right away. The `Link` header of the '
+        'response (relation `full-resolution`) points to the raster at the requested resolution, which is only '
+        'retrieved once it is requested.',
+        default=False,
+    )
+    crs: Optional[int] = Field(
+        title='Output CRS',
+        description='EPSG code of the coordinate reference system of the raster, either 4326 (WGS 84) or a UTM zone '
+        '(326xx north, 327xx south). Defaults to the UTM zone of the centre of the bbox, whose pixels are squares of '
+        '`resolution` metres.',
+        default=None,
+        examples=[32632],
+    )
+
+    @model_validator(mode='after')
+    def check_crs(self) -> 'NaturalnessWorkUnit':
+        if self.crs is not None:
+            assert is_supported(self.crs), 'The CRS must be WGS 84 (4326) or a UTM zone'
+        return self
+
+    def output_crs(self) -> int:
+        return utm_crs(self.bbox) if self.crs is None else self.crs
 
 
+def preview_resolution(
+    bbox: Tuple[float, float, float, float], resolution: int, max_edge: int = PREVIEW_MAX_EDGE
+) -> int:
+    """
+    The requested resolution doubled until the longest edge of the area is at most `max_edge` pixels. The previews of
+    all areas of a resolution thereby share a few resolutions, i.e. repeated previews are served from the cache.
+    """
+    while (
+        max(
+            sentinelhub.bbox_to_dimensions(
+                sentinelhub.BBox(bbox=bbox, crs=sentinelhub.CRS.WGS84), resolution=resolution
+            )
+        )
+        > max_edge
+    ):
+        resolution *= 2
+    return resolution
+
+
+def encode_work_unit(body: NaturalnessWorkUnit) -> str:
+    """The work unit at its full resolution as URL-safe token"""
+    work_unit = body.model_dump_json(exclude={'preview'})
+    return base64.urlsafe_b64encode(work_unit.encode()).decode().rstrip('=')
+
+
+def decode_work_unit(token: str) -> NaturalnessWorkUnit:
+    try:
+        work_unit = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        return NaturalnessWorkUnit.model_validate_json(work_unit)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail='The work unit of the URL is invalid') from e
+
+
+@tracer.start_as_current_span('compute_raster_response')
 def __compute_raster_response(
-    raster_result: RemoteSensingResult,
+    raster_result: RemoteSensingMosaic,
     body: NaturalnessWorkUnit,
     index: Index,
 ) -> GeoTiffResponse:
@@ -95,21 +316,45 @@ def __compute_raster_response(
     def unlink():
         file_path.unlink()
 
-    with rasterio.open(
-        file_path,
-        mode='w+',
-        driver='GTiff',
-        height=raster_result.height,
-        width=raster_result.width,
-        count=1,
-        dtype=str(raster_result.index_data.dtype),
-        crs=CRS.from_string('EPSG:4326'),
-        nodata=NO_DATA_VALUES[index],
-        transform=rasterio.transform.from_bounds(
-            *raster_result.bbox, width=raster_result.width, height=raster_result.height
-        ),
-    ) as dst:
-        dst.write(raster_result.index_data, 1)
+    # the tiles are written window by window as they arrive, the file is created once the first tile tells the dtype
+    dst = None
+    try:
+        for tile in raster_result.tiles:
+            check_deadline()
+            with metrics.observe_stage('encode', index=index):
+                if dst is None:
+                    dst = rasterio.open(
+                        file_path,
+                        mode='w+',
+                        driver='GTiff',
+                        height=raster_result.height,
+                        width=raster_result.width,
+                        count=1,
+                        dtype=str(tile.result.index_data.dtype),
+                        crs=CRS.from_epsg(raster_result.crs),
+                        nodata=NO_DATA_VALUES[index],
+                        transform=rasterio.transform.from_bounds(
+                            *raster_result.bbox, width=raster_result.width, height=raster_result.height
+                        ),
+                        BIGTIFF='IF_SAFER',
+                    )
+                dst.write(
+                    tile.result.index_data,
+                    1,
+                    window=Window(
+                        col_off=tile.column_offset,
+                        row_off=tile.row_offset,
+                        width=tile.result.width,
+                        height=tile.result.height,
+                    ),
+                )
+        with metrics.observe_stage('encode', index=index):
+            dst.close()
+    except Exception:
+        if dst is not None:
+            dst.close()
+        file_path.unlink(missing_ok=True)
+        raise
 
     log.info(f'Finished for {body}')
 
@@ -121,27 +366,278 @@ def __compute_raster_response(
     )
 
 
+class ZonalStatsAccumulator:
+    """
+    Merge the zonal statistics of a feature across the tiles it overlaps, equal to the statistics `rasterstats` computes
+    on the complete raster. Apart from `median`, which keeps the valid values of the feature, the accumulated state does
+    not depend on the size of the feature.
+
+    Class counts of categorical indices are counted with `np.bincount` on the integer classes, histograms of continuous
+    indices use equal-width bins over the value range of the index.
+    """
+
+    def __init__(
+        self,
+        stats: List[str],
+        class_count: Optional[int] = None,
+        histogram_bins: Optional[int] = None,
+        histogram_range: Optional[Tuple[float, float]] = None,
+    ):
+        self.stats = stats
+        self.count = 0
+        self.mean = 0.0
+        self.squared_deviations = 0.0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.nodata = 0
+        self.nan = 0
+        self.moments = bool({'mean', 'sum', 'std'}.intersection(stats))
+        self.class_counts = np.zeros(class_count, dtype=np.int64) if class_count is not None else None
+        needs_pixel_count = {'majority', 'minority', 'unique'}.intersection(stats)
+        self.pixel_count = Counter() if needs_pixel_count and self.class_counts is None else None
+        self.values = [] if 'median' in stats else None
+        self.histogram = np.zeros(histogram_bins, dtype=np.int64) if histogram_bins is not None else None
+        self.histogram_range = histogram_range
+
+    def add(self, values: np.ndarray, nodata: float) -> None:
+        is_nodata = values == nodata
+        self.nodata += int(is_nodata.sum())
+        if np.issubdtype(values.dtype, np.floating):
+            is_nan = np.isnan(values)
+            self.nan += int(is_nan.sum())
+            valid = values[~(is_nodata | is_nan)]
+        else:
+            valid = values[~is_nodata]
+        if valid.size == 0:
+            return
+
+        if self.moments:
+            valid_sum = float(valid.sum(dtype=np.float64))
+            valid_mean = valid_sum / valid.size
+            # the parallel variance algorithm by Chan et al. keeps the standard deviation numerically stable
+            count = self.count + valid.size
+            delta = valid_mean - self.mean
+            self.squared_deviations += (
+                float(((valid - valid_mean) ** 2).sum(dtype=np.float64)) + delta**2 * self.count * valid.size / count
+            )
+            self.mean += delta * valid.size / count
+            self.sum += valid_sum
+        self.count += valid.size
+        self.min = min(self.min, valid.min().item())
+        self.max = max(self.max, valid.max().item())
+        if self.class_counts is not None:
+            counts = np.bincount(valid.astype(np.intp, copy=False), minlength=self.class_counts.size)
+            counts[: self.class_counts.size] += self.class_counts
+            self.class_counts = counts
+        if self.pixel_count is not None:
+            keys, counts = np.unique(valid, return_counts=True)
+            self.pixel_count.update(dict(zip(keys.tolist(), counts.tolist())))
+        if self.values is not None:
+            self.values.append(valid)
+        if self.histogram is not None:
+            self.histogram += np.histogram(valid, bins=self.histogram.size, range=self.histogram_range)[0]
+
+    def result(self) -> Dict[str, Any]:
+        if self.count == 0:
+            feature_stats = {stat: None for stat in self.stats}
+            if 'count' in self.stats:
+                feature_stats['count'] = 0
+        else:
+            if self.class_counts is not None:
+                pixel_count = {key: int(count) for key, count in enumerate(self.class_counts.tolist()) if count > 0}
+            else:
+                pixel_count = self.pixel_count or {}
+            keys = sorted(pixel_count)
+            feature_stats = {
+                'min': float(self.min),
+                'max': float(self.max),
+                'mean': self.mean,
+                'count': self.count,
+                'sum': self.sum,
+                'std': math.sqrt(self.squared_deviations / self.count),
+                'median': float(np.median(np.concatenate(self.values))) if self.values is not None else None,
+                'majority': float(max(keys, key=pixel_count.get)) if keys else None,
+                'minority': float(min(keys, key=pixel_count.get)) if keys else None,
+                'unique': len(keys),
+                'range': float(self.max - self.min),
+            }
+            feature_stats = {stat: value for stat, value in feature_stats.items() if stat in self.stats}
+        if 'nodata' in self.stats:
+            feature_stats['nodata'] = float(self.nodata)
+        if 'nan' in self.stats:
+            feature_stats['nan'] = float(self.nan)
+
+        if self.class_counts is not None:
+            feature_stats['class_counts'] = {str(key): int(count) for key, count in enumerate(self.class_counts)}
+            feature_stats['class_fractions'] = {
+                str(key): int(count) / self.count if self.count > 0 else None
+                for key, count in enumerate(self.class_counts)
+            }
+        if self.histogram is not None:
+            feature_stats['histogram'] = self.histogram.tolist()
+        return feature_stats
+
+
+@tracer.start_as_current_span('compute_vector_response')
 def __compute_vector_response(
     stats: List[Aggregation],
     vectors: geojson_pydantic.FeatureCollection,
     index: Index,
-    raster_result: RemoteSensingResult,
-) -> geojson_pydantic.FeatureCollection:
-    geojson = zonal_stats(
-        vectors=vectors,
-        raster=raster_result.index_data,
+    raster_result: RemoteSensingMosaic,
+    categorical: bool = False,
+    histogram_bins: Optional[int] = None,
+    include_geometry: bool = True,
+) -> Dict[str, Any]:
+    features = list(read_features(vectors))
+    # the statistics are computed on the geometries projected into the CRS of the raster, the features remain in WGS 84
+    geometries = project_geometries([shape(feature['geometry']) for feature in features], crs=raster_result.crs)
+    if raster_result.tile_count == 1 and not categorical and histogram_bins is None:
+        tile = next(raster_result.tiles)
+        with metrics.observe_stage('zonal_stats', index=index):
+            for feature, feature_stats in zip(
+                features,
+                gen_zonal_stats(
+                    vectors=geometries,
+                    raster=tile.result.index_data,
+                    stats=stats,
+                    affine=rasterio.transform.from_bounds(
+                        *raster_result.bbox, width=raster_result.width, height=raster_result.height
+                    ),
+                    nodata=NO_DATA_VALUES[index],
+                    all_touched=True,
+                ),
+            ):
+                check_deadline()
+                feature.setdefault('properties', {}).update(feature_stats)
+        return to_feature_collection(features=features, include_geometry=include_geometry)
+
+    # the statistics of large mosaics are accumulated tile by tile, so only one tile is held in memory at a time
+    accumulators = _accumulate_zonal_stats(
+        stats=stats,
+        geometries=geometries,
+        mosaics={index: raster_result},
+        categorical=categorical,
+        histogram_bins=histogram_bins,
+    )
+    for feature, accumulator in zip(features, accumulators[index]):
+        feature.setdefault('properties', {}).update(accumulator.result())
+    return to_feature_collection(features=features, include_geometry=include_geometry)
+
+
+@tracer.start_as_current_span('compute_multi_index_vector_response')
+def __compute_multi_index_vector_response(
+    stats: List[Aggregation],
+    vectors: geojson_pydantic.FeatureCollection,
+    raster_results: Dict[Index, RemoteSensingMosaic],
+    categorical: bool = False,
+    histogram_bins: Optional[int] = None,
+    include_geometry: bool = True,
+) -> Dict[str, Any]:
+    """Compute the stats of all indices, the properties are prefixed with the index, e.g. `NDVI_mean`"""
+    features = list(read_features(vectors))
+    crs = next(iter(raster_results.values())).crs
+    accumulators = _accumulate_zonal_stats(
         stats=stats,
-        affine=rasterio.transform.from_bounds(
-            *raster_result.bbox, width=raster_result.width, height=raster_result.height
-        ),
-        geojson_out=True,
-        nodata=NO_DATA_VALUES[index],
-        all_touched=True,
+        geometries=project_geometries([shape(feature['geometry']) for feature in features], crs=crs),
+        mosaics=raster_results,
+        categorical=categorical,
+        histogram_bins=histogram_bins,
     )
+    for i, feature in enumerate(features):
+        properties = feature.setdefault('properties', {})
+        for index, index_accumulators in accumulators.items():
+            properties.update({f'{index}_{stat}': value for stat, value in index_accumulators[i].result().items()})
+    return to_feature_collection(features=features, include_geometry=include_geometry)
+
+
+def to_feature_collection(features: List[Dict[str, Any]], include_geometry: bool = True) -> Dict[str, Any]:
+    """
+    Wrap the computed features into a GeoJSON feature collection. Without geometries, the features keep their id and
+    properties only, features without id are identified by their position.
+    """
+    if not include_geometry:
+        features = [
+            {
+                'type': 'Feature',
+                'id': i if feature.get('id') is None else feature['id'],
+                'geometry': None,
+                'properties': feature.get('properties') or {},
+            }
+            for i, feature in enumerate(features)
+        ]
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def _accumulate_zonal_stats(
+    stats: List[Aggregation],
+    geometries: List[shapely.Geometry],
+    mosaics: Dict[Index, RemoteSensingMosaic],
+    categorical: bool = False,
+    histogram_bins: Optional[int] = None,
+) -> Dict[Index, List[ZonalStatsAccumulator]]:
+    """
+    Accumulate the stats of each geometry over the tiles of the mosaics. The mosaics must share the same grid, so every
+    geometry is rasterized only once per tile and the mask is applied to the tiles of all indices. The geometries must
+    be given in the CRS of the mosaics.
+
+    :param categorical: count the classes of the categorical indices
+    :param histogram_bins: the number of histogram bins of the continuous indices, no histogram if `None`
+    """
+    first = next(iter(mosaics.values()))
+    if any(
+        (mosaic.height, mosaic.width, mosaic.tile_count) != (first.height, first.width, first.tile_count)
+        for mosaic in mosaics.values()
+    ):
+        raise ValueError('The mosaics of all indices must share the same grid')
+
+    accumulators = {
+        index: [
+            ZonalStatsAccumulator(
+                stats=[str(stat) for stat in stats],
+                class_count=CATEGORICAL_INDICES.get(index) if categorical else None,
+                histogram_bins=histogram_bins if index in VALUE_RANGES else None,
+                histogram_range=VALUE_RANGES.get(index),
+            )
+            for _ in geometries
+        ]
+        for index in mosaics
+    }
+    transform = rasterio.transform.from_bounds(*first.bbox, width=first.width, height=first.height)
+    for tiles in zip(*(mosaic.tiles for mosaic in mosaics.values())):
+        tile = tiles[0]
+        window = Window(
+            col_off=tile.column_offset,
+            row_off=tile.row_offset,
+            width=tile.result.width,
+            height=tile.result.height,
+        )
+        tile_transform = rasterio.windows.transform(window, transform)
+        with metrics.observe_stage('zonal_stats', index=metrics.INDEX.get()):
+            for i, geometry in enumerate(geometries):
+                check_deadline()
+                # like rasterstats, only the window covering the bounds of the geometry is rasterized
+                (row_start, row_stop), (column_start, column_stop) = bounds_window(geometry.bounds, tile_transform)
+                row_stop, column_stop = max(row_stop, row_start + 1), max(column_stop, column_start + 1)
+                row_start, column_start = max(row_start, 0), max(column_start, 0)
+                row_stop, column_stop = min(row_stop, tile.result.height), min(column_stop, tile.result.width)
+                if row_start >= row_stop or column_start >= column_stop:
+                    continue
 
-    return geojson_pydantic.FeatureCollection(type='FeatureCollection', features=geojson)
+                in_geometry = geometry_mask(
+                    [geometry],
+                    out_shape=(row_stop - row_start, column_stop - column_start),
+                    transform=tile_transform * Affine.translation(column_start, row_start),
+                    all_touched=True,
+                    invert=True,
+                )
+                for index, index_tile in zip(mosaics, tiles):
+                    values = index_tile.result.index_data[row_start:row_stop, column_start:column_stop][in_geometry]
+                    accumulators[index][i].add(values=values, nodata=NO_DATA_VALUES[index])
+    return accumulators
 
 
+@tracer.start_as_current_span('get_bbox')
 def get_bbox(features: geojson_pydantic.FeatureCollection) -> Tuple[float, float, float, float]:
     geoms = []
     for feature in features.iter():
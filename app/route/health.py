@@ -1,15 +1,93 @@
-from fastapi import APIRouter
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, Request, Response
 from pydantic import BaseModel
 
+from naturalness import metrics
+
 router = APIRouter(prefix='/health')
 
 
+@dataclass(frozen=True)
+class ReadinessPolicy:
+    """The thresholds beyond which a replica reports that it is not ready to receive traffic"""
+
+    cache_dir: Path = Path('./cache')
+    max_upstream_error_rate: float = 0.5
+    min_free_disk_bytes: int = 1_000_000_000
+
+
 class HealthCheck(BaseModel):
     status: str = 'ok'
 
 
+class RouteLoad(BaseModel):
+    in_flight: int
+    queued: int
+
+
+class CacheDiskUsage(BaseModel):
+    total_bytes: int
+    used_bytes: int
+    free_bytes: int
+
+
+class ReadinessCheck(BaseModel):
+    status: str
+    reasons: List[str] = []
+    routes: Dict[str, RouteLoad] = {}
+    cache_disk: Optional[CacheDiskUsage] = None
+    upstream_error_rate: Optional[float] = None
+
+
 @router.get(
     '', status_code=200, summary='Annie, are you ok?', description='Verify whether the application API is operational'
 )
 async def is_ok() -> HealthCheck:
     return HealthCheck()
+
+
+@router.get(
+    '/ready',
+    status_code=200,
+    summary='Are you ready for more?',
+    description='Report the queue depth and in-flight requests per route, the disk usage of the cache and the error '
+    'rate of SentinelHub downloads. Responds with 503 if a route is saturated, the error rate or the disk usage '
+    'exceed their thresholds, so that load balancers stop routing to overloaded replicas.',
+    responses={503: {'model': ReadinessCheck}},
+)
+async def is_ready(request: Request, response: Response) -> ReadinessCheck:
+    policy = getattr(request.app.state, 'readiness_policy', ReadinessPolicy())
+    load_shedder = getattr(request.app.state, 'load_shedder', None)
+    reasons = []
+
+    routes = {}
+    if load_shedder is not None:
+        for route, load in load_shedder.loads().items():
+            routes[route] = RouteLoad(in_flight=load.in_flight, queued=load.queued)
+            if load_shedder.saturated(route):
+                reasons.append(f'{route} is saturated')
+
+    cache_disk = None
+    if policy.cache_dir.exists():
+        total_bytes, used_bytes, free_bytes = shutil.disk_usage(policy.cache_dir)
+        cache_disk = CacheDiskUsage(total_bytes=total_bytes, used_bytes=used_bytes, free_bytes=free_bytes)
+        if free_bytes < policy.min_free_disk_bytes:
+            reasons.append(f'only {free_bytes} bytes are free on the cache disk')
+
+    upstream_error_rate = metrics.UPSTREAM_ERROR_RATE.value()
+    if upstream_error_rate is not None and upstream_error_rate > policy.max_upstream_error_rate:
+        reasons.append(f'{upstream_error_rate:.0%} of the SentinelHub downloads failed')
+
+    if reasons:
+        response.status_code = 503
+    return ReadinessCheck(
+        status='unavailable' if reasons else 'ready',
+        reasons=reasons,
+        routes=routes,
+        cache_disk=cache_disk,
+        upstream_error_rate=upstream_error_rate,
+    )
@@ -1,98 +1,320 @@
 import logging.config
-from typing import Annotated, List
+from datetime import date
+from functools import partial
+from typing import Annotated, Any, Dict, List
 
+import anyio
 import geojson_pydantic
-from fastapi import APIRouter, Body
-from fastapi.responses import JSONResponse
-from pydantic import conint
+from fastapi import APIRouter, Body, Depends, HTTPException
+from opentelemetry import trace
 from starlette.requests import Request
 
 from app.route.common import (
-    Aggregation,
+    AggregationStatsBody,
+    CategoricalBody,
     GeoTiffResponse,
+    HistogramBinsBody,
+    IncludeGeometryBody,
+    InstrumentedJSONResponse,
     NaturalnessWorkUnit,
+    ResolutionBody,
     TimeRange,
+    TimeSeriesInterval,
+    VectorsBody,
+    __compute_multi_index_vector_response,
     __compute_raster_response,
     __compute_vector_response,
+    decode_work_unit,
+    encode_work_unit,
+    enforce_deadline,
     get_bbox,
+    preview_resolution,
+    split_time_range,
+    to_feature_collection,
+    track_request,
 )
-from naturalness.imagery_store_operator import Index
+from app.scheduling import identify_client, run_scheduled
+from naturalness.imagery_store_operator import CATEGORICAL_INDICES, VALUE_RANGES, Index
+from naturalness.projection import project_bbox, utm_crs
+from naturalness.tracing import tracer
 
 log = logging.getLogger(__name__)
 
-router = APIRouter(prefix='', tags=['index'])
+# the maximum number of windows of a time series, i.e. ten years of monthly windows
+MAX_TIME_SERIES_WINDOWS = 120
+DEFAULT_TIME_SERIES_CONCURRENCY = 4
+
+router = APIRouter(
+    prefix='',
+    tags=['index'],
+    dependencies=[Depends(track_request), Depends(enforce_deadline), Depends(identify_client)],
+)
 
 
 @router.post(
     '/{index}/raster',
     summary='Index values as raster',
-    description='Retrieve the requested index and return its raw data as raster (GeoTIFF)',
+    description='Retrieve the requested index and return its raw data as raster (GeoTIFF). Previews are returned at a '
+    'coarse resolution, their `Link` header points to the full-resolution raster.',
     response_class=GeoTiffResponse,
 )
+@tracer.start_as_current_span('index_compute_raster')
 async def index_compute_raster(index: Index, body: NaturalnessWorkUnit, request: Request) -> GeoTiffResponse:
     log.info(f'Creating index for {body}')
+    if not body.preview:
+        return await __respond_raster(index=index, body=body, resolution=body.resolution, request=request)
 
-    raster_result = request.app.state.imagery_store.imagery(
-        index=index,
-        bbox=body.bbox,
-        start_date=body.time_range.start_date.isoformat(),
-        end_date=body.time_range.end_date.isoformat(),
-        resolution=body.resolution,
+    resolution = preview_resolution(bbox=body.bbox, resolution=body.resolution)
+    response = await __respond_raster(index=index, body=body, resolution=resolution, request=request)
+    # the full resolution is only retrieved (and paid) once the client follows the link. The link is relative to the
+    # host, so that responses replayed from the response cache hold for any host or proxy they are requested through
+    full_path = request.app.url_path_for(
+        'index_compute_full_raster', index=index.value, work_unit=encode_work_unit(body)
     )
-    return __compute_raster_response(raster_result=raster_result, body=body, index=index)
+    response.headers['Link'] = f'<{request.scope.get("root_path", "").rstrip("/")}{full_path}>; rel="full-resolution"'
+    response.headers['X-Preview-Resolution'] = str(resolution)
+    return response
+
+
+@router.get(
+    '/{index}/raster/full/{work_unit}',
+    summary='Full-resolution raster of a preview',
+    description='Retrieve the requested index at the full resolution of a preview, as linked by the preview',
+    response_class=GeoTiffResponse,
+)
+@tracer.start_as_current_span('index_compute_full_raster')
+async def index_compute_full_raster(index: Index, work_unit: str, request: Request) -> GeoTiffResponse:
+    body = decode_work_unit(work_unit)
+    log.info(f'Creating index for {body}')
+    return await __respond_raster(index=index, body=body, resolution=body.resolution, request=request)
+
+
+async def __respond_raster(
+    index: Index, body: NaturalnessWorkUnit, resolution: int, request: Request
+) -> GeoTiffResponse:
+    trace.get_current_span().set_attributes(
+        {'naturalness.index': index, 'naturalness.resolution': resolution, 'naturalness.preview': body.preview}
+        | ({} if body.crs is None else {'naturalness.crs': body.crs})
+    )
+
+    crs = body.output_crs()
+    bbox = project_bbox(bbox=body.bbox, crs=crs, resolution=resolution)
+    imagery_store = request.app.state.imagery_store
+
+    def compute_raster() -> GeoTiffResponse:
+        raster_result = imagery_store.mosaic(
+            index=index,
+            bbox=bbox,
+            start_date=body.time_range.start_date.isoformat(),
+            end_date=body.time_range.end_date.isoformat(),
+            resolution=resolution,
+            crs=crs,
+        )
+        return __compute_raster_response(raster_result=raster_result, body=body, index=index)
+
+    # the retrieval blocks, keep it off the event loop so that queued requests can be shed and probes answered
+    return await run_scheduled(request, compute_raster)
 
 
 @router.post(
     '/{index}/vector',
     summary='Aggregate index values to user-defined regions',
     description='Retrieve the requested index and compute a summary of the values within the given vector geometry (GeoJSON)',
-    response_class=JSONResponse,
+    response_class=InstrumentedJSONResponse,
 )
+@tracer.start_as_current_span('index_compute_vector')
 async def index_compute_vector(
     index: Index,
-    aggregation_stats: Annotated[List[Aggregation], Body(examples=[[Aggregation.median]])],
-    vectors: Annotated[
-        geojson_pydantic.FeatureCollection,
-        Body(
-            examples=[
-                {
-                    'type': 'FeatureCollection',
-                    'features': [
-                        {
-                            'type': 'Feature',
-                            'properties': {},
-                            'geometry': {
-                                'coordinates': [
-                                    [[8.70, 49.41], [8.70, 49.42], [8.71, 49.42], [8.71, 49.41], [8.70, 49.41]]
-                                ],
-                                'type': 'Polygon',
-                            },
-                        }
-                    ],
-                }
-            ]
-        ),
-    ],
+    aggregation_stats: AggregationStatsBody,
+    vectors: VectorsBody,
     time_range: TimeRange,
     request: Request,
-    resolution: Annotated[conint(ge=10), Body()] = 90,
+    resolution: ResolutionBody = 90,
+    categorical: CategoricalBody = False,
+    histogram_bins: HistogramBinsBody = None,
+    include_geometry: IncludeGeometryBody = True,
 ) -> geojson_pydantic.FeatureCollection:
     log.info(f'Creating index for {time_range}')
+    if categorical and index not in CATEGORICAL_INDICES:
+        raise HTTPException(status_code=422, detail='Class counts are only available for categorical indices')
+    if histogram_bins is not None and index not in VALUE_RANGES:
+        raise HTTPException(status_code=422, detail='Histograms are only available for continuous indices')
+    trace.get_current_span().set_attributes(
+        {
+            'naturalness.index': index,
+            'naturalness.resolution': resolution,
+            'naturalness.feature_count': len(vectors.features),
+        }
+    )
+
+    bbox = get_bbox(features=vectors)
+    # the statistics are computed in the UTM zone of the features, on pixels of equal area
+    crs = utm_crs(bbox)
+    bbox = project_bbox(bbox=bbox, crs=crs, resolution=resolution)
+    imagery_store = request.app.state.imagery_store
+
+    def compute_vector() -> Dict[str, Any]:
+        raster_result = imagery_store.mosaic(
+            index=index,
+            bbox=bbox,
+            start_date=time_range.start_date.isoformat(),
+            end_date=time_range.end_date.isoformat(),
+            resolution=resolution,
+            crs=crs,
+        )
+        return __compute_vector_response(
+            stats=aggregation_stats,
+            vectors=vectors,
+            index=index,
+            raster_result=raster_result,
+            categorical=categorical,
+            histogram_bins=histogram_bins,
+            include_geometry=include_geometry,
+        )
+
+    vector_response = await run_scheduled(request, compute_vector)
+    log.info(f'Finished for {time_range}')
+
+    return InstrumentedJSONResponse(content=vector_response)
+
+
+@router.post(
+    '/vector',
+    summary='Aggregate the values of several indices to user-defined regions',
+    description='Retrieve the requested indices and compute a summary of the values of each index within the given '
+    'vector geometry (GeoJSON) in a single pass. The summaries are prefixed with the index, e.g. `NDVI_median`.',
+    response_class=InstrumentedJSONResponse,
+)
+@tracer.start_as_current_span('multi_index_compute_vector')
+async def multi_index_compute_vector(
+    indices: Annotated[List[Index], Body(min_length=1, examples=[[Index.NDVI, Index.WATER]])],
+    aggregation_stats: AggregationStatsBody,
+    vectors: VectorsBody,
+    time_range: TimeRange,
+    request: Request,
+    resolution: ResolutionBody = 90,
+    categorical: CategoricalBody = False,
+    histogram_bins: HistogramBinsBody = None,
+    include_geometry: IncludeGeometryBody = True,
+) -> geojson_pydantic.FeatureCollection:
+    log.info(f'Creating indices {indices} for {time_range}')
+    trace.get_current_span().set_attributes(
+        {
+            'naturalness.indices': [str(index) for index in indices],
+            'naturalness.resolution': resolution,
+            'naturalness.feature_count': len(vectors.features),
+        }
+    )
+
+    bbox = get_bbox(features=vectors)
+    crs = utm_crs(bbox)
+    bbox = project_bbox(bbox=bbox, crs=crs, resolution=resolution)
+    imagery_store = request.app.state.imagery_store
+
+    def compute_vector() -> Dict[str, Any]:
+        raster_results = {
+            index: imagery_store.mosaic(
+                index=index,
+                bbox=bbox,
+                start_date=time_range.start_date.isoformat(),
+                end_date=time_range.end_date.isoformat(),
+                resolution=resolution,
+                crs=crs,
+            )
+            for index in dict.fromkeys(indices)
+        }
+        return __compute_multi_index_vector_response(
+            stats=aggregation_stats,
+            vectors=vectors,
+            raster_results=raster_results,
+            categorical=categorical,
+            histogram_bins=histogram_bins,
+            include_geometry=include_geometry,
+        )
+
+    vector_response = await run_scheduled(request, compute_vector)
+    log.info(f'Finished for {time_range}')
+
+    return InstrumentedJSONResponse(content=vector_response)
+
 
-    raster_result = request.app.state.imagery_store.imagery(
-        index=index,
-        bbox=get_bbox(features=vectors),
-        start_date=time_range.start_date.isoformat(),
-        end_date=time_range.end_date.isoformat(),
-        resolution=resolution,
+@router.post(
+    '/{index}/timeseries',
+    summary='Aggregate index values to user-defined regions over time',
+    description='Split the time range into monthly or quarterly windows, retrieve the requested index for each window '
+    'and compute a summary of the values within the given vector geometry (GeoJSON). Each feature receives a '
+    '`time_series` table with the `start_date`, `end_date` and summaries of each window.',
+    response_class=InstrumentedJSONResponse,
+)
+@tracer.start_as_current_span('index_compute_timeseries')
+async def index_compute_timeseries(
+    index: Index,
+    aggregation_stats: AggregationStatsBody,
+    vectors: VectorsBody,
+    time_range: TimeRange,
+    request: Request,
+    interval: Annotated[TimeSeriesInterval, Body()] = TimeSeriesInterval.MONTH,
+    resolution: ResolutionBody = 90,
+    include_geometry: IncludeGeometryBody = True,
+) -> geojson_pydantic.FeatureCollection:
+    log.info(f'Creating {interval} time series for {time_range}')
+    windows = split_time_range(time_range=time_range, interval=interval)
+    if len(windows) > MAX_TIME_SERIES_WINDOWS:
+        raise HTTPException(
+            status_code=422,
+            detail=f'The time series would have {len(windows)} windows, at most {MAX_TIME_SERIES_WINDOWS} are supported',
+        )
+    trace.get_current_span().set_attributes(
+        {
+            'naturalness.index': index,
+            'naturalness.resolution': resolution,
+            'naturalness.feature_count': len(vectors.features),
+            'naturalness.window_count': len(windows),
+        }
     )
 
-    vector_response = __compute_vector_response(
-        stats=aggregation_stats,
-        vectors=vectors,
-        index=index,
-        raster_result=raster_result,
+    bbox = get_bbox(features=vectors)
+    crs = utm_crs(bbox)
+    bbox = project_bbox(bbox=bbox, crs=crs, resolution=resolution)
+    imagery_store = request.app.state.imagery_store
+
+    def compute_window(start_date: date, end_date: date) -> Dict[str, Any]:
+        raster_result = imagery_store.mosaic(
+            index=index,
+            bbox=bbox,
+            start_date=start_date.isoformat(),
+            end_date=end_date.isoformat(),
+            resolution=resolution,
+            crs=crs,
+        )
+        return __compute_vector_response(
+            stats=aggregation_stats, vectors=vectors, index=index, raster_result=raster_result
+        )
+
+    # the windows are independent requests (and cache entries), so they are retrieved concurrently
+    limiter = anyio.CapacityLimiter(
+        getattr(request.app.state, 'timeseries_concurrency', DEFAULT_TIME_SERIES_CONCURRENCY)
     )
+    window_responses = [None] * len(windows)
+
+    async def retrieve(i: int, start_date: date, end_date: date) -> None:
+        window_responses[i] = await run_scheduled(
+            request, partial(compute_window, start_date=start_date, end_date=end_date), limiter=limiter
+        )
+
+    async with anyio.create_task_group() as task_group:
+        for i, (start_date, end_date) in enumerate(windows):
+            task_group.start_soon(retrieve, i, start_date, end_date)
+
+    features = [feature.model_dump(mode='json') for feature in vectors.features]
+    for i, feature in enumerate(features):
+        time_series = {
+            'start_date': [start_date.isoformat() for start_date, _ in windows],
+            'end_date': [end_date.isoformat() for _, end_date in windows],
+        }
+        for stat in aggregation_stats:
+            time_series[str(stat)] = [response['features'][i]['properties'][stat] for response in window_responses]
+        feature['properties'] = {**(feature.get('properties') or {}), 'time_series': time_series}
     log.info(f'Finished for {time_range}')
 
-    return vector_response
+    return InstrumentedJSONResponse(content=to_feature_collection(features=features, include_geometry=include_geometry))
@@ -0,0 +1,23 @@
+import os
+
+from fastapi import APIRouter
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
+from starlette.responses import Response
+
+router = APIRouter(prefix='/metrics')
+
+
+@router.get(
+    '',
+    status_code=200,
+    summary='Prometheus metrics',
+    description='Expose processing stage latencies, cache usage, PU consumption and response sizes for Prometheus',
+    response_class=Response,
+)
+async def expose_metrics() -> Response:
+    registry = REGISTRY
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        # with several uvicorn workers every process writes its metrics to the shared directory
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,209 @@
+import asyncio
+import hmac
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import UTC, date, datetime, timedelta
+from functools import partial
+from pathlib import Path
+from typing import Annotated, Callable, Dict, List, Optional, Tuple, TypeVar
+
+import anyio
+import anyio.to_thread
+import yaml
+from fastapi import Header, HTTPException
+from starlette.requests import Request
+
+from naturalness import metrics
+from naturalness.deadline import DEADLINE
+from naturalness.exception import DeadlineExceededError
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# the client of all requests without a known API key
+ANONYMOUS = 'anonymous'
+
+
+@dataclass(frozen=True)
+class ClientPolicy:
+    name: str
+    api_key: Optional[str] = field(default=None, repr=False)
+    weight: float = 1.0
+    max_concurrency: int = 2
+    max_pus_per_day: Optional[float] = None
+
+
+def load_client_policies(path: Path) -> List[ClientPolicy]:
+    """
+    Read the API clients from a YAML file with a list of `clients`, each with its `name`, `api_key`, `weight`,
+    `max_concurrency` and optionally `max_pus_per_day`. A client named `anonymous` sets the policy of requests
+    without a known API key.
+    """
+    with open(path) as file:
+        return [ClientPolicy(**client) for client in yaml.safe_load(file)['clients']]
+
+
+@dataclass
+class ClientState:
+    policy: ClientPolicy
+    running: int = 0
+    # the virtual time at which the last queued job of the client finishes its share
+    finish_tag: float = 0.0
+    usage_date: date = field(default_factory=lambda: datetime.now(UTC).date())
+    usage: metrics.Usage = field(default_factory=metrics.Usage)
+
+
+class FairScheduler:
+    """
+    Weighted fair queuing of the jobs of the API clients, i.e. the retrieval and computation of a response or a time
+    series window. At most `max_concurrency` jobs run at a time and each client runs at most the `max_concurrency` of
+    its policy.
+
+    Waiting jobs are started in the order of their virtual start tags (start-time fair queuing): a client queues behind
+    its own jobs instead of everybody else's, and while several clients wait, each receives slots in proportion to its
+    weight. The PUs and CPU time of the jobs are accounted per client, PUs against its daily quota.
+    """
+
+    def __init__(self, clients: List[ClientPolicy], max_concurrency: int = 8):
+        self.max_concurrency = max_concurrency
+        self.clients = clients
+        self.default = next((client for client in clients if client.name == ANONYMOUS), ClientPolicy(name=ANONYMOUS))
+        self._states: Dict[str, ClientState] = {}
+        self._running = 0
+        self._virtual_time = 0.0
+        self._waiting: List[Tuple[float, int, str, asyncio.Future]] = []
+        self._sequence = itertools.count()
+
+    def identify(self, api_key: Optional[str]) -> ClientPolicy:
+        if api_key is not None:
+            for client in self.clients:
+                if client.api_key is not None and hmac.compare_digest(client.api_key.encode(), api_key.encode()):
+                    return client
+        return self.default
+
+    def state(self, client: ClientPolicy) -> ClientState:
+        if client.name not in self._states:
+            self._states[client.name] = ClientState(policy=client)
+        state = self._states[client.name]
+        today = datetime.now(UTC).date()
+        if state.usage_date != today:
+            state.usage_date, state.usage = today, metrics.Usage()
+        return state
+
+    def quota_reset(self, client: ClientPolicy) -> Optional[float]:
+        """The seconds until the daily PU quota of the client resets, `None` if it is not exhausted"""
+        if client.max_pus_per_day is None or self.state(client).usage.processing_units < client.max_pus_per_day:
+            return None
+        tomorrow = datetime.combine(datetime.now(UTC).date() + timedelta(days=1), datetime.min.time(), tzinfo=UTC)
+        return (tomorrow - datetime.now(UTC)).total_seconds()
+
+    async def acquire(self, client: ClientPolicy, timeout: Optional[float] = None) -> None:
+        """Wait for a slot of the client, raise `TimeoutError` if none is granted within the timeout"""
+        state = self.state(client)
+        start_tag = max(self._virtual_time, state.finish_tag)
+        state.finish_tag = start_tag + 1.0 / client.weight
+
+        granted = asyncio.get_running_loop().create_future()
+        job = (start_tag, next(self._sequence), client.name, granted)
+        self._waiting.append(job)
+        self._waiting.sort(key=lambda waiting: waiting[:2])
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), timeout=timeout)
+        except (TimeoutError, asyncio.CancelledError):
+            if granted.done():
+                # the slot was granted while the waiting job was abandoned
+                self.release(client)
+            else:
+                self._waiting.remove(job)
+                granted.cancel()
+            raise
+
+    def release(self, client: ClientPolicy) -> None:
+        self.state(client).running -= 1
+        self._running -= 1
+        self._dispatch()
+
+    def account(self, client: ClientPolicy, usage: metrics.Usage) -> None:
+        state = self.state(client)
+        state.usage.processing_units += usage.processing_units
+        state.usage.cpu_seconds += usage.cpu_seconds
+        metrics.CLIENT_PROCESSING_UNITS.labels(client=client.name).inc(usage.processing_units)
+        metrics.CLIENT_CPU_SECONDS.labels(client=client.name).inc(usage.cpu_seconds)
+
+    def _dispatch(self) -> None:
+        position = 0
+        while self._running < self.max_concurrency and position < len(self._waiting):
+            start_tag, _, name, granted = self._waiting[position]
+            state = self._states[name]
+            if state.running >= state.policy.max_concurrency:
+                # the jobs of other clients may overtake the jobs of a client at its limit
+                position += 1
+                continue
+            del self._waiting[position]
+            state.running += 1
+            self._running += 1
+            self._virtual_time = max(self._virtual_time, start_tag)
+            granted.set_result(None)
+
+
+async def identify_client(
+    request: Request,
+    x_api_key: Annotated[
+        Optional[str], Header(description='The key of the API client, requests without a known key share one quota')
+    ] = None,
+) -> None:
+    """Identify the client of the request by its API key and reject it with 429 if its daily PU quota is exhausted"""
+    scheduler: Optional[FairScheduler] = getattr(request.app.state, 'scheduler', None)
+    if scheduler is None:
+        return
+    client = scheduler.identify(x_api_key)
+    request.state.client = client
+
+    quota_reset = scheduler.quota_reset(client)
+    if quota_reset is not None:
+        log.warning(f'Rejecting a request of {client.name}, its daily PU quota is exhausted')
+        raise HTTPException(
+            status_code=429,
+            detail='The daily processing unit quota of the client is exhausted',
+            headers={'Retry-After': str(int(quota_reset) + 1)},
+        )
+
+
+def _measured(func: Callable[[], T], usage: metrics.Usage) -> T:
+    metrics.USAGE.set(usage)
+    started = time.thread_time()
+    try:
+        return func()
+    finally:
+        usage.cpu_seconds += time.thread_time() - started
+
+
+async def run_scheduled(request: Request, func: Callable[[], T], limiter: Optional[anyio.CapacityLimiter] = None) -> T:
+    """
+    Run the blocking retrieval and computation in a worker thread, once the `FairScheduler` in `app.state.scheduler`
+    granted the client of the request a slot. The function runs right away if no scheduler is set.
+    """
+    scheduler: Optional[FairScheduler] = getattr(request.app.state, 'scheduler', None)
+    if scheduler is None:
+        return await anyio.to_thread.run_sync(func, limiter=limiter)
+
+    client = getattr(request.state, 'client', scheduler.default)
+    deadline = DEADLINE.get()
+    timeout = None if deadline is None or deadline.expires_at is None else max(deadline.remaining(), 0.0)
+    started = time.monotonic()
+    try:
+        await scheduler.acquire(client, timeout=timeout)
+    except TimeoutError as e:
+        raise DeadlineExceededError(f'The request did not finish within {deadline.timeout} seconds') from e
+    metrics.SCHEDULER_WAIT.labels(client=client.name).observe(time.monotonic() - started)
+
+    usage = metrics.Usage()
+    try:
+        return await anyio.to_thread.run_sync(partial(_measured, func, usage), limiter=limiter)
+    finally:
+        scheduler.release(client)
+        scheduler.account(client, usage)
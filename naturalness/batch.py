@@ -0,0 +1,393 @@
+import copy
+import json
+import logging
+import math
+import os
+import time
+import uuid
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.warp import reproject, transform_bounds
+from sentinelhub import CRS, BBox, DownloadFailedException, SentinelHubRequest
+from sentinelhub.api.batch import BatchProcessClient, BatchRequestStatus
+from sentinelhub.time_utils import parse_time_interval
+
+from naturalness import metrics
+from naturalness.cache import CacheBackend
+from naturalness.deadline import DEADLINE, check_deadline
+from naturalness.exception import OperatorInteractionError
+from naturalness.imagery_store_operator import (
+    MAX_TILE_EDGE,
+    NO_DATA_VALUES,
+    ImageryStore,
+    Index,
+    ProcessingUnitStats,
+    RemoteSensingMosaic,
+    RemoteSensingResult,
+    RemoteSensingTile,
+    SentinelHubOperator,
+    decoded_dtype,
+)
+from naturalness.projection import WGS84
+from naturalness.tracing import tracer
+
+log = logging.getLogger(__name__)
+
+# the resolutions in meters offered by the tiling grids of SentinelHub Batch Processing
+TILING_GRID_RESOLUTIONS = {
+    0: (10, 20, 60),
+    1: (10, 20, 60),
+    2: (60, 120, 240, 360),
+}
+FINAL_STATUSES = (BatchRequestStatus.DONE, BatchRequestStatus.FAILED, BatchRequestStatus.STOPPED)
+# written to the local directory of a job once it was submitted and completed once its tiles were collected
+JOB_FILE = 'job.json'
+# an upper bound of the Sentinel-2 acquisitions of a location per day, the swaths of adjacent orbits overlap towards
+# the poles
+MAX_ACQUISITIONS_PER_DAY = 4
+
+
+@dataclass(frozen=True)
+class BatchJob:
+    """A finished batch job with its output tiles collected to a local directory"""
+
+    request_id: str
+    tile_files: Tuple[Path, ...]
+    processing_units: float
+
+
+class BatchImageryStore(ImageryStore):
+    """
+    Route requests of at least `min_pixels` pixels (or `min_pus` estimated PUs) to SentinelHub Batch Processing instead
+    of splitting them into process requests. A job is submitted for the complete area, polled until it is done and its
+    output tiles are collected from the bucket the job delivers to. All smaller requests are passed to the operator.
+
+    The output tiles are on the UTM tiling grid of SentinelHub at the grid resolution closest to the requested one and
+    are reprojected into the pixel grid of the request by nearest neighbour. Submitted jobs are recorded in the cache
+    directory of the operator, so a request that is repeated after its deadline passed resumes the running job instead
+    of paying for a new one.
+    """
+
+    def __init__(
+        self,
+        operator: SentinelHubOperator,
+        bucket: CacheBackend,
+        output_url: str,
+        min_pixels: Optional[int] = 25_000_000,
+        min_pus: Optional[float] = None,
+        tiling_grid: int = 1,
+        poll_interval: float = 10.0,
+        timeout: float = 3600.0,
+    ):
+        if tiling_grid not in TILING_GRID_RESOLUTIONS:
+            raise ValueError(f'Tiling grid {tiling_grid} is not supported')
+        self.operator = operator
+        self.bucket = bucket
+        # the bucket backend must point to the same location as the URL, each job delivers to a directory of its own
+        self.output_template = f'{output_url.rstrip("/")}/<requestId>/<tileName>-<outputId>.tif'
+        self.min_pixels = min_pixels
+        self.min_pus = min_pus
+        self.tiling_grid = tiling_grid
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    def imagery(
+        self,
+        index: Index,
+        bbox: Tuple[float, float, float, float],
+        start_date: str,
+        end_date: str,
+        resolution: int = 90,
+        crs: int = WGS84,
+    ) -> RemoteSensingResult:
+        width, height = SentinelHubOperator._dimensions(bbox=bbox, resolution=resolution, crs=crs)
+        SentinelHubOperator._validate_dimensions(width=width, height=height)
+        estimated_pus = self._batch_estimate(
+            index=index, bbox=bbox, start_date=start_date, end_date=end_date, width=width, height=height, crs=crs
+        )
+        if estimated_pus is None:
+            return self.operator.imagery(
+                index=index, bbox=bbox, start_date=start_date, end_date=end_date, resolution=resolution, crs=crs
+            )
+
+        job = self._job(
+            index=index,
+            bbox=bbox,
+            start_date=start_date,
+            end_date=end_date,
+            resolution=resolution,
+            size=(width, height),
+            crs=crs,
+        )
+        return BatchImageryStore._read(
+            job=job,
+            index=index,
+            bbox=bbox,
+            width=width,
+            height=height,
+            pus=ProcessingUnitStats(estimated=estimated_pus, consumed=0.0 if job is None else job.processing_units),
+            crs=crs,
+        )
+
+    def mosaic(
+        self,
+        index: Index,
+        bbox: Tuple[float, float, float, float],
+        start_date: str,
+        end_date: str,
+        resolution: int = 90,
+        crs: int = WGS84,
+    ) -> RemoteSensingMosaic:
+        width, height, windows = SentinelHubOperator._tile_windows(
+            bbox=bbox, resolution=resolution, tile_edge=MAX_TILE_EDGE, crs=crs
+        )
+        estimated_pus = self._batch_estimate(
+            index=index, bbox=bbox, start_date=start_date, end_date=end_date, width=width, height=height, crs=crs
+        )
+        if estimated_pus is None:
+            return self.operator.mosaic(
+                index=index, bbox=bbox, start_date=start_date, end_date=end_date, resolution=resolution, crs=crs
+            )
+
+        def tiles() -> Iterator[RemoteSensingTile]:
+            job = self._job(
+                index=index,
+                bbox=bbox,
+                start_date=start_date,
+                end_date=end_date,
+                resolution=resolution,
+                size=(width, height),
+                crs=crs,
+            )
+            # the job is reported with the first tile, the others are read from its output for free
+            pus = ProcessingUnitStats(estimated=estimated_pus, consumed=0.0 if job is None else job.processing_units)
+            for row_offset, column_offset, tile_height, tile_width, tile_bbox in windows:
+                result = BatchImageryStore._read(
+                    job=job, index=index, bbox=tile_bbox, width=tile_width, height=tile_height, pus=pus, crs=crs
+                )
+                yield RemoteSensingTile(row_offset=row_offset, column_offset=column_offset, result=result)
+                pus = ProcessingUnitStats(estimated=0.0, consumed=0.0)
+
+        return RemoteSensingMosaic(
+            height=height, width=width, bbox=bbox, tile_count=len(windows), tiles=tiles(), crs=crs
+        )
+
+    def grid_resolution(self, resolution: int) -> int:
+        """The coarsest resolution of the tiling grid that is at least as fine as the requested resolution"""
+        resolutions = TILING_GRID_RESOLUTIONS[self.tiling_grid]
+        return max(
+            (grid_resolution for grid_resolution in resolutions if grid_resolution <= resolution),
+            default=min(resolutions),
+        )
+
+    def _batch_estimate(
+        self,
+        index: Index,
+        bbox: Tuple[float, float, float, float],
+        start_date: str,
+        end_date: str,
+        width: int,
+        height: int,
+        crs: int = WGS84,
+    ) -> Optional[float]:
+        """
+        Whether the request is processed by a batch job.
+
+        :return: the PUs estimated for the request at the rates of process requests (`NaN` if they are not needed to
+            decide), `None` if it is passed to the operator
+        """
+        if self.min_pixels is not None and width * height >= self.min_pixels:
+            return math.nan
+        if self.min_pus is None:
+            return None
+
+        band_number, output_format = SentinelHubOperator._output_properties(index=index)
+        pus = partial(
+            SentinelHubOperator._calculate_pus,
+            width=width,
+            height=height,
+            band_number=band_number,
+            output_format=output_format,
+            local_collections={self.operator.config.sh_base_url},
+            remote_collections=set(),
+        )
+        # the PUs grow with the number of acquisitions, the catalog is only searched if the bounds of their number
+        # leave the decision open
+        start, end = parse_time_interval((start_date, end_date))
+        days = math.ceil((end - start).total_seconds() / (24 * 60 * 60))
+        if pus(n_samples=days * MAX_ACQUISITIONS_PER_DAY) < self.min_pus:
+            return None
+        if pus(n_samples=1) >= self.min_pus:
+            return math.nan
+
+        acquisitions = self.operator._available_timestamps(
+            index=index, bbox_obj=BBox(bbox=bbox, crs=CRS(crs)), time_interval=(start_date, end_date)
+        )
+        estimated_pus = pus(n_samples=len(acquisitions))
+        return estimated_pus if estimated_pus >= self.min_pus else None
+
+    @tracer.start_as_current_span('BatchImageryStore.job')
+    def _job(
+        self,
+        index: Index,
+        bbox: Tuple[float, float, float, float],
+        start_date: str,
+        end_date: str,
+        resolution: int,
+        size: Tuple[int, int],
+        crs: int = WGS84,
+    ) -> Optional[BatchJob]:
+        """Submit the job or resume the recorded one and collect its output, `None` if there are no acquisitions"""
+        check_deadline()
+        request, _, _ = self.operator._prepare_request(
+            index=index, bbox_obj=BBox(bbox=bbox, crs=CRS(crs)), time_interval=(start_date, end_date), size=size
+        )
+        if request is None:
+            log.info(f'No acquisitions available between {start_date} and {end_date}, skipping the batch job')
+            return None
+
+        # jobs share the key of the equal process request, the grid resolution is derived from its arguments
+        job_dir = self.operator.data_folder / 'batch' / SentinelHubOperator._entry_dir(request=request).name
+        job_file = job_dir / JOB_FILE
+        recording = json.loads(job_file.read_text()) if job_file.exists() else {}
+        if 'tiles' in recording:
+            log.info(f'Batch job {recording["request_id"]} retrieved from the cache')
+            return BatchJob(
+                request_id=recording['request_id'],
+                tile_files=tuple(job_dir / tile for tile in recording['tiles']),
+                processing_units=recording['processing_units'],
+            )
+
+        client = BatchProcessClient(config=self.operator._client_config())
+        try:
+            request_id = recording.get('request_id')
+            if request_id is None:
+                request_id = self._submit(client=client, request=request, index=index, resolution=resolution)
+                job_dir.mkdir(parents=True, exist_ok=True)
+                BatchImageryStore._record(job_file=job_file, recording={'request_id': request_id})
+            else:
+                log.info(f'Resuming batch job {request_id}')
+            processing_units = self._wait(client=client, request_id=request_id)
+        except DownloadFailedException:
+            check_deadline()
+            metrics.count_upstream_request(success=False)
+            log.exception('Interaction with SentinelHub Batch Processing failed')
+            raise OperatorInteractionError('SentinelHub operator interaction not possible.')
+        metrics.count_upstream_request(success=True)
+        if not math.isnan(processing_units):
+            metrics.count_processing_units(kind='consumed', index=index, value=processing_units)
+
+        tiles = self._collect(request_id=request_id, index=index, job_dir=job_dir)
+        BatchImageryStore._record(
+            job_file=job_file,
+            recording={'request_id': request_id, 'tiles': tiles, 'processing_units': processing_units},
+        )
+        return BatchJob(
+            request_id=request_id,
+            tile_files=tuple(job_dir / tile for tile in tiles),
+            processing_units=processing_units,
+        )
+
+    def _submit(self, client: BatchProcessClient, request: SentinelHubRequest, index: Index, resolution: int) -> str:
+        payload = copy.deepcopy(request.download_list[0].post_values)
+        # the size of the output is given by the tiling grid
+        for dimension in ('width', 'height'):
+            payload['output'].pop(dimension, None)
+
+        batch_request = client.create(
+            payload,
+            input=client.tiling_grid_input(grid_id=self.tiling_grid, resolution=self.grid_resolution(resolution)),
+            # the bucket policy grants SentinelHub access to the bucket, i.e. no credentials are passed
+            output=client.raster_output(delivery={'s3': {'url': self.output_template}}),
+            description=f'naturalness utility {index}',
+        )
+        client.start_job(batch_request)
+        log.info(f'Submitted batch job {batch_request.request_id}')
+        return batch_request.request_id
+
+    def _wait(self, client: BatchProcessClient, request_id: str) -> float:
+        """Poll the job until it is done and return the PUs it consumed"""
+        started = time.monotonic()
+        while True:
+            check_deadline()
+            # status requests are idempotent, unlike the creation of the job
+            batch_request = self.operator.retry_policy.call(
+                partial(client.get_request, request_id), operation='batch_status'
+            )
+            if batch_request.status in FINAL_STATUSES:
+                break
+            if time.monotonic() - started > self.timeout:
+                raise OperatorInteractionError(f'Batch job {request_id} did not finish within {self.timeout} seconds')
+            log.debug(f'Batch job {request_id} is {batch_request.status.value}')
+            deadline = DEADLINE.get()
+            time.sleep(
+                self.poll_interval if deadline is None else max(min(self.poll_interval, deadline.remaining()), 0.0)
+            )
+
+        if batch_request.status != BatchRequestStatus.DONE:
+            metrics.count_upstream_request(success=False)
+            log.error(f'Batch job {request_id} ended as {batch_request.status.value}: {batch_request.error}')
+            raise OperatorInteractionError('SentinelHub operator interaction not possible.')
+        return math.nan if batch_request.cost_PU is None else batch_request.cost_PU
+
+    def _collect(self, request_id: str, index: Index, job_dir: Path) -> List[str]:
+        """Fetch the output tiles of the index from the bucket into the job directory"""
+        tiles = [tile for tile in self.bucket.list_files(key=request_id) if tile.endswith(f'-{index}.tif')]
+        for tile in tiles:
+            tmp_file = job_dir / f'.{tile}.{uuid.uuid4().hex}'
+            try:
+                if not self.bucket.fetch(key=request_id, file_name=tile, target=tmp_file):
+                    raise OperatorInteractionError(f'Output tile {tile} of batch job {request_id} disappeared')
+                os.replace(tmp_file, job_dir / tile)
+            finally:
+                tmp_file.unlink(missing_ok=True)
+        log.info(f'Collected {len(tiles)} output tiles of batch job {request_id}')
+        return tiles
+
+    @staticmethod
+    def _record(job_file: Path, recording: dict) -> None:
+        tmp_file = job_file.with_name(f'.{JOB_FILE}.{uuid.uuid4().hex}')
+        tmp_file.write_text(json.dumps(recording))
+        os.replace(tmp_file, job_file)
+
+    @staticmethod
+    def _read(
+        job: Optional[BatchJob],
+        index: Index,
+        bbox: Tuple[float, float, float, float],
+        width: int,
+        height: int,
+        pus: ProcessingUnitStats,
+        crs: int = WGS84,
+    ) -> RemoteSensingResult:
+        """Reproject the output tiles of the job overlapping the area into its pixel grid"""
+        west, south, east, north = bbox
+        # the raw values are reprojected as floats, so that pixels without a tile stay NaN whatever the tile dtype
+        raw_data = np.full((height, width), np.nan)
+        for tile_file in () if job is None else job.tile_files:
+            with rasterio.open(tile_file) as src:
+                tile_west, tile_south, tile_east, tile_north = transform_bounds(src.crs, f'EPSG:{crs}', *src.bounds)
+                if tile_east <= west or east <= tile_west or tile_north <= south or north <= tile_south:
+                    continue
+                reproject(
+                    source=rasterio.band(src, 1),
+                    destination=raw_data,
+                    dst_transform=rasterio.transform.from_bounds(*bbox, width=width, height=height),
+                    dst_crs=f'EPSG:{crs}',
+                    src_nodata=src.nodata,
+                    dst_nodata=np.nan,
+                    # keep the pixels of the tiles reprojected before
+                    init_dest_nodata=False,
+                    resampling=Resampling.nearest,
+                )
+
+        index_data = np.full((height, width), NO_DATA_VALUES[index], dtype=decoded_dtype(index=index))
+        covered = ~np.isnan(raw_data)
+        index_data[covered] = SentinelHubOperator.decode(index=index, data=raw_data[covered])
+        return RemoteSensingResult(index_data=index_data, height=height, width=width, bbox=bbox, pus=pus, crs=crs)
@@ -0,0 +1,215 @@
+import logging
+import os
+import shutil
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from enum import StrEnum
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from naturalness import metrics
+
+log = logging.getLogger(__name__)
+
+# the files of a cache entry as written by the SentinelHub client, an entry is complete once its response exists
+REQUEST_FILE = 'request.json'
+RESPONSE_FILE = 'response.tiff'
+ENTRY_FILES = (REQUEST_FILE, RESPONSE_FILE)
+# the decoded raster is derived locally from the response and is not shared, its file is named by its dtype
+DECODED_FILE = 'decoded.{dtype}.npy'
+
+
+class CacheBackendType(StrEnum):
+    FILESYSTEM = 'filesystem'
+    S3 = 's3'
+
+
+class CacheBackend(ABC):
+    """
+    A store of cache entries shared between replicas. Entries are addressed by the hash of the request they were
+    downloaded for, i.e. equal requests of different replicas map to the same entry.
+    """
+
+    @abstractmethod
+    def fetch(self, key: str, file_name: str, target: Path) -> bool:
+        """Copy the file of the entry to the target path, return `False` if it does not exist"""
+        pass
+
+    @abstractmethod
+    def upload(self, key: str, file_name: str, source: Path) -> None:
+        pass
+
+    @abstractmethod
+    def list_files(self, key: str) -> List[str]:
+        """The names of the files of the entry, empty if it does not exist"""
+        pass
+
+
+class FileSystemCacheBackend(CacheBackend):
+    """A shared directory, e.g. a network file system mounted into each replica"""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def fetch(self, key: str, file_name: str, target: Path) -> bool:
+        try:
+            shutil.copyfile(self.root / key / file_name, target)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def upload(self, key: str, file_name: str, source: Path) -> None:
+        target = self.root / key / file_name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = target.with_name(f'.{file_name}.{uuid.uuid4().hex}')
+        shutil.copyfile(source, tmp_file)
+        os.replace(tmp_file, target)
+
+    def list_files(self, key: str) -> List[str]:
+        entry_dir = self.root / key
+        if not entry_dir.is_dir():
+            return []
+        return sorted(file.name for file in entry_dir.iterdir() if file.is_file() and not file.name.startswith('.'))
+
+
+class S3CacheBackend(CacheBackend):
+    """
+    A bucket of an S3 compatible object store. Credentials are read by boto3 from the standard `AWS_*` environment
+    variables, the endpoint URL allows using other providers than AWS (e.g. MinIO).
+    """
+
+    def __init__(self, bucket: str, prefix: str = '', endpoint_url: Optional[str] = None):
+        try:
+            import boto3
+        except ImportError as e:
+            raise ImportError(
+                'The S3 cache backend requires the optional dependencies, install them via `poetry install -E s3`'
+            ) from e
+
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+
+    def _object_key(self, key: str, file_name: str) -> str:
+        return '/'.join(part for part in (self.prefix, key, file_name) if part)
+
+    def fetch(self, key: str, file_name: str, target: Path) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.download_file(self.bucket, self._object_key(key, file_name), str(target))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
+        return True
+
+    def upload(self, key: str, file_name: str, source: Path) -> None:
+        self.client.upload_file(str(source), self.bucket, self._object_key(key, file_name))
+
+    def list_files(self, key: str) -> List[str]:
+        prefix = f'{self._object_key(key, "")}/'
+        file_names = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix):
+            file_names.extend(item['Key'].removeprefix(prefix) for item in page.get('Contents', []))
+        return sorted(file_name for file_name in file_names if '/' not in file_name)
+
+
+class ReadThroughCache:
+    """
+    The local cache directory in front of an optional shared backend.
+
+    Entries missing locally are fetched from the shared backend and new entries are uploaded to it, so each scene is
+    only downloaded (and paid for) once across all replicas. If the size of the local directory is bounded, the least
+    recently used entries are evicted from it; they remain available in the shared backend.
+    """
+
+    def __init__(self, local_dir: Path, shared: Optional[CacheBackend] = None, max_bytes: Optional[int] = None):
+        self.local_dir = local_dir
+        self.shared = shared
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def contains(self, entry_dir: Path) -> bool:
+        response_file = entry_dir / RESPONSE_FILE
+        if response_file.exists():
+            # the modification time marks the last use for the eviction
+            response_file.touch()
+            return True
+        if self.shared is None:
+            return False
+
+        tmp_files = {file_name: entry_dir.parent / f'.{file_name}.{uuid.uuid4().hex}' for file_name in ENTRY_FILES}
+        try:
+            # the response is fetched first as it tells whether the entry exists
+            for file_name in reversed(ENTRY_FILES):
+                if not self.shared.fetch(key=entry_dir.name, file_name=file_name, target=tmp_files[file_name]):
+                    return False
+            entry_dir.mkdir(parents=True, exist_ok=True)
+            for file_name in ENTRY_FILES:
+                os.replace(tmp_files[file_name], entry_dir / file_name)
+        finally:
+            for tmp_file in tmp_files.values():
+                tmp_file.unlink(missing_ok=True)
+        log.debug(f'Fetched cache entry {entry_dir.name} from the shared cache')
+        return True
+
+    def store(self, entry_dir: Path) -> None:
+        """Share a new entry and enforce the size limit of the local directory"""
+        if self.shared is not None:
+            # the response is uploaded last as it marks the entry as complete
+            for file_name in ENTRY_FILES:
+                self.shared.upload(key=entry_dir.name, file_name=file_name, source=entry_dir / file_name)
+        if self.max_bytes is not None:
+            self._evict(keep=entry_dir)
+
+    def load_decoded(self, entry_dir: Path, dtype: np.dtype) -> Optional[np.ndarray]:
+        """
+        Memory-map the decoded raster of the entry read-only. Hits only read from the page cache, which is shared by all
+        workers reading the same entry, instead of decoding the response into a new array. Rasters decoded into another
+        dtype, e.g. by a previous version, are not served.
+        """
+        decoded_file = entry_dir / DECODED_FILE.format(dtype=np.dtype(dtype).name)
+        try:
+            return np.load(decoded_file, mmap_mode='r')
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            log.warning(f'Discarding the unreadable decoded raster of cache entry {entry_dir.name}')
+            decoded_file.unlink(missing_ok=True)
+            return None
+
+    def store_decoded(self, entry_dir: Path, index_data: np.ndarray) -> None:
+        """Store the decoded raster of the entry and enforce the size limit of the local directory including it"""
+        decoded_file = entry_dir / DECODED_FILE.format(dtype=index_data.dtype.name)
+        tmp_file = entry_dir / f'.{decoded_file.name}.{uuid.uuid4().hex}'
+        with open(tmp_file, mode='wb') as file:
+            np.save(file, np.ascontiguousarray(index_data), allow_pickle=False)
+        os.replace(tmp_file, decoded_file)
+        if self.max_bytes is not None:
+            self._evict(keep=entry_dir)
+
+    def _evict(self, keep: Path) -> None:
+        with self._lock:
+            entries: List[Tuple[float, int, Path]] = []
+            for response_file in self.local_dir.glob(f'*/{RESPONSE_FILE}'):
+                try:
+                    size = sum(file.stat().st_size for file in response_file.parent.iterdir())
+                    entries.append((response_file.stat().st_mtime, size, response_file.parent))
+                except FileNotFoundError:
+                    continue
+
+            total_bytes = sum(size for _, size, _ in entries)
+            for _, size, entry_dir in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                if entry_dir == keep:
+                    continue
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total_bytes -= size
+                metrics.CACHE_EVICTIONS.labels(cache='imagery').inc()
+                log.debug(f'Evicted cache entry {entry_dir.name}')
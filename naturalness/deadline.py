@@ -0,0 +1,45 @@
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from naturalness.exception import DeadlineExceededError, RequestCancelledError
+
+
+class Deadline:
+    """
+    The time budget of a request and whether it was cancelled. The processing checks it between its steps, so blocking
+    calls such as downloads are completed (and cached) but no further work is started for a request nobody waits for.
+    """
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.timeout = timeout
+        self.expires_at = None if timeout is None else time.monotonic() + timeout
+        self._cancelled = threading.Event()
+
+    def remaining(self) -> float:
+        return float('inf') if self.expires_at is None else self.expires_at - time.monotonic()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check(self) -> None:
+        if self.cancelled:
+            raise RequestCancelledError('The request was cancelled')
+        if self.remaining() <= 0.0:
+            raise DeadlineExceededError(f'The request did not finish within {self.timeout} seconds')
+
+
+# set per request by the API, threads started via anyio inherit it
+DEADLINE: ContextVar[Optional[Deadline]] = ContextVar('deadline', default=None)
+
+
+def check_deadline() -> None:
+    """Raise if the deadline of the current request passed or the request was cancelled"""
+    deadline = DEADLINE.get()
+    if deadline is not None:
+        deadline.check()
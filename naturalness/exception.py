@@ -12,3 +12,19 @@ class OperatorInteractionError(Exception):
     """
 
     pass
+
+
+class DeadlineExceededError(Exception):
+    """
+    The deadline of the request passed before its processing finished
+    """
+
+    pass
+
+
+class RequestCancelledError(Exception):
+    """
+    The request was cancelled, e.g. because the client disconnected
+    """
+
+    pass
@@ -1,13 +1,17 @@
+import hashlib
+import json
 import logging
 import math
-import os
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+from datetime import datetime, timedelta
 from enum import Enum, StrEnum
+from functools import partial
 from pathlib import Path
-from typing import Set, Tuple
+from typing import Iterator, List, Optional, Set, Tuple
 
 import numpy as np
+from opentelemetry import trace
 from sentinelhub import (
     CRS,
     BBox,
@@ -16,22 +20,50 @@ from sentinelhub import (
     MimeType,
     ResamplingType,
     SentinelHubRequest,
-    ServiceUrl,
     SHConfig,
     bbox_to_dimensions,
 )
 from sentinelhub.api.catalog import get_available_timestamps
 from sentinelhub.download.models import DownloadResponse
+from sentinelhub.time_utils import parse_time_interval
 
+from naturalness import metrics
+from naturalness.cache import REQUEST_FILE, CacheBackend, ReadThroughCache
+from naturalness.deadline import DEADLINE, check_deadline
 from naturalness.exception import OperatorInteractionError, OperatorValidationError
+from naturalness.projection import WGS84, is_supported
+from naturalness.pu_calibration import PuCalibration
+from naturalness.retry import FailFastDownloadClient, Hedger, RetryPolicy
+from naturalness.tracing import tracer
 
 log = logging.getLogger(__name__)
 
+CATALOG_SETTLING_PERIOD = timedelta(days=7)
+# the maximum edge length of a single SentinelHub process request
+MAX_TILE_EDGE = 2500
+# the maximum edge length of a mosaic of several requests
+MAX_MOSAIC_EDGE = 25000
+
 
 @dataclass
 class ProcessingUnitStats:
     estimated: float
     consumed: float
+    correction_factor: float = 1.0
+
+
+@dataclass
+class MosaicEstimate:
+    """The PUs the tiles of a mosaic would consume and the number of tiles that need no download"""
+
+    pus: ProcessingUnitStats
+    tile_count: int
+    cached: int
+    without_acquisitions: int
+
+    @property
+    def downloads(self) -> int:
+        return self.tile_count - self.cached - self.without_acquisitions
 
 
 @dataclass
@@ -41,6 +73,41 @@ class RemoteSensingResult:
     width: int
     bbox: Tuple[float, float, float, float]
     pus: ProcessingUnitStats
+    # the EPSG code of the CRS of the bbox and the pixel grid
+    crs: int = WGS84
+
+
+@dataclass
+class RemoteSensingTile:
+    row_offset: int
+    column_offset: int
+    result: RemoteSensingResult
+
+
+@dataclass
+class RemoteSensingMosaic:
+    """
+    A raster assembled from tiles that are only retrieved while iterating over `tiles`, so consumers can process one
+    tile at a time instead of holding the complete raster in memory.
+    """
+
+    height: int
+    width: int
+    bbox: Tuple[float, float, float, float]
+    tile_count: int
+    tiles: Iterator[RemoteSensingTile]
+    crs: int = WGS84
+
+    @classmethod
+    def from_result(cls, result: RemoteSensingResult) -> 'RemoteSensingMosaic':
+        return cls(
+            height=result.height,
+            width=result.width,
+            bbox=result.bbox,
+            tile_count=1,
+            tiles=iter([RemoteSensingTile(row_offset=0, column_offset=0, result=result)]),
+            crs=result.crs,
+        )
 
 
 class OutputFormat(Enum):
@@ -56,6 +123,28 @@ class Index(StrEnum):
     NATURALNESS = 'NATURALNESS'
 
 
+NO_DATA_VALUES = {
+    Index.NDVI: -999,
+    Index.WATER: 255,
+    Index.NATURALNESS: -999,
+}
+# the number of classes of indices whose values are integer classes rather than continuous measurements
+CATEGORICAL_INDICES = {Index.WATER: 2}
+# the range of valid values of the continuous indices
+VALUE_RANGES = {
+    Index.NDVI: (-1.0, 1.0),
+    Index.NATURALNESS: (0.0, 1.0),
+}
+
+
+def decoded_dtype(index: Index) -> np.dtype:
+    """
+    The dtype of the decoded index values, categorical indices keep their integer classes. Continuous values are decoded
+    from 16 bit integers, i.e. single precision holds them exactly enough.
+    """
+    return np.dtype(np.uint8) if index in CATEGORICAL_INDICES else np.dtype(np.float32)
+
+
 class ImageryStore(ABC):
     @abstractmethod
     def imagery(
@@ -65,9 +154,27 @@ class ImageryStore(ABC):
         start_date: str,
         end_date: str,
         resolution: int = 90,
+        crs: int = WGS84,
     ) -> RemoteSensingResult:
+        """Retrieve the index of the bbox, given in the CRS of the EPSG code `crs`"""
         pass
 
+    def mosaic(
+        self,
+        index: Index,
+        bbox: Tuple[float, float, float, float],
+        start_date: str,
+        end_date: str,
+        resolution: int = 90,
+        crs: int = WGS84,
+    ) -> RemoteSensingMosaic:
+        """Retrieve the imagery tile by tile, stores that cannot split requests return a single tile"""
+        return RemoteSensingMosaic.from_result(
+            self.imagery(
+                index=index, bbox=bbox, start_date=start_date, end_date=end_date, resolution=resolution, crs=crs
+            )
+        )
+
 
 class SentinelHubOperator(ImageryStore):
     def __init__(
@@ -76,12 +183,40 @@ class SentinelHubOperator(ImageryStore):
         api_secret: str,
         script_path: Path,
         cache_dir: Path,
+        pu_calibration: Optional[PuCalibration] = None,
+        base_url: Optional[str] = None,
+        cache_backend: Optional[CacheBackend] = None,
+        local_cache_max_bytes: Optional[int] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        hedger: Optional[Hedger] = None,
     ):
-        self.config = SHConfig(**{'sh_client_id': api_id, 'sh_client_secret': api_secret})
+        # the client fails on the first error, retries are up to the retry policy
+        config = {
+            'sh_client_id': api_id,
+            'sh_client_secret': api_secret,
+            'max_download_attempts': 1,
+            'max_retries': 1,
+        }
+        self.data_collection = DataCollection.SENTINEL2_L2A
+        if base_url is not None:
+            # e.g. a local stand-in of the APIs, the collection definition pins the URL of process and catalog requests
+            base_url = base_url.rstrip('/')
+            config |= {
+                'sh_base_url': base_url,
+                'sh_token_url': f'{base_url}/auth/realms/main/protocol/openid-connect/token',
+            }
+            self.data_collection = DataCollection.SENTINEL2_L2A.define_from(
+                f'SENTINEL2_L2A_{hashlib.md5(base_url.encode()).hexdigest()[:8]}', service_url=base_url
+            )
+        self.config = SHConfig(**config)
         self.evalscripts = {index: (script_path / f'{index}.js').read_text() for index in Index}
+        self.pu_calibration = pu_calibration
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.hedger = hedger
 
         self.data_folder = cache_dir
         self.data_folder.mkdir(parents=True, exist_ok=True)
+        self.cache = ReadThroughCache(local_dir=cache_dir, shared=cache_backend, max_bytes=local_cache_max_bytes)
 
     def imagery(
         self,
@@ -90,57 +225,206 @@ class SentinelHubOperator(ImageryStore):
         start_date: str,
         end_date: str,
         resolution: int = 90,
+        crs: int = WGS84,
     ) -> RemoteSensingResult:
-        bbox_obj = BBox(bbox=bbox, crs=CRS.WGS84)
-        bbox_width, bbox_height = bbox_to_dimensions(bbox_obj, resolution=resolution)
+        bbox_width, bbox_height = SentinelHubOperator._dimensions(bbox=bbox, resolution=resolution, crs=crs)
+        SentinelHubOperator._validate_dimensions(width=bbox_width, height=bbox_height)
+        return self._imagery(
+            index=index,
+            bbox=bbox,
+            start_date=start_date,
+            end_date=end_date,
+            resolution=resolution,
+            bbox_width=bbox_width,
+            bbox_height=bbox_height,
+            crs=crs,
+        )
 
-        if min(bbox_width, bbox_height) <= 0 or max(bbox_width, bbox_height) > 2500:
+    def mosaic(
+        self,
+        index: Index,
+        bbox: Tuple[float, float, float, float],
+        start_date: str,
+        end_date: str,
+        resolution: int = 90,
+        crs: int = WGS84,
+        tile_edge: int = MAX_TILE_EDGE,
+    ) -> RemoteSensingMosaic:
+        """
+        Split areas exceeding the size limit of a single request into tiles of at most `tile_edge` pixels. The tiles
+        share the pixel grid of the complete area and are downloaded one after another while iterating.
+        """
+        width, height, windows = SentinelHubOperator._tile_windows(
+            bbox=bbox, resolution=resolution, tile_edge=tile_edge, crs=crs
+        )
+
+        def tiles() -> Iterator[RemoteSensingTile]:
+            for row_offset, column_offset, tile_height, tile_width, tile_bbox in windows:
+                result = self._imagery(
+                    index=index,
+                    bbox=tile_bbox,
+                    start_date=start_date,
+                    end_date=end_date,
+                    resolution=resolution,
+                    bbox_width=tile_width,
+                    bbox_height=tile_height,
+                    crs=crs,
+                )
+                yield RemoteSensingTile(row_offset=row_offset, column_offset=column_offset, result=result)
+
+        return RemoteSensingMosaic(
+            height=height, width=width, bbox=bbox, tile_count=len(windows), tiles=tiles(), crs=crs
+        )
+
+    @staticmethod
+    def _tile_windows(
+        bbox: Tuple[float, float, float, float], resolution: int, tile_edge: int, crs: int = WGS84
+    ) -> Tuple[int, int, List[Tuple[int, int, int, int, Tuple[float, float, float, float]]]]:
+        """
+        Split the area into tiles on the pixel grid of the complete area.
+
+        :return: the width and height of the area and the row and column offset, height, width and bbox of each tile
+        """
+        width, height = SentinelHubOperator._dimensions(bbox=bbox, resolution=resolution, crs=crs)
+        if min(width, height) <= 0 or max(width, height) > MAX_MOSAIC_EDGE:
             raise OperatorValidationError(
-                f'Edge dimensions of requested area must be between (0, 2500). You requested {bbox_width, bbox_height}'
+                f'Edge dimensions of requested area must be between (0, {MAX_MOSAIC_EDGE}). You requested '
+                f'{width, height}'
             )
+        west, south, east, north = bbox
+
+        def x(column: int) -> float:
+            # the outer edges are kept exact, so a single tile has the same cache entry as the equal `imagery` call
+            return east if column == width else west + column * (east - west) / width
+
+        def y(row: int) -> float:
+            return south if row == height else north - row * (north - south) / height
+
+        windows = []
+        for row_offset in range(0, height, tile_edge):
+            for column_offset in range(0, width, tile_edge):
+                tile_height, tile_width = min(tile_edge, height - row_offset), min(tile_edge, width - column_offset)
+                tile_bbox = (
+                    x(column_offset),
+                    y(row_offset + tile_height),
+                    x(column_offset + tile_width),
+                    y(row_offset),
+                )
+                windows.append((row_offset, column_offset, tile_height, tile_width, tile_bbox))
+        return width, height, windows
+
+    @tracer.start_as_current_span('SentinelHubOperator.imagery')
+    def _imagery(
+        self,
+        index: Index,
+        bbox: Tuple[float, float, float, float],
+        start_date: str,
+        end_date: str,
+        resolution: int,
+        bbox_width: int,
+        bbox_height: int,
+        crs: int = WGS84,
+    ) -> RemoteSensingResult:
+        check_deadline()
+        span = trace.get_current_span()
+        bbox_obj = BBox(bbox=bbox, crs=CRS(crs))
+        span.set_attributes(
+            {
+                'naturalness.index': index,
+                'naturalness.width': bbox_width,
+                'naturalness.height': bbox_height,
+                'naturalness.area_m2': bbox_width * bbox_height * resolution**2,
+            }
+        )
 
-        request = SentinelHubRequest(
-            data_folder=str(self.data_folder),
-            evalscript=self.evalscripts[index],
-            input_data=[
-                SentinelHubRequest.input_data(
-                    data_collection=DataCollection.SENTINEL2_L2A,
-                    identifier='s2',
-                    time_interval=(start_date, end_date),
-                    downsampling=ResamplingType.BICUBIC,
-                ),
-            ],
-            responses=[
-                SentinelHubRequest.output_response(index, MimeType.TIFF),
-            ],
-            bbox=bbox_obj,
-            size=(bbox_width, bbox_height),
-            config=self.config,
+        request, n_samples, cached = self._prepare_request(
+            index=index, bbox_obj=bbox_obj, time_interval=(start_date, end_date), size=(bbox_width, bbox_height)
         )
-        pu_stats = self.estimate_pus(index=index, request=request)
+        if request is None:
+            log.info(f'No acquisitions available between {start_date} and {end_date}, skipping the download')
+            return RemoteSensingResult(
+                index_data=np.full(
+                    (bbox_height, bbox_width),
+                    NO_DATA_VALUES[index],
+                    dtype=decoded_dtype(index=index),
+                ),
+                height=bbox_height,
+                width=bbox_width,
+                bbox=bbox,
+                pus=ProcessingUnitStats(estimated=0.0, consumed=0.0),
+                crs=crs,
+            )
+
+        metrics.count_cache_request(hit=cached, index=index)
+        span.set_attribute('naturalness.cache_hit', cached)
+
+        pu_stats = self.estimate_pus(index=index, request=request, n_samples=n_samples, cached=cached)
+        entry_dir = SentinelHubOperator._entry_dir(request=request)
+        if cached:
+            with metrics.observe_stage('decode', index=index):
+                index_data = self.cache.load_decoded(entry_dir=entry_dir, dtype=decoded_dtype(index=index))
+            if index_data is not None:
+                pu_stats.consumed = SentinelHubOperator._get_cached_pus(entry_dir=entry_dir)
+                log.info('RS data retrieved from the decoded cache')
+                return RemoteSensingResult(
+                    index_data=index_data,
+                    height=bbox_height,
+                    width=bbox_width,
+                    bbox=bbox,
+                    pus=pu_stats,
+                    crs=crs,
+                )
+
+        check_deadline()
+        request.config = self._client_config()
         try:
-            data = request.get_data(save_data=True, decode_data=False)[0]
+            with metrics.observe_stage('download', index=index), tracer.start_as_current_span('sentinelhub.process'):
+                data = self._download(request=request, cached=cached)
         except DownloadFailedException:
+            # a download aborted by the deadline of the request is no failure of SentinelHub
+            check_deadline()
+            if not cached:
+                metrics.count_upstream_request(success=False)
             log.exception('Download of remote sensing scenes failed')
             raise OperatorInteractionError('SentinelHub operator interaction not possible.')
 
         pu_stats.consumed = self._get_actual_pus(data=data)
+        if not cached:
+            metrics.count_upstream_request(success=True)
+            try:
+                self.cache.store(entry_dir=entry_dir)
+            except Exception:
+                log.exception('Storing the downloaded scenes in the cache failed')
+        # the download is cached by now, only the remaining work is dropped if nobody waits for the result anymore
+        check_deadline()
+        span.set_attributes(
+            {'naturalness.pus.estimated': pu_stats.estimated, 'naturalness.pus.consumed': pu_stats.consumed}
+        )
+        if not cached:
+            metrics.count_processing_units(kind='estimated', index=index, value=pu_stats.estimated)
+            metrics.count_processing_units(kind='consumed', index=index, value=pu_stats.consumed)
 
         if pu_stats.consumed > 0.0 and not math.isclose(pu_stats.estimated, pu_stats.consumed):
             log.warning(
                 f'The pu estimation was inaccurate. The request required {pu_stats.estimated} PUs but the estimation was '
                 f'{pu_stats.consumed} PUs.'
             )
+        if self.pu_calibration is not None:
+            _, output_format = SentinelHubOperator._output_properties(index=index)
+            self.pu_calibration.record(
+                key=PuCalibration.key(
+                    index=index, output_format=output_format.name, width=bbox_width, height=bbox_height
+                ),
+                estimated=pu_stats.estimated / pu_stats.correction_factor,
+                consumed=pu_stats.consumed,
+            )
 
-        data_cleaned = data.decode()
-        match index:
-            case 'NDVI':
-                divisor = 2**16 / 2 - 1
-            case 'NATURALNESS':
-                divisor = 2**16 - 1
-            case _:
-                divisor = 1
-        data_cleaned = data_cleaned / divisor
+        with metrics.observe_stage('decode', index=index):
+            data_cleaned = SentinelHubOperator.decode(index=index, data=data.decode())
+        try:
+            self.cache.store_decoded(entry_dir=entry_dir, index_data=data_cleaned)
+        except OSError:
+            log.exception('Storing the decoded raster in the cache failed')
 
         log.info('RS data retrieved')
         return RemoteSensingResult(
@@ -149,48 +433,254 @@ class SentinelHubOperator(ImageryStore):
             width=bbox_width,
             bbox=bbox,
             pus=pu_stats,
+            crs=crs,
+        )
+
+    def estimate(
+        self,
+        index: Index,
+        bbox: Tuple[float, float, float, float],
+        start_date: str,
+        end_date: str,
+        resolution: int = 90,
+        crs: int = WGS84,
+    ) -> ProcessingUnitStats:
+        """Estimate the PUs that `imagery` would consume for the same arguments without downloading anything"""
+        bbox_obj = BBox(bbox=bbox, crs=CRS(crs))
+        bbox_width, bbox_height = SentinelHubOperator._dimensions(bbox=bbox, resolution=resolution, crs=crs)
+        SentinelHubOperator._validate_dimensions(width=bbox_width, height=bbox_height)
+
+        request, n_samples, cached = self._prepare_request(
+            index=index, bbox_obj=bbox_obj, time_interval=(start_date, end_date), size=(bbox_width, bbox_height)
+        )
+        if request is None:
+            return ProcessingUnitStats(estimated=0.0, consumed=math.nan)
+        return self.estimate_pus(index=index, request=request, n_samples=n_samples, cached=cached)
+
+    def estimate_mosaic(
+        self,
+        index: Index,
+        bbox: Tuple[float, float, float, float],
+        start_date: str,
+        end_date: str,
+        resolution: int = 90,
+        crs: int = WGS84,
+        tile_edge: int = MAX_TILE_EDGE,
+    ) -> MosaicEstimate:
+        """Estimate the PUs that `mosaic` would consume for the same arguments without downloading anything"""
+        _, _, windows = SentinelHubOperator._tile_windows(
+            bbox=bbox, resolution=resolution, tile_edge=tile_edge, crs=crs
+        )
+        estimated, cached_tiles, tiles_without_acquisitions = 0.0, 0, 0
+        for _, _, tile_height, tile_width, tile_bbox in windows:
+            request, n_samples, cached = self._prepare_request(
+                index=index,
+                bbox_obj=BBox(bbox=tile_bbox, crs=CRS(crs)),
+                time_interval=(start_date, end_date),
+                size=(tile_width, tile_height),
+            )
+            if request is None:
+                tiles_without_acquisitions += 1
+            elif cached:
+                cached_tiles += 1
+            else:
+                estimated += self.estimate_pus(
+                    index=index, request=request, n_samples=n_samples, cached=cached
+                ).estimated
+        return MosaicEstimate(
+            pus=ProcessingUnitStats(estimated=estimated, consumed=math.nan),
+            tile_count=len(windows),
+            cached=cached_tiles,
+            without_acquisitions=tiles_without_acquisitions,
+        )
+
+    @staticmethod
+    def _dimensions(bbox: Tuple[float, float, float, float], resolution: int, crs: int = WGS84) -> Tuple[int, int]:
+        """
+        The pixel dimensions of the area at the resolution in metres. WGS 84 areas are dimensioned by their extent in
+        their UTM zone, the extent of areas in a UTM zone is already given in metres.
+        """
+        if not is_supported(crs):
+            raise OperatorValidationError(f'EPSG:{crs} is not supported, request WGS 84 (4326) or a UTM zone')
+        if crs == WGS84:
+            return bbox_to_dimensions(BBox(bbox=bbox, crs=CRS.WGS84), resolution=resolution)
+        west, south, east, north = bbox
+        return round((east - west) / resolution), round((north - south) / resolution)
+
+    @staticmethod
+    def _validate_dimensions(width: int, height: int) -> None:
+        if min(width, height) <= 0 or max(width, height) > MAX_TILE_EDGE:
+            raise OperatorValidationError(
+                f'Edge dimensions of requested area must be between (0, {MAX_TILE_EDGE}). You requested {width, height}'
+            )
+
+    def _prepare_request(
+        self,
+        index: Index,
+        bbox_obj: BBox,
+        time_interval: Tuple[str, str],
+        size: Tuple[int, int],
+    ) -> Tuple[Optional[SentinelHubRequest], Optional[int], bool]:
+        """
+        Build the request for the time interval, trimmed to the available acquisitions unless it is already cached.
+        The cache is probed once per request, callers pass the result on instead of probing (a remote backend) again.
+
+        :return: the request (`None` if there are no acquisitions), the number of acquisitions if they were queried and
+            whether the request is cached
+        """
+        request = self._build_request(index=index, bbox_obj=bbox_obj, time_interval=time_interval, size=size)
+        if self._is_cached(request=request):
+            return request, None, True
+
+        acquisitions = self._available_timestamps(index=index, bbox_obj=bbox_obj, time_interval=time_interval)
+        if len(acquisitions) == 0:
+            return None, 0, False
+
+        # equivalent requests collapse to the same cache entry if the time range is trimmed to the acquisitions
+        request = self._build_request(
+            index=index,
+            bbox_obj=bbox_obj,
+            time_interval=(min(acquisitions).date().isoformat(), max(acquisitions).date().isoformat()),
+            size=size,
+        )
+        return request, len(acquisitions), self._is_cached(request=request)
+
+    def _build_request(
+        self,
+        index: Index,
+        bbox_obj: BBox,
+        time_interval: Tuple[str, str],
+        size: Tuple[int, int],
+    ) -> SentinelHubRequest:
+        return SentinelHubRequest(
+            data_folder=str(self.data_folder),
+            evalscript=self.evalscripts[index],
+            input_data=[
+                SentinelHubRequest.input_data(
+                    data_collection=self.data_collection,
+                    identifier='s2',
+                    time_interval=time_interval,
+                    downsampling=ResamplingType.BICUBIC,
+                ),
+            ],
+            responses=[
+                SentinelHubRequest.output_response(index, MimeType.TIFF),
+            ],
+            bbox=bbox_obj,
+            size=size,
+            config=self.config,
         )
 
-    def estimate_pus(self, index: Index, request: SentinelHubRequest) -> ProcessingUnitStats:
+    def _download(self, request: SentinelHubRequest, cached: bool) -> DownloadResponse:
+        if cached:
+            # the response was cached without its decoded raster, it is read instead of downloaded
+            return request.get_data(save_data=True, decode_data=False)[0]
+
+        def download() -> DownloadResponse:
+            return request.get_data(save_data=False, decode_data=False)[0]
+
+        request.download_client_class = FailFastDownloadClient
+        data = self.retry_policy.call(
+            download if self.hedger is None else partial(self.hedger.call, download), operation='process'
+        )
+        # only the response that won is written to the cache, a hedged request must not write the same files
+        data.to_local()
+        return data
+
+    def _client_config(self) -> SHConfig:
+        """The client configuration, with the timeout of the SentinelHub calls bounded by the deadline of the request"""
+        deadline = DEADLINE.get()
+        if deadline is None or deadline.expires_at is None:
+            return self.config
+        config = self.config.copy()
+        config.download_timeout_seconds = max(min(config.download_timeout_seconds, deadline.remaining()), 0.001)
+        return config
+
+    def _is_cached(self, request: SentinelHubRequest) -> bool:
+        return self.cache.contains(entry_dir=SentinelHubOperator._entry_dir(request=request))
+
+    @staticmethod
+    def _entry_dir(request: SentinelHubRequest) -> Path:
         _, response_path = request.download_list[0].get_storage_paths()
-        if os.path.exists(response_path):
+        return Path(response_path).parent
+
+    def _available_timestamps(self, index: Index, bbox_obj: BBox, time_interval: Tuple[str, str]) -> List[datetime]:
+        """
+        Query the catalog for the acquisitions within the time interval. Time intervals that ended more than
+        `CATALOG_SETTLING_PERIOD` ago will not receive new acquisitions, so their results are cached on disk.
+        """
+        start, end = parse_time_interval(time_interval)
+        catalog_key = hashlib.md5(
+            f'{tuple(bbox_obj)}/{bbox_obj.crs.epsg}/{start.isoformat()}/{end.isoformat()}'.encode()
+        ).hexdigest()
+        catalog_file = self.data_folder / 'catalog' / f'{catalog_key}.json'
+        if catalog_file.exists():
+            return [datetime.fromisoformat(timestamp) for timestamp in json.loads(catalog_file.read_text())]
+
+        with metrics.observe_stage('catalog', index=index), tracer.start_as_current_span('sentinelhub.catalog'):
+            timestamps = self.retry_policy.call(
+                partial(
+                    get_available_timestamps,
+                    config=self._client_config(),
+                    bbox=bbox_obj,
+                    time_interval=(start, end),
+                    data_collection=self.data_collection,
+                ),
+                operation='catalog',
+            )
+
+        if end.replace(tzinfo=None) + CATALOG_SETTLING_PERIOD < datetime.now():
+            catalog_file.parent.mkdir(parents=True, exist_ok=True)
+            catalog_file.write_text(json.dumps([timestamp.isoformat() for timestamp in timestamps]))
+        return timestamps
+
+    @tracer.start_as_current_span('SentinelHubOperator.estimate_pus')
+    def estimate_pus(
+        self,
+        index: Index,
+        request: SentinelHubRequest,
+        n_samples: Optional[int] = None,
+        cached: Optional[bool] = None,
+    ) -> ProcessingUnitStats:
+        if self._is_cached(request=request) if cached is None else cached:
             log.debug('Expecting a cached result with no PU consumption.')
             return ProcessingUnitStats(estimated=0.0, consumed=math.nan)
 
-        match index:
-            case Index.NDVI:
-                band_number = 3
-                output_format = OutputFormat.BIT_16
-            case Index.WATER:
-                band_number = 1
-                output_format = OutputFormat.BIT_8
-            case Index.NATURALNESS:
-                band_number = 3
-                output_format = OutputFormat.BIT_16
-            case _:
-                raise ValueError(f'Index {index} is not supported for PU estimation')
+        band_number, output_format = SentinelHubOperator._output_properties(index=index)
 
         request_input = request.payload.get('input')
         request_output = request.payload.get('output')
 
         service_urls = set(service.service_url for service in request_input.get('data'))
-        local_collections = set(filter(lambda url: url == ServiceUrl.MAIN, service_urls))
+        local_collections = set(filter(lambda url: url == self.config.sh_base_url, service_urls))
         remote_collections = service_urls.difference(local_collections)
 
         bbox_height = request_output.get('height')
         bbox_width = request_output.get('width')
 
-        n_samples = len(
-            get_available_timestamps(
-                config=self.config,
-                bbox=BBox(bbox=request_input.get('bounds').get('bbox'), crs=CRS.WGS84),
-                time_interval=(
-                    request_input.get('data')[0].get('dataFilter').get('timeRange').get('from'),
-                    request_input.get('data')[0].get('dataFilter').get('timeRange').get('to'),
-                ),
-                data_collection=DataCollection.SENTINEL2_L2A,
-            )
-        )
+        if n_samples is None:
+            with metrics.observe_stage('catalog', index=index), tracer.start_as_current_span('sentinelhub.catalog'):
+                n_samples = len(
+                    self.retry_policy.call(
+                        partial(
+                            get_available_timestamps,
+                            config=self._client_config(),
+                            bbox=BBox(
+                                bbox=request_input.get('bounds').get('bbox'),
+                                # the CRS is given by its URL, e.g. http://www.opengis.net/def/crs/EPSG/0/4326
+                                crs=CRS(
+                                    int(request_input.get('bounds').get('properties').get('crs').rsplit('/', 1)[-1])
+                                ),
+                            ),
+                            time_interval=(
+                                request_input.get('data')[0].get('dataFilter').get('timeRange').get('from'),
+                                request_input.get('data')[0].get('dataFilter').get('timeRange').get('to'),
+                            ),
+                            data_collection=self.data_collection,
+                        ),
+                        operation='catalog',
+                    )
+                )
         estimated_pus = SentinelHubOperator._calculate_pus(
             width=bbox_width,
             height=bbox_height,
@@ -201,8 +691,28 @@ class SentinelHubOperator(ImageryStore):
             n_samples=n_samples,
         )
 
-        log.info(f'Estimated PU consumed by request are {estimated_pus}')
-        return ProcessingUnitStats(estimated=estimated_pus, consumed=math.nan)
+        correction_factor = 1.0
+        if self.pu_calibration is not None:
+            correction_factor = self.pu_calibration.factor(
+                PuCalibration.key(index=index, output_format=output_format.name, width=bbox_width, height=bbox_height)
+            )
+
+        log.info(f'Estimated PU consumed by request are {estimated_pus * correction_factor}')
+        return ProcessingUnitStats(
+            estimated=estimated_pus * correction_factor, consumed=math.nan, correction_factor=correction_factor
+        )
+
+    @staticmethod
+    def _output_properties(index: Index) -> Tuple[int, OutputFormat]:
+        match index:
+            case Index.NDVI:
+                return 3, OutputFormat.BIT_16
+            case Index.WATER:
+                return 1, OutputFormat.BIT_8
+            case Index.NATURALNESS:
+                return 3, OutputFormat.BIT_16
+            case _:
+                raise ValueError(f'Index {index} is not supported for PU estimation')
 
     @staticmethod
     def _calculate_pus(
@@ -248,6 +758,27 @@ class SentinelHubOperator(ImageryStore):
         )
         return max(computed_pu, 0.005)
 
+    @staticmethod
+    def decode(index: Index, data: np.ndarray) -> np.ndarray:
+        """Revert the integer encoding of the evalscript output"""
+        match index:
+            case 'NDVI':
+                return np.divide(data, 2**16 / 2 - 1, dtype=decoded_dtype(index=index))
+            case 'NATURALNESS':
+                return np.divide(data, 2**16 - 1, dtype=decoded_dtype(index=index))
+            case _:
+                # categorical indices keep their integer classes
+                return data.astype(decoded_dtype(index=index), copy=False)
+
+    @staticmethod
+    def _get_cached_pus(entry_dir: Path) -> float:
+        """The PUs the cached response consumed when it was downloaded"""
+        try:
+            recording = json.loads((entry_dir / REQUEST_FILE).read_text())
+            return float(recording['response']['headers']['x-processingunits-spent'])
+        except (OSError, KeyError, ValueError):
+            return math.nan
+
     @staticmethod
     def _get_actual_pus(data: DownloadResponse) -> float:
         actual_pus = float(data.headers['x-processingunits-spent'])
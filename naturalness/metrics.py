@@ -0,0 +1,157 @@
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Deque, Iterator, Optional, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# set per request by the API so that metrics recorded deep down in the operator can be attributed to the route
+ROUTE: ContextVar[str] = ContextVar('route', default='')
+INDEX: ContextVar[str] = ContextVar('index', default='')
+
+
+@dataclass
+class Usage:
+    """The resources consumed on behalf of an API client"""
+
+    processing_units: float = 0.0
+    cpu_seconds: float = 0.0
+
+
+# set per scheduled job by the API so that the PUs consumed deep down in the operator are accounted to its client
+USAGE: ContextVar[Optional[Usage]] = ContextVar('usage', default=None)
+
+STAGE_DURATION = Histogram(
+    'naturalness_stage_duration_seconds',
+    'Duration of the individual processing stages of a request',
+    ['stage', 'index', 'route'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0),
+)
+CACHE_REQUESTS = Counter(
+    'naturalness_cache_requests_total',
+    'Imagery cache lookups by result (hit or miss)',
+    ['result', 'index', 'route'],
+)
+CACHE_EVICTIONS = Counter(
+    'naturalness_cache_evictions_total',
+    'Entries evicted from the size-bounded local imagery cache',
+    ['cache'],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'naturalness_requests_in_flight',
+    'Requests currently being processed',
+    ['index', 'route'],
+    multiprocess_mode='livesum',
+)
+PROCESSING_UNITS = Counter(
+    'naturalness_processing_units_total',
+    'Estimated and consumed SentinelHub processing units',
+    ['kind', 'index', 'route'],
+)
+RESPONSE_SIZE = Histogram(
+    'naturalness_response_size_bytes',
+    'Size of the response bodies',
+    ['index', 'route'],
+    buckets=tuple(4**exponent for exponent in range(4, 16)),
+)
+REQUESTS_SHED = Counter(
+    'naturalness_requests_shed_total',
+    'Requests rejected with 503 because the route was saturated',
+    ['route', 'reason'],
+)
+RESPONSE_CACHE_REQUESTS = Counter(
+    'naturalness_response_cache_requests_total',
+    'Response cache lookups of deterministic requests by result (hit, miss or not_modified)',
+    ['result', 'route'],
+)
+UPSTREAM_REQUESTS = Counter(
+    'naturalness_upstream_requests_total',
+    'SentinelHub downloads by result (success or failure)',
+    ['result'],
+)
+UPSTREAM_RETRIES = Counter(
+    'naturalness_upstream_retries_total',
+    'Retried SentinelHub calls by operation and the reason of the failed attempt (status code or connection)',
+    ['operation', 'reason'],
+)
+HEDGED_REQUESTS = Counter(
+    'naturalness_hedged_requests_total',
+    'SentinelHub downloads duplicated after the latency threshold by the request that won (primary, hedge or none)',
+    ['winner'],
+)
+CLIENT_PROCESSING_UNITS = Counter(
+    'naturalness_client_processing_units_total',
+    'Consumed SentinelHub processing units by API client',
+    ['client'],
+)
+CLIENT_CPU_SECONDS = Counter(
+    'naturalness_client_cpu_seconds_total',
+    'CPU time of the retrieval and computation of responses by API client',
+    ['client'],
+)
+SCHEDULER_WAIT = Histogram(
+    'naturalness_scheduler_wait_seconds',
+    'Time the jobs of an API client waited for a slot of the fair scheduler',
+    ['client'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0),
+)
+
+
+class ErrorRate:
+    """The share of failed requests within a sliding time window, e.g. to report the health of an upstream service"""
+
+    def __init__(self, window_seconds: float = 300.0, min_requests: int = 10):
+        self.window_seconds = window_seconds
+        self.min_requests = min_requests
+        self._outcomes: Deque[Tuple[float, bool]] = deque()
+        self._lock = threading.Lock()
+
+    def record(self, failed: bool) -> None:
+        with self._lock:
+            self._outcomes.append((time.monotonic(), failed))
+            self._expire()
+
+    def value(self) -> Optional[float]:
+        """The error rate, `None` if too few requests were recorded within the window to tell"""
+        with self._lock:
+            self._expire()
+            if len(self._outcomes) < self.min_requests:
+                return None
+            return sum(failed for _, failed in self._outcomes) / len(self._outcomes)
+
+    def _expire(self) -> None:
+        horizon = time.monotonic() - self.window_seconds
+        while self._outcomes and self._outcomes[0][0] < horizon:
+            self._outcomes.popleft()
+
+
+UPSTREAM_ERROR_RATE = ErrorRate()
+
+
+@contextmanager
+def observe_stage(stage: str, index: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_DURATION.labels(stage=stage, index=index, route=ROUTE.get()).observe(time.perf_counter() - start)
+
+
+def count_cache_request(hit: bool, index: str) -> None:
+    CACHE_REQUESTS.labels(result='hit' if hit else 'miss', index=index, route=ROUTE.get()).inc()
+
+
+def count_processing_units(kind: str, index: str, value: float) -> None:
+    PROCESSING_UNITS.labels(kind=kind, index=index, route=ROUTE.get()).inc(value)
+    usage = USAGE.get()
+    if kind == 'consumed' and usage is not None and not math.isnan(value):
+        usage.processing_units += value
+
+
+def count_upstream_request(success: bool) -> None:
+    UPSTREAM_REQUESTS.labels(result='success' if success else 'failure').inc()
+    UPSTREAM_ERROR_RATE.record(failed=not success)
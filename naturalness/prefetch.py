@@ -0,0 +1,211 @@
+import asyncio
+import fcntl
+import json
+import logging
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import UTC, datetime, time, timedelta
+from functools import partial
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+import anyio.to_thread
+import shapely
+from shapely.geometry import shape
+
+from naturalness.exception import OperatorInteractionError, OperatorValidationError
+from naturalness.imagery_store_operator import Index, SentinelHubOperator
+from naturalness.projection import project_bbox, utm_crs
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class PrefetchTarget:
+    index: Index
+    bbox: Tuple[float, float, float, float]
+    start_date: str
+    end_date: str
+    resolution: int = 90
+    # the EPSG code of the CRS to retrieve the bbox (given in WGS 84) in, by default its UTM zone like the endpoints
+    crs: Optional[int] = None
+
+
+@dataclass
+class PrefetchReport:
+    downloaded: int = 0
+    cached: int = 0
+    without_acquisitions: int = 0
+    over_budget: int = 0
+    failed: int = 0
+    consumed_pus: float = 0.0
+
+
+class PuBudget:
+    """Reserve the estimated PUs of a download before it starts and settle the reservation with the consumed PUs"""
+
+    def __init__(self, limit: float = math.inf):
+        self.limit = limit
+        self.used = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, pus: float) -> bool:
+        with self._lock:
+            if self.used + pus > self.limit:
+                return False
+            self.used += pus
+            return True
+
+    def settle(self, reserved: float, consumed: float) -> None:
+        with self._lock:
+            self.used += (0.0 if math.isnan(consumed) else consumed) - reserved
+
+
+def load_targets(
+    targets_file: Path,
+    start_date: str,
+    end_date: str,
+    indices: Iterable[Index] = tuple(Index),
+    resolution: int = 90,
+) -> List[PrefetchTarget]:
+    """
+    Read the areas to prefetch from a GeoJSON file. The bounds of each feature are prefetched for all `indices` and the
+    given time range, unless the feature properties override them via `indices`, `start_date`, `end_date`,
+    `resolution` or `crs`.
+    """
+    feature_collection = json.loads(targets_file.read_text())
+    targets = []
+    for feature in feature_collection['features']:
+        properties = feature.get('properties') or {}
+        bbox = shapely.bounds(shape(feature['geometry'])).tolist()
+        for index in properties.get('indices', indices):
+            targets.append(
+                PrefetchTarget(
+                    index=Index(index),
+                    bbox=tuple(bbox),
+                    start_date=properties.get('start_date', start_date),
+                    end_date=properties.get('end_date', end_date),
+                    resolution=properties.get('resolution', resolution),
+                    crs=properties.get('crs'),
+                )
+            )
+    return targets
+
+
+def prefetch(
+    imagery_store: SentinelHubOperator,
+    targets: List[PrefetchTarget],
+    max_workers: int = 2,
+    pu_budget: Optional[float] = None,
+) -> PrefetchReport:
+    """
+    Download the imagery of the targets into the cache of the imagery store. Targets are retrieved as mosaics like the
+    requests of the endpoints, i.e. areas exceeding the size limit of a single request are prefetched tile by tile.
+
+    :param imagery_store: the operator to fill the cache of
+    :param targets: the requests to prefetch, in order of priority
+    :param max_workers: the number of concurrent downloads
+    :param pu_budget: targets are skipped once their estimated PUs would exceed the budget, unlimited if `None`
+    :return: the number of targets per outcome and the consumed PUs
+    """
+    budget = PuBudget(limit=math.inf if pu_budget is None else pu_budget)
+    report = PrefetchReport()
+    report_lock = threading.Lock()
+
+    def fetch(target: PrefetchTarget) -> None:
+        # the area is retrieved on the same pixel grid as the requests of the endpoints, to share their cache entries
+        crs = utm_crs(target.bbox) if target.crs is None else target.crs
+        bbox = project_bbox(bbox=target.bbox, crs=crs, resolution=target.resolution)
+        try:
+            estimate = imagery_store.estimate_mosaic(
+                index=target.index,
+                bbox=bbox,
+                start_date=target.start_date,
+                end_date=target.end_date,
+                resolution=target.resolution,
+                crs=crs,
+            )
+            if estimate.downloads == 0:
+                outcome = 'cached' if estimate.cached > 0 else 'without_acquisitions'
+            elif not budget.reserve(estimate.pus.estimated):
+                log.info(f'Skipping {target}, its estimated {estimate.pus.estimated} PUs exceed the remaining budget')
+                outcome = 'over_budget'
+            else:
+                consumed = 0.0
+                try:
+                    mosaic = imagery_store.mosaic(
+                        index=target.index,
+                        bbox=bbox,
+                        start_date=target.start_date,
+                        end_date=target.end_date,
+                        resolution=target.resolution,
+                        crs=crs,
+                    )
+                    for tile in mosaic.tiles:
+                        # cached tiles report the PUs of their original download and an estimate of 0
+                        if tile.result.pus.estimated > 0.0 and not math.isnan(tile.result.pus.consumed):
+                            consumed += tile.result.pus.consumed
+                finally:
+                    budget.settle(reserved=estimate.pus.estimated, consumed=consumed)
+                    with report_lock:
+                        report.consumed_pus += consumed
+                outcome = 'downloaded'
+        except (OperatorInteractionError, OperatorValidationError):
+            log.exception(f'Prefetching {target} failed')
+            outcome = 'failed'
+
+        with report_lock:
+            setattr(report, outcome, getattr(report, outcome) + 1)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prefetch') as executor:
+        list(executor.map(fetch, targets))
+
+    log.info(f'Prefetching finished: {report}')
+    return report
+
+
+async def prefetch_daily(
+    imagery_store: SentinelHubOperator,
+    targets_file: Path,
+    at: time,
+    lock_file: Path,
+    start_date: str,
+    end_date: str,
+    max_workers: int = 2,
+    pu_budget: Optional[float] = None,
+) -> None:
+    """
+    Prefetch the targets of the file every day at the given time (UTC), e.g. during off-peak hours. The file is read
+    anew for every run. If several workers share the cache, the lock file ensures that only one of them prefetches.
+    """
+    while True:
+        now = datetime.now(UTC)
+        next_run = datetime.combine(now.date(), at, tzinfo=UTC)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+
+        with open(lock_file, mode='a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                log.info('Prefetching is already running in another worker')
+                continue
+
+            try:
+                targets = load_targets(targets_file=targets_file, start_date=start_date, end_date=end_date)
+                await anyio.to_thread.run_sync(
+                    partial(
+                        prefetch,
+                        imagery_store=imagery_store,
+                        targets=targets,
+                        max_workers=max_workers,
+                        pu_budget=pu_budget,
+                    )
+                )
+            except Exception:
+                log.exception('Scheduled prefetching failed')
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
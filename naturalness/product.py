@@ -0,0 +1,271 @@
+import logging
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+
+from naturalness.imagery_store_operator import (
+    CATEGORICAL_INDICES,
+    MAX_TILE_EDGE,
+    NO_DATA_VALUES,
+    ImageryStore,
+    Index,
+    ProcessingUnitStats,
+    RemoteSensingMosaic,
+    RemoteSensingResult,
+    RemoteSensingTile,
+    SentinelHubOperator,
+    decoded_dtype,
+)
+from naturalness.projection import WGS84
+from naturalness.tracing import tracer
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Product:
+    """A precomputed index of a region, stored as cloud optimized GeoTIFF"""
+
+    path: Path
+    index: Index
+    start_date: str
+    end_date: str
+    resolution: int
+    bbox: Tuple[float, float, float, float]
+
+    def covers(self, bbox: Tuple[float, float, float, float]) -> bool:
+        west, south, east, north = bbox
+        return self.bbox[0] <= west and self.bbox[1] <= south and east <= self.bbox[2] and north <= self.bbox[3]
+
+
+def build_product(
+    imagery_store: ImageryStore,
+    output_dir: Path,
+    name: str,
+    index: Index,
+    bbox: Tuple[float, float, float, float],
+    start_date: str,
+    end_date: str,
+    resolution: int,
+) -> Path:
+    """
+    Compute the index of a region into a tiled cloud optimized GeoTIFF with overviews. The imagery is retrieved tile by
+    tile, so regions of any size can be built. Continuous indices are stored as 32 bit floats.
+
+    :return: the path of the product
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    target = output_dir / f'{name}_{index}_{start_date}_{end_date}_{resolution}m.tif'
+    tmp_file = output_dir / f'.{target.stem}.{uuid.uuid4().hex}.tif'
+
+    mosaic = imagery_store.mosaic(
+        index=index, bbox=bbox, start_date=start_date, end_date=end_date, resolution=resolution
+    )
+    categorical = index in CATEGORICAL_INDICES
+    try:
+        with rasterio.open(
+            tmp_file,
+            mode='w',
+            driver='GTiff',
+            height=mosaic.height,
+            width=mosaic.width,
+            count=1,
+            dtype=decoded_dtype(index=index),
+            crs='EPSG:4326',
+            nodata=NO_DATA_VALUES[index],
+            transform=rasterio.transform.from_bounds(*bbox, width=mosaic.width, height=mosaic.height),
+            tiled=True,
+            blockxsize=512,
+            blockysize=512,
+            BIGTIFF='IF_SAFER',
+        ) as dst:
+            for tile in mosaic.tiles:
+                dst.write(
+                    tile.result.index_data.astype(dst.dtypes[0], copy=False),
+                    1,
+                    window=Window(
+                        col_off=tile.column_offset,
+                        row_off=tile.row_offset,
+                        width=tile.result.width,
+                        height=tile.result.height,
+                    ),
+                )
+                log.debug(f'Wrote tile at {tile.row_offset, tile.column_offset} of {target.name}')
+            dst.update_tags(index=index, start_date=start_date, end_date=end_date, resolution=resolution)
+
+        rasterio.shutil.copy(
+            tmp_file,
+            target,
+            driver='COG',
+            COMPRESS='DEFLATE',
+            PREDICTOR='YES',
+            BLOCKSIZE=512,
+            OVERVIEW_RESAMPLING='MODE' if categorical else 'AVERAGE',
+            BIGTIFF='IF_SAFER',
+        )
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+    log.info(f'Built product {target}')
+    return target
+
+
+class ProductImageryStore(ImageryStore):
+    """
+    Answer requests from precomputed products by windowed reads, if a product of the index, time range and resolution
+    covers the requested area. All other requests are passed to the fallback store, e.g. the `SentinelHubOperator`.
+
+    Requests at a coarser resolution than the product are read from its overviews. Values are resampled by nearest
+    neighbour, i.e. the pixel grid of the request may be shifted by up to half a pixel against a live request. Requests
+    in a UTM zone are reprojected from the WGS 84 products on the fly.
+    """
+
+    def __init__(self, product_dir: Path, fallback: ImageryStore):
+        self.fallback = fallback
+        self.products = ProductImageryStore._load_products(product_dir=product_dir)
+        log.info(f'Serving {len(self.products)} precomputed products from {product_dir}')
+
+    @staticmethod
+    def _load_products(product_dir: Path) -> List[Product]:
+        products = []
+        for path in sorted(product_dir.glob('*.tif')):
+            with rasterio.open(path) as src:
+                tags = src.tags()
+                try:
+                    products.append(
+                        Product(
+                            path=path,
+                            index=Index(tags['index']),
+                            start_date=tags['start_date'],
+                            end_date=tags['end_date'],
+                            resolution=int(tags['resolution']),
+                            bbox=tuple(src.bounds),
+                        )
+                    )
+                except (KeyError, ValueError):
+                    log.warning(f'Ignoring {path}, it is not a product')
+        return products
+
+    def find(
+        self,
+        index: Index,
+        bbox: Tuple[float, float, float, float],
+        start_date: str,
+        end_date: str,
+        resolution: int,
+        crs: int = WGS84,
+    ) -> Optional[Product]:
+        """The product with the finest resolution that can answer the request, if any"""
+        if crs != WGS84:
+            bbox = transform_bounds(f'EPSG:{crs}', 'EPSG:4326', *bbox, densify_pts=21)
+        candidates = [
+            product
+            for product in self.products
+            if product.index == index
+            and product.start_date == start_date
+            and product.end_date == end_date
+            and product.resolution <= resolution
+            and product.covers(bbox)
+        ]
+        return max(candidates, key=lambda product: product.resolution, default=None)
+
+    @tracer.start_as_current_span('ProductImageryStore.imagery')
+    def imagery(
+        self,
+        index: Index,
+        bbox: Tuple[float, float, float, float],
+        start_date: str,
+        end_date: str,
+        resolution: int = 90,
+        crs: int = WGS84,
+    ) -> RemoteSensingResult:
+        product = self.find(
+            index=index, bbox=bbox, start_date=start_date, end_date=end_date, resolution=resolution, crs=crs
+        )
+        if product is None:
+            return self.fallback.imagery(
+                index=index, bbox=bbox, start_date=start_date, end_date=end_date, resolution=resolution, crs=crs
+            )
+
+        width, height = SentinelHubOperator._dimensions(bbox=bbox, resolution=resolution, crs=crs)
+        SentinelHubOperator._validate_dimensions(width=width, height=height)
+        return ProductImageryStore._read(product=product, index=index, bbox=bbox, width=width, height=height, crs=crs)
+
+    def mosaic(
+        self,
+        index: Index,
+        bbox: Tuple[float, float, float, float],
+        start_date: str,
+        end_date: str,
+        resolution: int = 90,
+        crs: int = WGS84,
+    ) -> RemoteSensingMosaic:
+        product = self.find(
+            index=index, bbox=bbox, start_date=start_date, end_date=end_date, resolution=resolution, crs=crs
+        )
+        if product is None:
+            return self.fallback.mosaic(
+                index=index, bbox=bbox, start_date=start_date, end_date=end_date, resolution=resolution, crs=crs
+            )
+
+        width, height, windows = SentinelHubOperator._tile_windows(
+            bbox=bbox, resolution=resolution, tile_edge=MAX_TILE_EDGE, crs=crs
+        )
+
+        def tiles() -> Iterator[RemoteSensingTile]:
+            for row_offset, column_offset, tile_height, tile_width, tile_bbox in windows:
+                result = ProductImageryStore._read(
+                    product=product, index=index, bbox=tile_bbox, width=tile_width, height=tile_height, crs=crs
+                )
+                yield RemoteSensingTile(row_offset=row_offset, column_offset=column_offset, result=result)
+
+        return RemoteSensingMosaic(
+            height=height, width=width, bbox=bbox, tile_count=len(windows), tiles=tiles(), crs=crs
+        )
+
+    @staticmethod
+    def _read(
+        product: Product,
+        index: Index,
+        bbox: Tuple[float, float, float, float],
+        width: int,
+        height: int,
+        crs: int = WGS84,
+    ) -> RemoteSensingResult:
+        with rasterio.open(product.path) as src:
+            if crs == WGS84:
+                index_data = src.read(
+                    1,
+                    window=from_bounds(*bbox, transform=src.transform),
+                    out_shape=(height, width),
+                    resampling=Resampling.nearest,
+                )
+            else:
+                # the product is warped into the pixel grid of the request directly
+                with WarpedVRT(
+                    src,
+                    crs=f'EPSG:{crs}',
+                    transform=rasterio.transform.from_bounds(*bbox, width=width, height=height),
+                    width=width,
+                    height=height,
+                    nodata=NO_DATA_VALUES[index],
+                    resampling=Resampling.nearest,
+                ) as vrt:
+                    index_data = vrt.read(1)
+        log.debug(f'Read {width}x{height} pixels from product {product.path.name}')
+        return RemoteSensingResult(
+            index_data=index_data.astype(decoded_dtype(index=index), copy=False),
+            height=height,
+            width=width,
+            bbox=bbox,
+            pus=ProcessingUnitStats(estimated=0.0, consumed=0.0),
+            crs=crs,
+        )
@@ -0,0 +1,49 @@
+import math
+from typing import List, Tuple
+
+import shapely
+from rasterio.warp import transform_bounds, transform_geom
+from sentinelhub.geo_utils import get_utm_crs
+from shapely.geometry import mapping, shape
+
+# the EPSG code of WGS 84, the CRS of the bboxes and geometries of the requests
+WGS84 = 4326
+
+
+def is_supported(crs: int) -> bool:
+    """Whether the imagery can be retrieved in the CRS, i.e. WGS 84 or a UTM zone (north 326xx, south 327xx)"""
+    return crs == WGS84 or 32601 <= crs <= 32660 or 32701 <= crs <= 32760
+
+
+def utm_crs(bbox: Tuple[float, float, float, float]) -> int:
+    """The EPSG code of the UTM zone of the centre of the WGS 84 bbox"""
+    west, south, east, north = bbox
+    return get_utm_crs((west + east) / 2, (south + north) / 2).epsg
+
+
+def project_bbox(
+    bbox: Tuple[float, float, float, float], crs: int, resolution: int
+) -> Tuple[float, float, float, float]:
+    """
+    The bounds of the WGS 84 bbox in the CRS. Projected bounds are extended to multiples of the resolution, so that the
+    pixels are exactly `resolution` metres wide and the grids of overlapping requests align (and share cache entries).
+    """
+    if crs == WGS84:
+        return bbox
+    west, south, east, north = transform_bounds('EPSG:4326', f'EPSG:{crs}', *bbox, densify_pts=21)
+    return (
+        math.floor(west / resolution) * resolution,
+        math.floor(south / resolution) * resolution,
+        math.ceil(east / resolution) * resolution,
+        math.ceil(north / resolution) * resolution,
+    )
+
+
+def project_geometries(geometries: List[shapely.Geometry], crs: int) -> List[shapely.Geometry]:
+    """Transform the WGS 84 geometries into the CRS"""
+    if crs == WGS84 or len(geometries) == 0:
+        return geometries
+    return [
+        shape(geometry)
+        for geometry in transform_geom('EPSG:4326', f'EPSG:{crs}', [mapping(geometry) for geometry in geometries])
+    ]
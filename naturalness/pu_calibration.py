@@ -0,0 +1,137 @@
+import fcntl
+import json
+import logging
+import math
+import os
+import threading
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class CalibrationEntry:
+    observations: int = 0
+    estimated: float = 0.0
+    consumed: float = 0.0
+
+    @property
+    def factor(self) -> float:
+        return self.consumed / self.estimated
+
+
+class PuCalibration:
+    """
+    Learn correction factors for the PU estimation from the actually consumed PUs.
+
+    Every pair of estimated and consumed PUs is appended to an observation log. The observations are aggregated per
+    calibration key (index, output format and size bucket) into a calibration table that is persisted next to the log.
+    The table is reloaded whenever the file changes, so it can be refitted or edited without restarting the service.
+    Updates of the table are serialised across processes with a file lock, so several workers can share the directory.
+    """
+
+    def __init__(self, calibration_dir: Path, min_observations: int = 5):
+        self.observation_file = calibration_dir / 'observations.jsonl'
+        self.table_file = calibration_dir / 'calibration.json'
+        self.lock_file = calibration_dir / 'calibration.lock'
+        self.min_observations = min_observations
+
+        calibration_dir.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._table: Dict[str, CalibrationEntry] = {}
+        self._table_mtime: Optional[int] = None
+
+        if not self.table_file.exists() and self.observation_file.exists():
+            self.fit()
+        self.reload()
+
+    @staticmethod
+    def key(index: str, output_format: str, width: int, height: int) -> str:
+        """
+        The size bucket is the order of magnitude of the pixel count to the base of 4, i.e. bucket `b` contains all
+        requests with `4**b <= width * height < 4**(b + 1)` pixels.
+        """
+        size_bucket = int(math.log2(max(width * height, 1)) // 2)
+        return f'{index}/{output_format}/{size_bucket}'
+
+    def factor(self, key: str) -> float:
+        with self._lock:
+            self._reload_if_changed()
+            entry = self._table.get(key)
+            if entry is None or entry.observations < self.min_observations or entry.estimated <= 0.0:
+                return 1.0
+            return entry.factor
+
+    def record(self, key: str, estimated: float, consumed: float) -> None:
+        if not (math.isfinite(estimated) and math.isfinite(consumed)) or estimated <= 0.0 or consumed <= 0.0:
+            log.debug(f'Skipping PU calibration observation for {key} ({estimated=}, {consumed=})')
+            return
+
+        with self._exclusive():
+            # another process may have updated the table since it was last read
+            self.reload()
+            with open(self.observation_file, mode='a') as observation_log:
+                observation_log.write(json.dumps({'key': key, 'estimated': estimated, 'consumed': consumed}) + '\n')
+
+            entry = self._table.setdefault(key, CalibrationEntry())
+            entry.observations += 1
+            entry.estimated += estimated
+            entry.consumed += consumed
+            self._write_table()
+
+    def fit(self) -> None:
+        """Rebuild the calibration table from the complete observation log."""
+        with self._exclusive():
+            table: Dict[str, CalibrationEntry] = {}
+            with open(self.observation_file) as observation_log:
+                for line in observation_log:
+                    if not line.strip():
+                        continue
+                    observation = json.loads(line)
+                    entry = table.setdefault(observation['key'], CalibrationEntry())
+                    entry.observations += 1
+                    entry.estimated += observation['estimated']
+                    entry.consumed += observation['consumed']
+
+            self._table = table
+            self._write_table()
+        log.info(f'PU calibration table fitted for {len(table)} keys')
+
+    def reload(self) -> None:
+        with self._lock:
+            if not self.table_file.exists():
+                self._table = {}
+                self._table_mtime = None
+                return
+
+            table = json.loads(self.table_file.read_text())
+            self._table = {key: CalibrationEntry(**entry) for key, entry in table.items()}
+            self._table_mtime = self.table_file.stat().st_mtime_ns
+            log.debug(f'PU calibration table loaded for {len(self._table)} keys')
+
+    def _reload_if_changed(self) -> None:
+        try:
+            mtime = self.table_file.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._table_mtime:
+            self.reload()
+
+    @contextmanager
+    def _exclusive(self) -> Iterator[None]:
+        with self._lock, open(self.lock_file, mode='a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write_table(self) -> None:
+        tmp_file = self.table_file.with_suffix(f'.{os.getpid()}.tmp')
+        tmp_file.write_text(json.dumps({key: asdict(entry) for key, entry in self._table.items()}, indent=2))
+        os.replace(tmp_file, self.table_file)
+        self._table_mtime = self.table_file.stat().st_mtime_ns
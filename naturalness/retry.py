@@ -0,0 +1,178 @@
+import contextvars
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from datetime import UTC, datetime
+from email.utils import parsedate_to_datetime
+from typing import Callable, Deque, Dict, Optional, Tuple, TypeVar
+
+import numpy as np
+import requests
+from sentinelhub import DownloadFailedException
+from sentinelhub.download import SentinelHubDownloadClient
+from sentinelhub.download.models import DownloadRequest
+from sentinelhub.exceptions import OutOfRequestsException
+
+from naturalness import metrics
+from naturalness.deadline import DEADLINE, check_deadline
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class FailFastDownloadClient(SentinelHubDownloadClient):
+    """
+    A download client that fails on rate limiting instead of waiting for the rate limit, so that the `RetryPolicy`
+    decides whether and when to retry and the `Retry-After` header of the response remains available to it.
+    """
+
+    def _do_download(self, request: DownloadRequest) -> requests.Response:
+        response = super()._do_download(request)
+        if response.status_code == requests.codes.TOO_MANY_REQUESTS:
+            raise DownloadFailedException(
+                f'Rate limit of {request.url} exceeded', request_exception=requests.HTTPError(response=response)
+            )
+        return response
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    Retry failed SentinelHub calls with exponential backoff and full jitter. Only connection errors and the
+    `status_codes` are retried; a `Retry-After` of the response is waited for at least, but retries that would exceed
+    `max_delay` or the deadline of the request are given up. Callers must only pass idempotent calls, e.g. process
+    requests or catalog searches but not the creation of batch jobs.
+    """
+
+    max_attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 30.0
+    status_codes: Tuple[int, ...] = RETRYABLE_STATUS_CODES
+
+    def reason(self, exception: DownloadFailedException) -> Optional[str]:
+        """The reason to retry the failure (status code or connection), `None` if it is permanent"""
+        if isinstance(exception, OutOfRequestsException):
+            return str(requests.codes.TOO_MANY_REQUESTS)
+        request_exception = exception.request_exception
+        if isinstance(
+            request_exception, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+        ):
+            return 'connection'
+        response = getattr(request_exception, 'response', None)
+        if response is not None and response.status_code in self.status_codes:
+            return str(response.status_code)
+        return None
+
+    def delay(self, attempt: int, exception: DownloadFailedException) -> float:
+        backoff = random.uniform(0.0, min(self.max_delay, self.base_delay * 2**attempt))
+        retry_after = RetryPolicy.retry_after(exception)
+        return backoff if retry_after is None else max(backoff, retry_after)
+
+    @staticmethod
+    def retry_after(exception: DownloadFailedException) -> Optional[float]:
+        """The seconds to wait as requested by the `Retry-After` header (delay seconds or HTTP date), if any"""
+        response = getattr(exception.request_exception, 'response', None)
+        value = None if response is None else response.headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(UTC)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    def call(self, func: Callable[[], T], operation: str) -> T:
+        for attempt in range(self.max_attempts):
+            try:
+                return func()
+            except DownloadFailedException as e:
+                reason = self.reason(e)
+                if reason is None or attempt + 1 >= self.max_attempts:
+                    raise
+                delay = self.delay(attempt=attempt, exception=e)
+                deadline = DEADLINE.get()
+                if delay > self.max_delay or (deadline is not None and delay >= deadline.remaining()):
+                    log.warning(f'Giving up the {operation} call, the next attempt would be in {delay:.1f}s')
+                    raise
+                metrics.UPSTREAM_RETRIES.labels(operation=operation, reason=reason).inc()
+                log.warning(
+                    f'Attempt {attempt + 1} of the {operation} call failed ({reason}), retrying in {delay:.1f}s'
+                )
+                time.sleep(delay)
+                check_deadline()
+        raise ValueError('The retry policy requires at least one attempt')
+
+
+class Hedger:
+    """
+    Send a duplicate of a download that did not complete within the `percentile` of the recent download latencies, and
+    take whichever completes first. The slower request is not cancelled, as the HTTP call cannot be interrupted; its
+    result is discarded.
+
+    A hedged process request consumes its PUs twice, i.e. the `percentile` bounds the share of downloads that are paid
+    twice. Hedging starts once `min_samples` latencies were recorded.
+    """
+
+    def __init__(self, percentile: float = 0.95, window: int = 200, min_samples: int = 20, max_workers: int = 16):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hedge')
+
+    def record(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+
+    def threshold(self) -> Optional[float]:
+        """The latency after which a download is hedged, `None` until enough latencies were recorded"""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            return float(np.quantile(self._latencies, self.percentile))
+
+    def call(self, func: Callable[[], T]) -> T:
+        threshold = self.threshold()
+        started = time.monotonic()
+        if threshold is None:
+            result = func()
+            self.record(time.monotonic() - started)
+            return result
+
+        # the deadline and the metric labels of the request are carried into the threads
+        primary = self._executor.submit(contextvars.copy_context().run, func)
+        done, _ = wait([primary], timeout=threshold)
+        if done:
+            result = primary.result()
+            self.record(time.monotonic() - started)
+            return result
+
+        log.debug(f'Hedging a download that exceeded {threshold:.2f}s')
+        hedge = self._executor.submit(contextvars.copy_context().run, func)
+        attempts: Dict[Future, str] = {primary: 'primary', hedge: 'hedge'}
+        pending = set(attempts)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except DownloadFailedException as e:
+                    error = e
+                    continue
+                metrics.HEDGED_REQUESTS.labels(winner=attempts[future]).inc()
+                self.record(time.monotonic() - started)
+                return result
+
+        metrics.HEDGED_REQUESTS.labels(winner='none').inc()
+        raise error
@@ -0,0 +1,67 @@
+import logging
+from enum import StrEnum
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+from opentelemetry import trace
+
+if TYPE_CHECKING:
+    from opentelemetry.sdk.trace import TracerProvider
+
+log = logging.getLogger(__name__)
+
+# without a configured tracer provider this is a no-op tracer, so instrumented code paths have negligible overhead
+tracer = trace.get_tracer('naturalness')
+
+
+class TracingExporter(StrEnum):
+    OTLP = 'otlp'
+    FILE = 'file'
+
+
+def configure_tracing(
+    exporter: Optional[TracingExporter], file_path: Path = Path('./traces.jsonl')
+) -> Optional['TracerProvider']:
+    """
+    Register a tracer provider exporting the spans. The OTLP exporter is configured via the standard `OTEL_EXPORTER_OTLP_*`
+    environment variables, the file exporter writes one JSON document per span for offline analysis.
+
+    :param exporter: the exporter to use, tracing stays disabled if `None`
+    :param file_path: target of the file exporter
+    :return: the registered provider, which must be shut down to flush pending spans and release the exporter
+    """
+    if exporter is None:
+        return None
+
+    try:
+        from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    except ImportError as e:
+        raise ImportError(
+            'Tracing requires the optional dependencies, install them via `poetry install -E tracing`'
+        ) from e
+
+    match exporter:
+        case TracingExporter.OTLP:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+            span_exporter = OTLPSpanExporter()
+        case TracingExporter.FILE:
+
+            class FileSpanExporter(ConsoleSpanExporter):
+                def shutdown(self) -> None:
+                    self.out.close()
+
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            span_exporter = FileSpanExporter(
+                out=open(file_path, mode='a'), formatter=lambda span: span.to_json(indent=None) + '\n'
+            )
+        case _:
+            raise ValueError(f'Tracing exporter {exporter} is not supported')
+
+    provider = TracerProvider(resource=Resource.create({SERVICE_NAME: 'naturalness-utility'}))
+    provider.add_span_processor(BatchSpanProcessor(span_exporter))
+    trace.set_tracer_provider(provider)
+    log.info(f'Tracing enabled with the {exporter} exporter')
+    return provider
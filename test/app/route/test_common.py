@@ -1,12 +1,42 @@
+import asyncio
+import json
 from datetime import date
+from typing import Tuple
 
 import geojson_pydantic
 import numpy as np
 import pytest
+import rasterio
 from pydantic import ValidationError
+from rasterio.warp import transform_geom
+from shapely.geometry import box, mapping, shape
+from starlette.requests import Request
 
-from app.route.common import Aggregation, NaturalnessWorkUnit, TimeRange, __compute_vector_response, get_bbox
-from naturalness.imagery_store_operator import Index, ProcessingUnitStats, RemoteSensingResult
+from app.route.common import (
+    Aggregation,
+    InstrumentedJSONResponse,
+    NaturalnessWorkUnit,
+    TimeRange,
+    TimeSeriesInterval,
+    ZonalStatsAccumulator,
+    __compute_multi_index_vector_response,
+    __compute_raster_response,
+    __compute_vector_response,
+    decode_work_unit,
+    encode_work_unit,
+    get_bbox,
+    preview_resolution,
+    split_time_range,
+    watch_disconnect,
+)
+from naturalness.deadline import Deadline
+from naturalness.imagery_store_operator import (
+    Index,
+    ProcessingUnitStats,
+    RemoteSensingMosaic,
+    RemoteSensingResult,
+    RemoteSensingTile,
+)
 
 
 def test_time_range_infer_date_start():
@@ -33,6 +63,33 @@ def test_work_unit():
     assert wu.time_range.end_date == end_date
 
 
+def test_work_unit_output_crs():
+    bbox = (8.70, 49.41, 8.71, 49.42)
+
+    assert NaturalnessWorkUnit(time_range=TimeRange(), bbox=bbox).output_crs() == 32632
+    assert NaturalnessWorkUnit(time_range=TimeRange(), bbox=bbox, crs=4326).output_crs() == 4326
+    with pytest.raises(ValidationError, match=r'.*The CRS must be WGS 84.*'):
+        NaturalnessWorkUnit(time_range=TimeRange(), bbox=bbox, crs=3857)
+
+
+def test_work_unit_token_round_trip():
+    work_unit = NaturalnessWorkUnit(
+        time_range=TimeRange(end_date=date(2020, 2, 1)), bbox=(8.65, 49.38, 8.75, 49.41), resolution=20, preview=True
+    )
+
+    decoded = decode_work_unit(encode_work_unit(work_unit))
+
+    assert decoded == work_unit.model_copy(update={'preview': False})
+
+
+@pytest.mark.parametrize(
+    'bbox, resolution, expected',
+    [((8.70, 49.41, 8.71, 49.42), 10, 10), ((8.65, 49.38, 8.75, 49.41), 10, 40), ((0.0, 0.0, 1.0, 1.0), 90, 720)],
+)
+def test_preview_resolution(bbox, resolution, expected):
+    assert preview_resolution(bbox=bbox, resolution=resolution) == expected
+
+
 def test_compute_vector_response():
     bbox = (0.0, 0.0, 2.0, 2.0)
     test_geometries = geojson_pydantic.FeatureCollection.model_validate(
@@ -69,11 +126,13 @@ def test_compute_vector_response():
         pus=ProcessingUnitStats(estimated=12, consumed=12),
     )
 
-    geom = __compute_vector_response(
-        stats=[Aggregation.max],
-        vectors=test_geometries,
-        index=Index.NDVI,
-        raster_result=test_raster_result,
+    geom = geojson_pydantic.FeatureCollection.model_validate(
+        __compute_vector_response(
+            stats=[Aggregation.max],
+            vectors=test_geometries,
+            index=Index.NDVI,
+            raster_result=RemoteSensingMosaic.from_result(test_raster_result),
+        )
     )
 
     assert isinstance(geom, geojson_pydantic.FeatureCollection)
@@ -111,11 +170,13 @@ def test_compute_vector_response_polygon_smaller_than_raster_cell():
         pus=ProcessingUnitStats(estimated=12, consumed=12),
     )
 
-    geom = __compute_vector_response(
-        stats=[Aggregation.max],
-        vectors=test_geometries,
-        index=Index.NDVI,
-        raster_result=test_raster_result,
+    geom = geojson_pydantic.FeatureCollection.model_validate(
+        __compute_vector_response(
+            stats=[Aggregation.max],
+            vectors=test_geometries,
+            index=Index.NDVI,
+            raster_result=RemoteSensingMosaic.from_result(test_raster_result),
+        )
     )
 
     assert geom.features[0].properties['max'] == 1.0
@@ -124,3 +185,287 @@ def test_compute_vector_response_polygon_smaller_than_raster_cell():
 def test_get_bbox(default_feature_collection):
     computed_bbox = get_bbox(default_feature_collection)
     assert computed_bbox == (0.0, 0.0, 1.0, 1.0)
+
+
+def test_instrumented_json_response_serialises_model(default_feature_collection):
+    response = InstrumentedJSONResponse(content=default_feature_collection)
+
+    assert response.media_type == 'application/json'
+    assert json.loads(response.body) == default_feature_collection.model_dump(mode='json')
+
+
+def test_instrumented_json_response_serialises_numpy():
+    response = InstrumentedJSONResponse(
+        content={'mean': np.float32(0.5), 'std': float('nan'), 'histogram': np.array([1, 2]), 'class_counts': {0: 2}}
+    )
+
+    assert response.body == b'{"mean":0.5,"std":null,"histogram":[1,2],"class_counts":{"0":2}}'
+
+
+def split_into_mosaic(data: np.ndarray, bbox: Tuple[float, float, float, float], tile_edge: int) -> RemoteSensingMosaic:
+    height, width = data.shape
+    west, south, east, north = bbox
+    tiles = []
+    for row in range(0, height, tile_edge):
+        for column in range(0, width, tile_edge):
+            tile_data = data[row : row + tile_edge, column : column + tile_edge]
+            tiles.append(
+                RemoteSensingTile(
+                    row_offset=row,
+                    column_offset=column,
+                    result=RemoteSensingResult(
+                        index_data=tile_data,
+                        height=tile_data.shape[0],
+                        width=tile_data.shape[1],
+                        bbox=(
+                            west + column / width * (east - west),
+                            north - (row + tile_data.shape[0]) / height * (north - south),
+                            west + (column + tile_data.shape[1]) / width * (east - west),
+                            north - row / height * (north - south),
+                        ),
+                        pus=ProcessingUnitStats(estimated=0.0, consumed=0.0),
+                    ),
+                )
+            )
+    return RemoteSensingMosaic(height=height, width=width, bbox=bbox, tile_count=len(tiles), tiles=iter(tiles))
+
+
+def test_compute_raster_response_writes_tiles():
+    bbox = (0.0, 0.0, 2.0, 2.0)
+    data = np.random.default_rng(seed=42).uniform(-1.0, 1.0, size=(20, 30))
+
+    response = __compute_raster_response(
+        raster_result=split_into_mosaic(data=data, bbox=bbox, tile_edge=8),
+        body=NaturalnessWorkUnit(time_range=TimeRange(), bbox=bbox),
+        index=Index.NDVI,
+    )
+
+    with rasterio.open(response.path) as raster:
+        np.testing.assert_array_equal(raster.read(1), data)
+        assert raster.bounds == bbox
+    response.path.unlink()
+
+
+def test_compute_raster_response_in_utm_zone():
+    bbox = (478000.0, 5473000.0, 480000.0, 5475000.0)
+    data = np.array([[0.25, 1.0], [0.25, 1.0]])
+
+    response = __compute_raster_response(
+        raster_result=RemoteSensingMosaic.from_result(
+            RemoteSensingResult(
+                index_data=data,
+                height=2,
+                width=2,
+                bbox=bbox,
+                pus=ProcessingUnitStats(estimated=0.0, consumed=0.0),
+                crs=32632,
+            )
+        ),
+        body=NaturalnessWorkUnit(time_range=TimeRange(), bbox=(8.70, 49.41, 8.72, 49.43)),
+        index=Index.NDVI,
+    )
+
+    with rasterio.open(response.path) as raster:
+        assert raster.crs.to_epsg() == 32632
+        assert raster.bounds == bbox
+        assert raster.res == (1000.0, 1000.0)
+    response.path.unlink()
+
+
+@pytest.mark.parametrize('tile_edge', [1, 2])
+def test_compute_vector_response_in_utm_zone(tile_edge):
+    # 1 km pixels in UTM zone 32N, the feature covers the western column
+    bbox = (478000.0, 5473000.0, 480000.0, 5475000.0)
+    data = np.array([[0.25, 1.0], [0.25, 1.0]])
+    geometry = transform_geom('EPSG:32632', 'EPSG:4326', mapping(box(478100.0, 5473100.0, 478900.0, 5474900.0)))
+    vectors = geojson_pydantic.FeatureCollection.model_validate(
+        {'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'geometry': geometry, 'properties': {}}]}
+    )
+    mosaic = split_into_mosaic(data=data, bbox=bbox, tile_edge=tile_edge)
+    mosaic.crs = 32632
+
+    response = __compute_vector_response(
+        stats=[Aggregation.mean, Aggregation.count], vectors=vectors, index=Index.NDVI, raster_result=mosaic
+    )
+
+    (feature,) = response['features']
+    assert feature['properties'] == {'mean': 0.25, 'count': 2}
+    # the features keep their WGS 84 geometries
+    assert shape(feature['geometry']) == shape(geometry)
+
+
+def test_compute_vector_response_accumulates_tiles():
+    bbox = (0.0, 0.0, 2.0, 2.0)
+    test_geometries = geojson_pydantic.FeatureCollection.model_validate(
+        {
+            'type': 'FeatureCollection',
+            'features': [
+                {
+                    'type': 'Feature',
+                    'geometry': {
+                        'type': 'Polygon',
+                        'coordinates': [[[0.05, 0.05], [1.33, 0.2], [0.9, 1.7], [0.05, 0.05]]],
+                    },
+                    'properties': {'name': 'triangle'},
+                },
+                {
+                    'type': 'Feature',
+                    'geometry': {
+                        'type': 'Polygon',
+                        'coordinates': [[[0.0, 0.0], [2.0, 0.0], [2.0, 2.0], [0.0, 2.0], [0.0, 0.0]]],
+                    },
+                    'properties': {},
+                },
+                {
+                    'type': 'Feature',
+                    'geometry': {
+                        'type': 'Polygon',
+                        'coordinates': [[[1.9, 1.9], [2.0, 1.9], [2.0, 2.0], [1.9, 2.0], [1.9, 1.9]]],
+                    },
+                    'properties': {},
+                },
+            ],
+        }
+    )
+    data = np.random.default_rng(seed=42).integers(0, 5, size=(20, 30)).astype(np.float64)
+    data[18:, 27:] = -999
+    data[0, :] = -999
+    stats = list(Aggregation)
+
+    single = geojson_pydantic.FeatureCollection.model_validate(
+        __compute_vector_response(
+            stats=stats,
+            vectors=test_geometries,
+            index=Index.NDVI,
+            raster_result=RemoteSensingMosaic.from_result(
+                RemoteSensingResult(
+                    index_data=data,
+                    height=20,
+                    width=30,
+                    bbox=bbox,
+                    pus=ProcessingUnitStats(estimated=0.0, consumed=0.0),
+                )
+            ),
+        )
+    )
+    tiled = geojson_pydantic.FeatureCollection.model_validate(
+        __compute_vector_response(
+            stats=stats,
+            vectors=test_geometries,
+            index=Index.NDVI,
+            raster_result=split_into_mosaic(data=data, bbox=bbox, tile_edge=7),
+        )
+    )
+
+    for single_feature, tiled_feature in zip(single.features, tiled.features):
+        assert tiled_feature.geometry == single_feature.geometry
+        assert tiled_feature.properties == pytest.approx(single_feature.properties)
+    assert tiled.features[0].properties['name'] == 'triangle'
+    assert tiled.features[2].properties['count'] == 0
+
+
+def test_compute_multi_index_vector_response(default_feature_collection):
+    bbox = (0.0, 0.0, 1.0, 1.0)
+    rng = np.random.default_rng(seed=42)
+    data = {
+        Index.NDVI: rng.uniform(-1.0, 1.0, size=(10, 10)),
+        Index.WATER: rng.integers(0, 2, size=(10, 10)).astype(np.float64),
+    }
+
+    def mosaic(index_data: np.ndarray) -> RemoteSensingMosaic:
+        return RemoteSensingMosaic.from_result(
+            RemoteSensingResult(
+                index_data=index_data,
+                height=10,
+                width=10,
+                bbox=bbox,
+                pus=ProcessingUnitStats(estimated=0.0, consumed=0.0),
+            )
+        )
+
+    geom = geojson_pydantic.FeatureCollection.model_validate(
+        __compute_multi_index_vector_response(
+            stats=[Aggregation.mean, Aggregation.median],
+            vectors=default_feature_collection,
+            raster_results={index: mosaic(index_data) for index, index_data in data.items()},
+        )
+    )
+
+    properties = geom.features[0].properties
+    for index, index_data in data.items():
+        single = geojson_pydantic.FeatureCollection.model_validate(
+            __compute_vector_response(
+                stats=[Aggregation.mean, Aggregation.median],
+                vectors=default_feature_collection,
+                index=index,
+                raster_result=mosaic(index_data),
+            )
+        )
+        assert properties[f'{index}_mean'] == pytest.approx(single.features[0].properties['mean'])
+        assert properties[f'{index}_median'] == pytest.approx(single.features[0].properties['median'])
+
+
+def test_zonal_stats_accumulator_counts_classes():
+    accumulator = ZonalStatsAccumulator(stats=['majority', 'unique', 'count'], class_count=2)
+
+    accumulator.add(values=np.array([0, 1, 1, 255], dtype=np.uint8), nodata=255)
+    accumulator.add(values=np.array([1, 255], dtype=np.uint8), nodata=255)
+
+    assert accumulator.result() == {
+        'majority': 1.0,
+        'unique': 2,
+        'count': 4,
+        'class_counts': {'0': 1, '1': 3},
+        'class_fractions': {'0': 0.25, '1': 0.75},
+    }
+
+
+def test_zonal_stats_accumulator_histogram():
+    accumulator = ZonalStatsAccumulator(stats=[], histogram_bins=4, histogram_range=(-1.0, 1.0))
+
+    accumulator.add(values=np.array([-1.0, -0.75, 0.1, -999.0]), nodata=-999)
+    accumulator.add(values=np.array([1.0, np.nan]), nodata=-999)
+
+    assert accumulator.result() == {'histogram': [2, 0, 1, 1]}
+
+
+def test_split_time_range_monthly():
+    windows = split_time_range(
+        time_range=TimeRange(start_date=date(2023, 11, 20), end_date=date(2024, 2, 10)),
+        interval=TimeSeriesInterval.MONTH,
+    )
+
+    assert windows == [
+        (date(2023, 11, 20), date(2023, 11, 30)),
+        (date(2023, 12, 1), date(2023, 12, 31)),
+        (date(2024, 1, 1), date(2024, 1, 31)),
+        (date(2024, 2, 1), date(2024, 2, 10)),
+    ]
+
+
+def test_split_time_range_quarterly():
+    windows = split_time_range(
+        time_range=TimeRange(start_date=date(2023, 2, 1), end_date=date(2023, 12, 31)),
+        interval=TimeSeriesInterval.QUARTER,
+    )
+
+    assert windows == [
+        (date(2023, 2, 1), date(2023, 3, 31)),
+        (date(2023, 4, 1), date(2023, 6, 30)),
+        (date(2023, 7, 1), date(2023, 9, 30)),
+        (date(2023, 10, 1), date(2023, 12, 31)),
+    ]
+
+
+def test_watch_disconnect_cancels_deadline():
+    messages = iter([{'type': 'http.request', 'body': b''}, {'type': 'http.disconnect'}])
+
+    async def receive():
+        return next(messages)
+
+    deadline = Deadline(timeout=60.0)
+    asyncio.run(
+        watch_disconnect(request=Request(scope={'type': 'http'}, receive=receive), deadline=deadline, interval=0)
+    )
+
+    assert deadline.cancelled
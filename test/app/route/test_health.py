@@ -1,4 +1,67 @@
+import pytest
+
+from app.api import app
+from app.load_shedding import LoadShedder
+from app.route import imagery
+from app.route.health import ReadinessPolicy
+from naturalness import metrics
+
+
 def test_health(mocked_client):
     response = mocked_client.get('/health')
     assert response.status_code == 200
     assert response.json() == {'status': 'ok'}
+
+
+@pytest.fixture
+def upstream_error_rate(monkeypatch) -> metrics.ErrorRate:
+    error_rate = metrics.ErrorRate(min_requests=2)
+    monkeypatch.setattr(metrics, 'UPSTREAM_ERROR_RATE', error_rate)
+    return error_rate
+
+
+def test_ready(mocked_client, upstream_error_rate, monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        app.state, 'readiness_policy', ReadinessPolicy(cache_dir=tmp_path, min_free_disk_bytes=0), raising=False
+    )
+    monkeypatch.setattr(app.state, 'load_shedder', LoadShedder(routes=imagery.router.routes), raising=False)
+
+    response = mocked_client.get('/health/ready')
+
+    assert response.status_code == 200
+    readiness = response.json()
+    assert readiness['status'] == 'ready'
+    assert readiness['routes']['/{index}/raster'] == {'in_flight': 0, 'queued': 0}
+    assert readiness['cache_disk']['free_bytes'] > 0
+    assert readiness['upstream_error_rate'] is None
+
+
+def test_not_ready_if_upstream_fails(mocked_client, upstream_error_rate):
+    upstream_error_rate.record(failed=True)
+    upstream_error_rate.record(failed=False)
+    upstream_error_rate.record(failed=True)
+
+    response = mocked_client.get('/health/ready')
+
+    assert response.status_code == 503
+    assert response.json()['reasons'] == ['67% of the SentinelHub downloads failed']
+
+
+def test_not_ready_if_saturated(mocked_client, upstream_error_rate, monkeypatch):
+    load_shedder = LoadShedder(routes=imagery.router.routes, max_in_flight=0, max_queued=0)
+    monkeypatch.setattr(app.state, 'load_shedder', load_shedder, raising=False)
+
+    response = mocked_client.get('/health/ready')
+
+    assert response.status_code == 503
+    assert '/{index}/raster is saturated' in response.json()['reasons']
+
+
+def test_not_ready_if_cache_disk_full(mocked_client, upstream_error_rate, monkeypatch, tmp_path):
+    policy = ReadinessPolicy(cache_dir=tmp_path, min_free_disk_bytes=2**62)
+    monkeypatch.setattr(app.state, 'readiness_policy', policy, raising=False)
+
+    response = mocked_client.get('/health/ready')
+
+    assert response.status_code == 503
+    assert response.json()['reasons'][0].endswith('bytes are free on the cache disk')
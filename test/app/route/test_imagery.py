@@ -1,9 +1,12 @@
+import time
+
 import numpy as np
 import pytest
 from rasterio import MemoryFile
 
+from app.api import app
 from app.route.common import Aggregation
-from naturalness.imagery_store_operator import Index
+from naturalness.imagery_store_operator import ImageryStore, Index
 
 
 @pytest.mark.parametrize('index', Index)
@@ -106,3 +109,241 @@ def test_index_vector_raise_exception_invalid_summary(mocked_client, index, defa
 
     response = mocked_client.post(f'/{index}/vector', json=default_vector_request)
     assert response.status_code == 422
+
+
+def test_multi_index_vector(mocked_client, default_vector_request):
+    default_vector_request.update(
+        {'indices': [Index.NDVI, Index.WATER], 'aggregation_stats': [Aggregation.max, Aggregation.count]}
+    )
+
+    response = mocked_client.post('/vector', json=default_vector_request)
+
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/json'
+
+    response_feature = response.json()['features'][0]
+
+    assert response_feature['geometry'] == default_vector_request['vectors']['features'][0]['geometry']
+    assert response_feature['properties'] == {'NDVI_max': 1.0, 'NDVI_count': 5, 'WATER_max': 1.0, 'WATER_count': 5}
+
+
+def test_multi_index_vector_requires_index(mocked_client, default_vector_request):
+    default_vector_request.update({'indices': []})
+
+    response = mocked_client.post('/vector', json=default_vector_request)
+
+    assert response.status_code == 422
+
+
+def test_index_vector_categorical(mocked_client, default_vector_request):
+    default_vector_request.update({'aggregation_stats': [Aggregation.majority], 'categorical': True})
+
+    response = mocked_client.post(f'/{Index.WATER}/vector', json=default_vector_request)
+
+    assert response.status_code == 200
+    assert response.json()['features'][0]['properties'] == {
+        'majority': 1.0,
+        'class_counts': {'0': 2, '1': 3},
+        'class_fractions': {'0': 0.4, '1': 0.6},
+    }
+
+
+def test_index_vector_histogram(mocked_client, default_vector_request):
+    default_vector_request.update({'histogram_bins': 4})
+
+    response = mocked_client.post(f'/{Index.NDVI}/vector', json=default_vector_request)
+
+    assert response.status_code == 200
+    assert response.json()['features'][0]['properties'] == {'max': 1.0, 'histogram': [0, 0, 1, 4]}
+
+
+@pytest.mark.parametrize('index, options', [(Index.NDVI, {'categorical': True}), (Index.WATER, {'histogram_bins': 4})])
+def test_index_vector_distribution_not_available(mocked_client, default_vector_request, index, options):
+    default_vector_request.update(options)
+
+    response = mocked_client.post(f'/{index}/vector', json=default_vector_request)
+
+    assert response.status_code == 422
+
+
+def test_multi_index_vector_distributions(mocked_client, default_vector_request):
+    default_vector_request.update(
+        {'indices': [Index.NDVI, Index.WATER], 'aggregation_stats': [], 'categorical': True, 'histogram_bins': 2}
+    )
+
+    response = mocked_client.post('/vector', json=default_vector_request)
+
+    assert response.status_code == 200
+    assert response.json()['features'][0]['properties'] == {
+        'NDVI_histogram': [0, 5],
+        'WATER_class_counts': {'0': 2, '1': 3},
+        'WATER_class_fractions': {'0': 0.4, '1': 0.6},
+    }
+
+
+def test_index_timeseries(mocked_client, default_vector_request):
+    default_vector_request.update(
+        {
+            'time_range': {'start_date': '2023-01-15', 'end_date': '2023-06-01'},
+            'interval': 'quarter',
+            'aggregation_stats': [Aggregation.max, Aggregation.count],
+        }
+    )
+
+    response = mocked_client.post(f'/{Index.NDVI}/timeseries', json=default_vector_request)
+
+    assert response.status_code == 200
+    assert response.json()['features'][0]['properties'] == {
+        'time_series': {
+            'start_date': ['2023-01-15', '2023-04-01'],
+            'end_date': ['2023-03-31', '2023-06-01'],
+            'max': [1.0, 1.0],
+            'count': [5, 5],
+        }
+    }
+
+
+def test_index_timeseries_too_many_windows(mocked_client, default_vector_request):
+    default_vector_request.update({'time_range': {'start_date': '2000-01-01', 'end_date': '2023-06-01'}})
+
+    response = mocked_client.post(f'/{Index.NDVI}/timeseries', json=default_vector_request)
+
+    assert response.status_code == 422
+
+
+class SlowImageryStore(ImageryStore):
+    def __init__(self, imagery_store: ImageryStore):
+        self.imagery_store = imagery_store
+
+    def imagery(self, *args, **kwargs):
+        time.sleep(0.05)
+        return self.imagery_store.imagery(*args, **kwargs)
+
+
+@pytest.mark.parametrize('server_timeout, client_timeout', [(None, '0.01'), (0.01, '60'), (0.01, None)])
+def test_index_raster_deadline(mocked_client, monkeypatch, server_timeout, client_timeout):
+    monkeypatch.setattr(app.state, 'imagery_store', SlowImageryStore(app.state.imagery_store))
+    monkeypatch.setattr(app.state, 'request_timeout', server_timeout, raising=False)
+    headers = {} if client_timeout is None else {'X-Request-Timeout': client_timeout}
+
+    response = mocked_client.post(
+        f'/{Index.NDVI}/raster',
+        json={'bbox': [0.0, 0.0, 1.0, 1.0], 'time_range': {'end_date': '2023-06-01'}},
+        headers=headers,
+    )
+
+    assert response.status_code == 504
+
+
+def test_index_vector_within_deadline(mocked_client, default_vector_request):
+    response = mocked_client.post(
+        f'/{Index.NDVI}/vector', json=default_vector_request, headers={'X-Request-Timeout': '60'}
+    )
+
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize('path', [f'/{Index.NDVI}/vector', f'/{Index.NDVI}/timeseries', '/vector'])
+def test_vector_without_geometry(mocked_client, default_vector_request, path):
+    default_vector_request['vectors']['features'][0]['id'] = 'parcel'
+    default_vector_request['vectors']['features'].append(
+        {
+            'type': 'Feature',
+            'properties': {'name': 'second'},
+            'geometry': {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 0]]]},
+        }
+    )
+
+    response = mocked_client.post(
+        path, json={**default_vector_request, 'indices': [Index.NDVI], 'include_geometry': False}
+    )
+
+    assert response.status_code == 200
+    features = response.json()['features']
+    assert [feature['id'] for feature in features] == ['parcel', 1]
+    assert all(feature['geometry'] is None for feature in features)
+    assert features[1]['properties']['name'] == 'second'
+
+
+class RecordingImageryStore(ImageryStore):
+    def __init__(self, imagery_store: ImageryStore):
+        self.imagery_store = imagery_store
+        self.requests = []
+
+    def imagery(self, *args, **kwargs):
+        self.requests.append(kwargs)
+        return self.imagery_store.imagery(*args, **kwargs)
+
+
+def test_index_raster_preview(mocked_client, monkeypatch):
+    imagery_store = RecordingImageryStore(app.state.imagery_store)
+    monkeypatch.setattr(app.state, 'imagery_store', imagery_store)
+
+    response = mocked_client.post(
+        f'/{Index.NDVI}/raster',
+        json={'bbox': [0.0, 0.0, 1.0, 1.0], 'time_range': {'end_date': '2023-06-01'}, 'preview': True},
+    )
+
+    assert response.status_code == 200
+    assert response.headers['X-Preview-Resolution'] == '720'
+    assert [request['resolution'] for request in imagery_store.requests] == [720]
+
+    full_url, relation = response.headers['Link'].split('; ')
+    assert relation == 'rel="full-resolution"'
+    assert full_url.startswith(f'</{Index.NDVI}/raster/full/')
+    full_response = mocked_client.get(full_url.strip('<>'))
+
+    assert full_response.status_code == 200
+    assert full_response.headers['content-type'] == 'image/geotiff'
+    assert 'Link' not in full_response.headers
+    assert [request['resolution'] for request in imagery_store.requests] == [720, 90]
+
+
+def test_index_full_raster_invalid_work_unit(mocked_client):
+    response = mocked_client.get(f'/{Index.NDVI}/raster/full/not-a-work-unit')
+
+    assert response.status_code == 422
+
+
+@pytest.mark.parametrize(
+    'crs, expected_crs, expected_bbox',
+    [
+        (None, 32631, (165960, 0, 277470, 110700)),
+        (32631, 32631, (165960, 0, 277470, 110700)),
+        (4326, 4326, (0.0, 0.0, 1.0, 1.0)),
+    ],
+)
+def test_index_raster_crs(mocked_client, monkeypatch, crs, expected_crs, expected_bbox):
+    imagery_store = RecordingImageryStore(app.state.imagery_store)
+    monkeypatch.setattr(app.state, 'imagery_store', imagery_store)
+
+    response = mocked_client.post(
+        f'/{Index.NDVI}/raster',
+        json={'bbox': [0.0, 0.0, 1.0, 1.0], 'time_range': {'end_date': '2023-06-01'}, 'crs': crs},
+    )
+
+    assert response.status_code == 200
+    (request,) = imagery_store.requests
+    assert request['crs'] == expected_crs
+    assert request['bbox'] == pytest.approx(expected_bbox)
+
+
+def test_index_raster_unsupported_crs(mocked_client):
+    response = mocked_client.post(
+        f'/{Index.NDVI}/raster',
+        json={'bbox': [0.0, 0.0, 1.0, 1.0], 'time_range': {'end_date': '2023-06-01'}, 'crs': 3857},
+    )
+
+    assert response.status_code == 422
+
+
+def test_index_vector_in_utm_zone(mocked_client, monkeypatch, default_vector_request):
+    imagery_store = RecordingImageryStore(app.state.imagery_store)
+    monkeypatch.setattr(app.state, 'imagery_store', imagery_store)
+
+    response = mocked_client.post(f'/{Index.NDVI}/vector', json=default_vector_request)
+
+    assert response.status_code == 200
+    (request,) = imagery_store.requests
+    assert request['crs'] == 32631
+    assert all(coordinate % 90 == 0 for coordinate in request['bbox'])
@@ -0,0 +1,30 @@
+from naturalness.imagery_store_operator import Index
+
+
+def test_metrics(mocked_client):
+    response = mocked_client.get('/metrics')
+
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    assert 'naturalness_stage_duration_seconds' in response.text
+
+
+def test_metrics_record_route_stages(mocked_client, default_vector_request):
+    mocked_client.post(f'/{Index.NDVI}/raster', json={'bbox': [0.0, 0.0, 1.0, 1.0]})
+    mocked_client.post(f'/{Index.WATER}/vector', json=default_vector_request)
+
+    response = mocked_client.get('/metrics')
+
+    assert (
+        'naturalness_stage_duration_seconds_count{index="NDVI",route="/{index}/raster",stage="encode"}' in response.text
+    )
+    assert (
+        'naturalness_stage_duration_seconds_count{index="WATER",route="/{index}/vector",stage="zonal_stats"}'
+        in response.text
+    )
+    assert (
+        'naturalness_stage_duration_seconds_count{index="WATER",route="/{index}/vector",stage="serialization"}'
+        in response.text
+    )
+    assert 'naturalness_response_size_bytes_count{index="NDVI",route="/{index}/raster"}' in response.text
+    assert 'naturalness_requests_in_flight{index="NDVI",route="/{index}/raster"} 0.0' in response.text
@@ -0,0 +1,61 @@
+import gzip
+
+import pytest
+import zstandard
+
+from app.compression import ContentEncoding, negotiate_encoding
+from naturalness.imagery_store_operator import Index
+
+
+@pytest.mark.parametrize(
+    'accept_encoding, encoding',
+    [
+        ('gzip, deflate, br, zstd', ContentEncoding.ZSTD),
+        ('gzip', ContentEncoding.GZIP),
+        ('zstd;q=0.5, gzip', ContentEncoding.GZIP),
+        ('zstd;q=0, gzip;q=0', None),
+        ('identity', None),
+        ('', None),
+    ],
+)
+def test_negotiate_encoding(accept_encoding, encoding):
+    assert negotiate_encoding(accept_encoding) == encoding
+
+
+@pytest.mark.parametrize(
+    'encoding, decompress',
+    [('gzip', gzip.decompress), ('zstd', lambda body: zstandard.ZstdDecompressor().decompress(body))],
+)
+def test_vector_response_compressed(mocked_client, default_vector_request, encoding, decompress):
+    features = default_vector_request['vectors']['features'] * 20
+    request = {**default_vector_request, 'vectors': {'type': 'FeatureCollection', 'features': features}}
+    uncompressed = mocked_client.post(f'/{Index.NDVI}/vector', json=request, headers={'Accept-Encoding': 'identity'})
+
+    with mocked_client.stream(
+        'POST', f'/{Index.NDVI}/vector', json=request, headers={'Accept-Encoding': encoding}
+    ) as response:
+        body = b''.join(response.iter_raw())
+
+    assert response.headers['content-encoding'] == encoding
+    assert response.headers['vary'] == 'Accept-Encoding'
+    assert int(response.headers['content-length']) == len(body) < len(uncompressed.content)
+    assert decompress(body) == uncompressed.content
+
+
+def test_small_response_not_compressed(mocked_client, default_vector_request):
+    response = mocked_client.post(
+        f'/{Index.NDVI}/vector', json=default_vector_request, headers={'Accept-Encoding': 'gzip'}
+    )
+
+    assert response.status_code == 200
+    assert 'content-encoding' not in response.headers
+
+
+def test_raster_response_not_compressed(mocked_client):
+    response = mocked_client.post(
+        f'/{Index.NDVI}/raster',
+        json={'bbox': [0.0, 0.0, 1.0, 1.0], 'time_range': {'end_date': '2023-06-01'}},
+        headers={'Accept-Encoding': 'gzip'},
+    )
+
+    assert 'content-encoding' not in response.headers
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from app.api import app
+from app.load_shedding import LoadShedder
+from app.route import imagery
+from naturalness.imagery_store_operator import Index
+
+ROUTE = '/{index}/raster'
+RASTER_REQUEST = {'bbox': [0.0, 0.0, 1.0, 1.0], 'time_range': {'end_date': '2023-06-01'}}
+
+
+@pytest.fixture
+def load_shedder(monkeypatch) -> LoadShedder:
+    load_shedder = LoadShedder(routes=imagery.router.routes, max_in_flight=0, max_queued=0, retry_after=7)
+    monkeypatch.setattr(app.state, 'load_shedder', load_shedder, raising=False)
+    return load_shedder
+
+
+def test_saturated_route_is_shed(mocked_client, load_shedder):
+    response = mocked_client.post(f'/{Index.NDVI}/raster', json=RASTER_REQUEST)
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '7'
+    assert load_shedder.load(ROUTE).queued == 0
+
+
+def test_unguarded_routes_pass(mocked_client, load_shedder):
+    response = mocked_client.get('/health')
+
+    assert response.status_code == 200
+
+
+def test_request_within_limits_passes(mocked_client, load_shedder):
+    load_shedder.max_in_flight = 1
+
+    response = mocked_client.post(f'/{Index.NDVI}/raster', json=RASTER_REQUEST)
+
+    assert response.status_code == 200
+    assert load_shedder.load(ROUTE).in_flight == 0
+
+
+def test_queued_request_waits_for_free_slot():
+    async def run() -> None:
+        load_shedder = LoadShedder(routes=[], max_in_flight=1, max_queued=1, queue_timeout=1.0)
+        assert await load_shedder.acquire(ROUTE) is None
+
+        waiting = asyncio.create_task(load_shedder.acquire(ROUTE))
+        await asyncio.sleep(0)
+        assert load_shedder.load(ROUTE).queued == 1
+        assert load_shedder.saturated(ROUTE)
+        assert await load_shedder.acquire(ROUTE) == 'queue_full'
+
+        load_shedder.release(ROUTE)
+        assert await waiting is None
+        assert load_shedder.load(ROUTE).in_flight == 1
+        assert load_shedder.load(ROUTE).queued == 0
+
+    asyncio.run(run())
+
+
+def test_queued_request_times_out():
+    async def run() -> None:
+        load_shedder = LoadShedder(routes=[], max_in_flight=1, max_queued=1, queue_timeout=0.01)
+        assert await load_shedder.acquire(ROUTE) is None
+
+        assert await load_shedder.acquire(ROUTE) == 'queue_timeout'
+        assert load_shedder.load(ROUTE).queued == 0
+
+    asyncio.run(run())
@@ -0,0 +1,56 @@
+import pytest
+
+from app.api import app
+from app.profiling import ProfileFormat, RequestProfiler
+
+
+@pytest.fixture
+def request_profiler(tmp_path) -> RequestProfiler:
+    app.state.request_profiler = RequestProfiler(profile_dir=tmp_path, admin_token='secret')
+    yield app.state.request_profiler
+    del app.state.request_profiler
+
+
+def test_profile_requested_by_admin(mocked_client, request_profiler):
+    response = mocked_client.get('/health', headers={'X-Profile-Token': 'secret', 'X-Request-ID': 'health-check'})
+
+    assert response.status_code == 200
+    assert response.headers['X-Request-ID'] == 'health-check'
+    assert len(list(request_profiler.profile_dir.glob('health-check-*.html'))) == 1
+
+
+def test_profile_invalid_token(mocked_client, request_profiler):
+    response = mocked_client.get('/health', headers={'X-Profile-Token': 'guess'})
+
+    assert response.status_code == 200
+    assert 'X-Request-ID' not in response.headers
+    assert list(request_profiler.profile_dir.iterdir()) == []
+
+
+def test_profile_sampled(mocked_client, request_profiler):
+    request_profiler.sample_rate = 1.0
+    request_profiler.profile_format = ProfileFormat.SPEEDSCOPE
+
+    response = mocked_client.get('/health', headers={'X-Request-ID': '../escape'})
+
+    request_id = response.headers['X-Request-ID']
+    assert request_id != '../escape'
+    assert len(list(request_profiler.profile_dir.glob(f'{request_id}-*.speedscope.json'))) == 1
+
+
+def test_profile_request_id_reused(mocked_client, request_profiler):
+    headers = {'X-Profile-Token': 'secret', 'X-Request-ID': 'health-check'}
+
+    mocked_client.get('/health', headers=headers)
+    mocked_client.get('/health', headers=headers)
+
+    assert len(list(request_profiler.profile_dir.glob('health-check-*.html'))) == 2
+
+
+def test_profile_store_failure(mocked_client, request_profiler, caplog):
+    request_profiler.profile_dir.rmdir()
+
+    response = mocked_client.get('/health', headers={'X-Profile-Token': 'secret', 'X-Request-ID': 'health-check'})
+
+    assert response.status_code == 200
+    assert 'Failed to store the profile of request health-check' in caplog.text
@@ -0,0 +1,105 @@
+from datetime import date, timedelta
+
+import pytest
+
+from app.api import app
+from app.response_cache import ResponseCache
+from app.route import imagery
+from app.route.common import TimeRange
+from naturalness.imagery_store_operator import ImageryStore, Index
+
+RASTER_REQUEST = {'bbox': [0.0, 0.0, 1.0, 1.0], 'time_range': {'end_date': '2023-06-01'}}
+
+
+class CountingImageryStore(ImageryStore):
+    def __init__(self, imagery_store: ImageryStore):
+        self.imagery_store = imagery_store
+        self.calls = 0
+
+    def imagery(self, *args, **kwargs):
+        self.calls += 1
+        return self.imagery_store.imagery(*args, **kwargs)
+
+
+@pytest.fixture
+def imagery_store(mocked_client, monkeypatch) -> CountingImageryStore:
+    imagery_store = CountingImageryStore(app.state.imagery_store)
+    monkeypatch.setattr(app.state, 'imagery_store', imagery_store)
+    return imagery_store
+
+
+@pytest.fixture
+def response_cache(monkeypatch, tmp_path) -> ResponseCache:
+    response_cache = ResponseCache(routes=imagery.router.routes, cache_dir=tmp_path, max_age=60)
+    monkeypatch.setattr(app.state, 'response_cache', response_cache, raising=False)
+    return response_cache
+
+
+def test_key_normalized():
+    body = {'time_range': {'end_date': '2023-06-01'}, 'bbox': [0.0, 0.0, 1.0, 1.0]}
+    reordered = {'bbox': [0.0, 0.0, 1.0, 1.0], 'time_range': {'end_date': '2023-06-01'}}
+
+    assert ResponseCache.key(path='/NDVI/raster', body=body) == ResponseCache.key(path='/NDVI/raster', body=reordered)
+    assert ResponseCache.key(path='/NDVI/raster', body=body) != ResponseCache.key(path='/WATER/raster', body=body)
+
+
+def test_key_resolves_default_time_range():
+    default_end_date = TimeRange().end_date.isoformat()
+
+    assert ResponseCache.key(path='/NDVI/raster', body={}) == ResponseCache.key(
+        path='/NDVI/raster', body={'time_range': {'end_date': default_end_date}}
+    )
+
+
+@pytest.mark.parametrize(
+    'body',
+    [{'time_range': {'end_date': (date.today() - timedelta(days=1)).isoformat()}}, {'time_range': 'invalid'}, []],
+)
+def test_key_of_recent_or_invalid_requests(body):
+    assert ResponseCache.key(path='/NDVI/raster', body=body) is None
+
+
+def test_raster_served_from_cache(mocked_client, imagery_store, response_cache):
+    first_response = mocked_client.post(f'/{Index.NDVI}/raster', json=RASTER_REQUEST)
+    second_response = mocked_client.post(f'/{Index.NDVI}/raster', json=dict(reversed(RASTER_REQUEST.items())))
+
+    assert first_response.status_code == second_response.status_code == 200
+    assert imagery_store.calls == 1
+    assert second_response.content == first_response.content
+    assert second_response.headers['content-type'] == 'image/geotiff'
+    assert second_response.headers['etag'] == first_response.headers['etag']
+    assert second_response.headers['cache-control'] == 'public, max-age=60'
+
+
+def test_vector_not_modified(mocked_client, imagery_store, response_cache, default_vector_request):
+    first_response = mocked_client.post(f'/{Index.NDVI}/vector', json=default_vector_request)
+    second_response = mocked_client.post(
+        f'/{Index.NDVI}/vector',
+        json=default_vector_request,
+        headers={'If-None-Match': first_response.headers['etag']},
+    )
+
+    assert first_response.status_code == 200
+    assert second_response.status_code == 304
+    assert second_response.content == b''
+    assert imagery_store.calls == 1
+
+
+def test_recent_request_not_cached(mocked_client, imagery_store, response_cache):
+    for _ in range(2):
+        response = mocked_client.post(
+            f'/{Index.NDVI}/raster',
+            json={'bbox': [0.0, 0.0, 1.0, 1.0], 'time_range': {'end_date': date.today().isoformat()}},
+        )
+
+        assert response.status_code == 200
+        assert 'cache-control' not in response.headers
+    assert imagery_store.calls == 2
+
+
+def test_failed_request_not_cached(mocked_client, response_cache):
+    response = mocked_client.post(f'/{Index.NDVI}/raster', json={**RASTER_REQUEST, 'resolution': 1})
+
+    assert response.status_code == 422
+    assert 'etag' not in response.headers
+    assert list(response_cache.cache_dir.iterdir()) == []
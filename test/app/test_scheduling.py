@@ -0,0 +1,141 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from prometheus_client import REGISTRY
+
+from app.api import app
+from app.scheduling import ANONYMOUS, ClientPolicy, FairScheduler, load_client_policies, run_scheduled
+from naturalness import metrics
+from naturalness.imagery_store_operator import Index
+
+RASTER_REQUEST = {'bbox': [0.0, 0.0, 1.0, 1.0], 'time_range': {'end_date': '2023-06-01'}}
+
+HEAVY = ClientPolicy(name='heavy', api_key='heavy-key', weight=1.0, max_concurrency=4)
+LIGHT = ClientPolicy(name='light', api_key='light-key', weight=2.0, max_concurrency=4, max_pus_per_day=10.0)
+
+
+@pytest.fixture
+def scheduler(monkeypatch) -> FairScheduler:
+    scheduler = FairScheduler(clients=[HEAVY, LIGHT], max_concurrency=2)
+    monkeypatch.setattr(app.state, 'scheduler', scheduler, raising=False)
+    return scheduler
+
+
+def test_load_client_policies(tmp_path):
+    policies_file = tmp_path / 'clients.yaml'
+    policies_file.write_text(
+        'clients:\n  - name: heavy\n    api_key: heavy-key\n    weight: 2\n  - name: anonymous\n    max_concurrency: 1\n'
+    )
+
+    clients = load_client_policies(policies_file)
+
+    assert clients == [
+        ClientPolicy(name='heavy', api_key='heavy-key', weight=2),
+        ClientPolicy(name=ANONYMOUS, max_concurrency=1),
+    ]
+    assert FairScheduler(clients=clients).identify(None) == clients[1]
+
+
+def test_identify_client():
+    scheduler = FairScheduler(clients=[HEAVY, LIGHT])
+
+    assert scheduler.identify('light-key') == LIGHT
+    assert scheduler.identify('unknown-key').name == ANONYMOUS
+    assert scheduler.identify(None).name == ANONYMOUS
+
+
+def test_waiting_jobs_are_started_by_weight():
+    async def run() -> None:
+        scheduler = FairScheduler(clients=[HEAVY, LIGHT], max_concurrency=1)
+        await scheduler.acquire(HEAVY)
+
+        started = []
+
+        async def job(client: ClientPolicy) -> None:
+            await scheduler.acquire(client)
+            started.append(client.name)
+
+        # the heavy client queued its jobs first, the light client still receives twice its share
+        tasks = [asyncio.create_task(job(HEAVY)) for _ in range(3)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(job(LIGHT)) for _ in range(3)]
+        await asyncio.sleep(0)
+
+        running = HEAVY
+        for position in range(6):
+            scheduler.release(running)
+            while len(started) <= position:
+                await asyncio.sleep(0)
+            running = LIGHT if started[-1] == LIGHT.name else HEAVY
+        await asyncio.gather(*tasks)
+
+        assert started == ['light', 'light', 'heavy', 'light', 'heavy', 'heavy']
+
+    asyncio.run(run())
+
+
+def test_client_at_its_limit_is_overtaken():
+    async def run() -> None:
+        limited = ClientPolicy(name='limited', max_concurrency=1)
+        scheduler = FairScheduler(clients=[limited, LIGHT], max_concurrency=2)
+        await scheduler.acquire(limited)
+
+        waiting = asyncio.create_task(scheduler.acquire(limited))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(scheduler.acquire(LIGHT), timeout=1.0)
+        assert not waiting.done()
+
+        scheduler.release(limited)
+        await asyncio.wait_for(waiting, timeout=1.0)
+
+    asyncio.run(run())
+
+
+def test_waiting_job_times_out():
+    async def run() -> None:
+        scheduler = FairScheduler(clients=[HEAVY], max_concurrency=1)
+        await scheduler.acquire(HEAVY)
+
+        with pytest.raises(TimeoutError):
+            await scheduler.acquire(HEAVY, timeout=0.01)
+        assert scheduler._waiting == []
+
+        scheduler.release(HEAVY)
+        assert scheduler.state(HEAVY).running == 0
+
+    asyncio.run(run())
+
+
+def test_usage_is_accounted_per_client(scheduler):
+    def job() -> str:
+        metrics.count_processing_units(kind='consumed', index=Index.NDVI, value=4.0)
+        return 'done'
+
+    request = SimpleNamespace(app=app, state=SimpleNamespace(client=LIGHT))
+    before = REGISTRY.get_sample_value('naturalness_client_processing_units_total', {'client': 'light'}) or 0.0
+
+    assert asyncio.run(run_scheduled(request, job)) == 'done'
+
+    after = REGISTRY.get_sample_value('naturalness_client_processing_units_total', {'client': 'light'})
+    assert after - before == 4.0
+    assert scheduler.state(LIGHT).usage.processing_units == 4.0
+    assert scheduler.state(LIGHT).usage.cpu_seconds >= 0.0
+    assert scheduler.state(LIGHT).running == 0
+
+
+def test_exhausted_quota_is_rejected(mocked_client, scheduler):
+    scheduler.account(LIGHT, metrics.Usage(processing_units=10.0))
+
+    response = mocked_client.post(f'/{Index.NDVI}/raster', json=RASTER_REQUEST, headers={'X-API-Key': 'light-key'})
+
+    assert response.status_code == 429
+    assert 0 < int(response.headers['Retry-After']) <= 86401
+
+
+def test_request_is_scheduled(mocked_client, scheduler):
+    response = mocked_client.post(f'/{Index.NDVI}/raster', json=RASTER_REQUEST, headers={'X-API-Key': 'heavy-key'})
+
+    assert response.status_code == 200
+    assert scheduler.state(HEAVY).running == 0
+    assert REGISTRY.get_sample_value('naturalness_scheduler_wait_seconds_count', {'client': 'heavy'}) >= 1
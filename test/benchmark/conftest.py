@@ -0,0 +1,34 @@
+import shutil
+import tracemalloc
+from pathlib import Path
+from typing import Callable
+
+import pytest
+
+from naturalness.imagery_store_operator import SentinelHubOperator
+
+
+@pytest.fixture
+def benchmark_memory(benchmark) -> Callable:
+    """Benchmark the function and record its peak memory allocation (as traced by `tracemalloc`) in the results"""
+
+    def run(function: Callable, rounds: int = 3, **kwargs):
+        tracemalloc.start()
+        try:
+            function(**kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        benchmark.extra_info['peak_memory_bytes'] = peak
+
+        return benchmark.pedantic(function, kwargs=kwargs, rounds=rounds, warmup_rounds=0)
+
+    return run
+
+
+@pytest.fixture
+def recorded_operator(tmp_path) -> SentinelHubOperator:
+    shutil.copytree('test/resources/sentinelhub_cache', tmp_path / 'cache')
+    return SentinelHubOperator(
+        api_id='api_id', api_secret='api_secret', script_path=Path('conf/eval_scripts'), cache_dir=tmp_path / 'cache'
+    )
@@ -0,0 +1,114 @@
+import geojson_pydantic
+import numpy as np
+from rasterio.io import MemoryFile
+from sentinelhub import CRS, BBox, bbox_to_dimensions
+from sentinelhub.download.models import DownloadResponse
+
+from naturalness.imagery_store_operator import (
+    Index,
+    ProcessingUnitStats,
+    RemoteSensingMosaic,
+    RemoteSensingResult,
+    RemoteSensingTile,
+    SentinelHubOperator,
+)
+
+RASTER_EDGES = [100, 1000, 2500]
+FEATURE_COUNTS = [10, 1_000, 100_000]
+TILE_EDGE = 500
+
+# south-west corner of the synthetic test area and the extent of a 10m pixel there (in degrees)
+AREA_ORIGIN = (8.0, 49.0)
+PIXEL_EXTENT = (0.0001353, 0.0000908)
+
+
+def synthetic_bbox(edge: int) -> BBox:
+    """A bbox that has approximately `edge` x `edge` pixels at a resolution of 10m"""
+    west, south = AREA_ORIGIN
+    pixel_width, pixel_height = PIXEL_EXTENT
+    return BBox(bbox=(west, south, west + edge * pixel_width, south + edge * pixel_height), crs=CRS.WGS84)
+
+
+def cache_synthetic_response(
+    operator: SentinelHubOperator, index: Index, bbox: BBox, start_date: str, end_date: str
+) -> None:
+    """Store a random response in the operator cache, as if it had been downloaded before"""
+    width, height = bbox_to_dimensions(bbox, resolution=10)
+    request = operator._build_request(
+        index=index, bbox_obj=bbox, time_interval=(start_date, end_date), size=(width, height)
+    )
+
+    rng = np.random.default_rng(seed=42)
+    match index:
+        case Index.NDVI:
+            data = rng.integers(-(2**15 - 1), 2**15 - 1, size=(height, width), dtype=np.int16)
+        case Index.WATER:
+            data = rng.integers(0, 2, size=(height, width), dtype=np.uint8)
+        case _:
+            data = rng.integers(0, 2**16 - 1, size=(height, width), dtype=np.uint16)
+
+    with MemoryFile() as memory_file:
+        with memory_file.open(driver='GTiff', width=width, height=height, count=1, dtype=data.dtype) as dataset:
+            dataset.write(data, 1)
+        content = memory_file.read()
+    DownloadResponse(
+        request=request.download_list[0],
+        content=content,
+        headers={'x-processingunits-spent': '1.0'},
+    ).to_local()
+
+
+def synthetic_raster_result(edge: int) -> RemoteSensingResult:
+    data = np.random.default_rng(seed=42).uniform(-1.0, 1.0, size=(edge, edge))
+    return RemoteSensingResult(
+        index_data=data,
+        height=edge,
+        width=edge,
+        bbox=(0.0, 0.0, 1.0, 1.0),
+        pus=ProcessingUnitStats(estimated=0.0, consumed=0.0),
+    )
+
+
+def synthetic_mosaic(edge: int, tile_edge: int) -> RemoteSensingMosaic:
+    """A mosaic of the unit square whose random tiles are only created while iterating"""
+    offsets = [(row, column) for row in range(0, edge, tile_edge) for column in range(0, edge, tile_edge)]
+
+    def tiles():
+        rng = np.random.default_rng(seed=42)
+        for row, column in offsets:
+            height, width = min(tile_edge, edge - row), min(tile_edge, edge - column)
+            yield RemoteSensingTile(
+                row_offset=row,
+                column_offset=column,
+                result=RemoteSensingResult(
+                    index_data=rng.uniform(-1.0, 1.0, size=(height, width)),
+                    height=height,
+                    width=width,
+                    bbox=(column / edge, 1.0 - (row + height) / edge, (column + width) / edge, 1.0 - row / edge),
+                    pus=ProcessingUnitStats(estimated=0.0, consumed=0.0),
+                ),
+            )
+
+    return RemoteSensingMosaic(
+        height=edge, width=edge, bbox=(0.0, 0.0, 1.0, 1.0), tile_count=len(offsets), tiles=tiles()
+    )
+
+
+def synthetic_feature_collection(feature_count: int) -> geojson_pydantic.FeatureCollection:
+    """Square polygons on a regular grid covering the unit square"""
+    cells = int(np.ceil(np.sqrt(feature_count)))
+    size = 1.0 / cells
+    features = []
+    for i in range(feature_count):
+        x, y = (i % cells) * size, (i // cells) * size
+        features.append(
+            {
+                'type': 'Feature',
+                'properties': {'id': i},
+                'geometry': {
+                    'type': 'Polygon',
+                    'coordinates': [[[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]],
+                },
+            }
+        )
+    return geojson_pydantic.FeatureCollection.model_validate({'type': 'FeatureCollection', 'features': features})
@@ -0,0 +1,84 @@
+import pytest
+
+from app.route.common import (
+    Aggregation,
+    NaturalnessWorkUnit,
+    TimeRange,
+    __compute_raster_response,
+    __compute_vector_response,
+    get_bbox,
+)
+from naturalness.imagery_store_operator import Index, RemoteSensingMosaic
+from test.benchmark.synthetic import (
+    FEATURE_COUNTS,
+    RASTER_EDGES,
+    TILE_EDGE,
+    synthetic_feature_collection,
+    synthetic_mosaic,
+    synthetic_raster_result,
+)
+
+pytestmark = pytest.mark.performance
+
+
+@pytest.mark.parametrize('edge', RASTER_EDGES)
+def test_compute_raster_response(benchmark_memory, edge):
+    raster_result = synthetic_raster_result(edge=edge)
+    body = NaturalnessWorkUnit(time_range=TimeRange(), bbox=raster_result.bbox)
+
+    def compute_and_remove(**kwargs):
+        # the tiles of a mosaic can only be consumed once
+        response = __compute_raster_response(raster_result=RemoteSensingMosaic.from_result(raster_result), **kwargs)
+        response.path.unlink()
+
+    benchmark_memory(compute_and_remove, body=body, index=Index.NDVI)
+
+
+@pytest.mark.parametrize('edge', RASTER_EDGES)
+def test_compute_tiled_raster_response(benchmark_memory, edge):
+    body = NaturalnessWorkUnit(time_range=TimeRange(), bbox=(0.0, 0.0, 1.0, 1.0))
+
+    def compute_and_remove(**kwargs):
+        response = __compute_raster_response(raster_result=synthetic_mosaic(edge=edge, tile_edge=TILE_EDGE), **kwargs)
+        response.path.unlink()
+
+    benchmark_memory(compute_and_remove, body=body, index=Index.NDVI)
+
+
+@pytest.mark.parametrize('feature_count', FEATURE_COUNTS)
+@pytest.mark.parametrize('edge', RASTER_EDGES)
+def test_compute_vector_response(benchmark_memory, edge, feature_count):
+    raster_result = synthetic_raster_result(edge=edge)
+    vectors = synthetic_feature_collection(feature_count=feature_count)
+
+    benchmark_memory(
+        lambda **kwargs: __compute_vector_response(
+            raster_result=RemoteSensingMosaic.from_result(raster_result), **kwargs
+        ),
+        rounds=1 if feature_count >= 100_000 else 3,
+        stats=[Aggregation.mean, Aggregation.median],
+        vectors=vectors,
+        index=Index.NDVI,
+    )
+
+
+@pytest.mark.parametrize('feature_count', FEATURE_COUNTS[:2])
+@pytest.mark.parametrize('edge', RASTER_EDGES)
+def test_compute_tiled_vector_response(benchmark_memory, edge, feature_count):
+    vectors = synthetic_feature_collection(feature_count=feature_count)
+
+    benchmark_memory(
+        lambda **kwargs: __compute_vector_response(
+            raster_result=synthetic_mosaic(edge=edge, tile_edge=TILE_EDGE), **kwargs
+        ),
+        stats=[Aggregation.mean, Aggregation.max],
+        vectors=vectors,
+        index=Index.NDVI,
+    )
+
+
+@pytest.mark.parametrize('feature_count', FEATURE_COUNTS)
+def test_get_bbox(benchmark_memory, feature_count):
+    vectors = synthetic_feature_collection(feature_count=feature_count)
+
+    benchmark_memory(get_bbox, rounds=1 if feature_count >= 100_000 else 3, features=vectors)
@@ -0,0 +1,36 @@
+import pytest
+
+from naturalness.imagery_store_operator import Index
+from test.benchmark.synthetic import RASTER_EDGES, cache_synthetic_response, synthetic_bbox
+
+pytestmark = pytest.mark.performance
+
+
+@pytest.mark.parametrize('index', Index)
+def test_imagery_recorded_response(benchmark_memory, recorded_operator, index):
+    benchmark_memory(
+        recorded_operator.imagery,
+        index=index,
+        bbox=(8.70, 49.41, 8.71, 49.42),
+        start_date='2024-09-01',
+        end_date='2024-09-10',
+    )
+
+
+@pytest.mark.parametrize('edge', RASTER_EDGES)
+@pytest.mark.parametrize('index', Index)
+def test_imagery_synthetic_response(benchmark_memory, recorded_operator, index, edge):
+    bbox = synthetic_bbox(edge=edge)
+    cache_synthetic_response(
+        operator=recorded_operator, index=index, bbox=bbox, start_date='2024-01-01', end_date='2024-12-31'
+    )
+
+    result = benchmark_memory(
+        recorded_operator.imagery,
+        index=index,
+        bbox=tuple(bbox),
+        start_date='2024-01-01',
+        end_date='2024-12-31',
+        resolution=10,
+    )
+    assert result.pus.estimated == 0.0
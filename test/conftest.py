@@ -9,6 +9,7 @@ from starlette.testclient import TestClient
 from app.api import Settings, app
 from app.route.common import Aggregation
 from naturalness.imagery_store_operator import ImageryStore, Index, ProcessingUnitStats, RemoteSensingResult
+from naturalness.projection import WGS84
 
 
 class TestImageryStore(ImageryStore):
@@ -19,6 +20,7 @@ class TestImageryStore(ImageryStore):
         start_date: str,
         end_date: str,
         resolution: int = 90,
+        crs: int = WGS84,
     ) -> RemoteSensingResult:
         if None in (index, bbox, start_date, end_date, resolution):
             raise ValueError('Missing input parameters')
@@ -0,0 +1,75 @@
+import random
+
+from locust import FastHttpUser, between, task
+
+from naturalness.imagery_store_operator import Index
+
+# areas requested every morning, these are served from the cache after their first download
+HOT_AREAS = [
+    (8.65, 49.38, 8.72, 49.43),
+    (13.35, 52.49, 13.43, 52.54),
+    (11.53, 48.12, 11.61, 48.17),
+]
+# random areas are placed within this region and always require a download
+REGION = (5.9, 47.3, 15.0, 55.0)
+AREA_EDGE = (0.01, 0.1)
+HOT_SHARE = 0.3
+
+TIME_RANGE = {'start_date': '2024-05-01', 'end_date': '2024-07-31'}
+
+
+def random_bbox():
+    if random.random() < HOT_SHARE:
+        return random.choice(HOT_AREAS)
+
+    west, south, east, north = REGION
+    edge = random.uniform(*AREA_EDGE)
+    x, y = random.uniform(west, east - edge), random.uniform(south, north - edge)
+    return round(x, 4), round(y, 4), round(x + edge, 4), round(y + edge, 4)
+
+
+def grid_feature_collection(bbox, cells: int = 4) -> dict:
+    west, south, east, north = bbox
+    width, height = (east - west) / cells, (north - south) / cells
+    features = []
+    for i in range(cells):
+        for j in range(cells):
+            x, y = west + i * width, south + j * height
+            features.append(
+                {
+                    'type': 'Feature',
+                    'properties': {},
+                    'geometry': {
+                        'type': 'Polygon',
+                        'coordinates': [[[x, y], [x + width, y], [x + width, y + height], [x, y + height], [x, y]]],
+                    },
+                }
+            )
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+class NaturalnessUser(FastHttpUser):
+    wait_time = between(0.5, 2.0)
+
+    @task(2)
+    def raster(self):
+        index = random.choice(list(Index))
+        self.client.post(
+            f'/{index}/raster',
+            json={'bbox': random_bbox(), 'time_range': TIME_RANGE, 'resolution': 30},
+            name='/{index}/raster',
+        )
+
+    @task(1)
+    def vector(self):
+        index = random.choice(list(Index))
+        self.client.post(
+            f'/{index}/vector',
+            json={
+                'aggregation_stats': ['mean', 'max'],
+                'vectors': grid_feature_collection(random_bbox()),
+                'time_range': TIME_RANGE,
+                'resolution': 30,
+            },
+            name='/{index}/vector',
+        )
@@ -0,0 +1,115 @@
+import argparse
+import csv
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import requests
+
+REPOSITORY = Path(__file__).parents[2]
+STUB_PORT = 9100
+APP_PORT = 8100
+
+
+def start(command: List[str], env: Dict[str, str], cwd: Path, health_url: str) -> subprocess.Popen:
+    process = subprocess.Popen(command, env=env, cwd=cwd)
+    for _ in range(600):
+        try:
+            if requests.get(health_url).status_code < 500:
+                return process
+        except requests.ConnectionError:
+            pass
+        if process.poll() is not None:
+            raise RuntimeError(f'{command} exited with {process.returncode}')
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f'{command} did not start')
+
+
+def summary(csv_prefix: Path) -> Dict[str, str]:
+    with open(f'{csv_prefix}_stats.csv') as stats_file:
+        aggregated = next(row for row in csv.DictReader(stats_file) if row['Name'] == 'Aggregated')
+    return {
+        'requests': aggregated['Request Count'],
+        'failures': aggregated['Failure Count'],
+        'rps': f'{float(aggregated["Requests/s"]):.1f}',
+        'p50': aggregated['50%'],
+        'p95': aggregated['95%'],
+        'p99': aggregated['99%'],
+        'max': f'{float(aggregated["Max Response Time"]):.0f}',
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='Load test the utility against the SentinelHub stub for several worker counts'
+    )
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--spawn-rate', type=float, default=5.0)
+    parser.add_argument('--run-time', default='2m')
+    parser.add_argument('--output', type=Path, default=Path('load_test_results'))
+    args = parser.parse_args()
+    args.output.mkdir(parents=True, exist_ok=True)
+
+    env = {
+        **os.environ,
+        'PYTHONPATH': str(REPOSITORY),
+        # the stub is served via plain http
+        'OAUTHLIB_INSECURE_TRANSPORT': '1',
+        'SENTINELHUB_API_ID': 'stub',
+        'SENTINELHUB_API_SECRET': 'stub',
+        'SENTINELHUB_BASE_URL': f'http://localhost:{STUB_PORT}',
+        'CONF_PATH': str(REPOSITORY / 'conf'),
+    }
+    stub = start(
+        [sys.executable, '-m', 'uvicorn', '--factory', 'test.load.sentinelhub_stub:create_app']
+        + ['--port', str(STUB_PORT), '--workers', '4', '--log-level', 'warning'],
+        env=env,
+        cwd=REPOSITORY,
+        health_url=f'http://localhost:{STUB_PORT}/auth/realms/main/protocol/openid-connect/token',
+    )
+
+    results = {}
+    try:
+        for workers in args.workers:
+            # every run starts with an empty cache
+            with tempfile.TemporaryDirectory() as working_dir:
+                app = start(
+                    [sys.executable, '-m', 'uvicorn', 'app.api:app', '--port', str(APP_PORT)]
+                    + ['--workers', str(workers), '--log-level', 'warning'],
+                    env=env,
+                    cwd=Path(working_dir),
+                    health_url=f'http://localhost:{APP_PORT}/health',
+                )
+                try:
+                    csv_prefix = args.output / f'workers_{workers}'
+                    subprocess.run(
+                        [sys.executable, '-m', 'locust', '-f', str(REPOSITORY / 'test/load/locustfile.py')]
+                        + ['--headless', '--only-summary', '--host', f'http://localhost:{APP_PORT}']
+                        + ['--users', str(args.users), '--spawn-rate', str(args.spawn_rate)]
+                        + ['--run-time', args.run_time, '--csv', str(csv_prefix)],
+                        env=env,
+                        cwd=REPOSITORY,
+                        check=False,
+                    )
+                    results[workers] = summary(csv_prefix)
+                finally:
+                    app.terminate()
+                    app.wait()
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    columns = ['requests', 'failures', 'rps', 'p50', 'p95', 'p99', 'max']
+    print(f'\n{"workers":>8}' + ''.join(f'{column:>10}' for column in columns) + '   (latencies in ms)')
+    for workers, result in results.items():
+        print(f'{workers:>8}' + ''.join(f'{result[column]:>10}' for column in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+import asyncio
+import json
+import logging
+import math
+import random
+import re
+import time
+import uuid
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import rasterio
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from pydantic import confloat, conint
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from rasterio.io import MemoryFile
+from rasterio.warp import transform_bounds
+from sentinelhub.time_utils import parse_time_interval
+
+log = logging.getLogger(__name__)
+
+# first acquisition of Sentinel-2A, the stub pretends that every location is revisited regularly since then
+FIRST_ACQUISITION = datetime(2015, 6, 27, 10, 30, tzinfo=UTC)
+
+SAMPLE_TYPES = {
+    'UINT8': np.uint8,
+    'UINT16': np.uint16,
+    'INT16': np.int16,
+    'FLOAT32': np.float32,
+}
+
+
+class StubSettings(BaseSettings):
+    latency: confloat(ge=0.0) = 0.5
+    latency_per_megapixel: confloat(ge=0.0) = 1.0
+    latency_jitter: confloat(ge=0.0) = 0.25
+    catalog_latency: confloat(ge=0.0) = 0.05
+    error_rate: confloat(ge=0.0, le=1.0) = 0.0
+    revisit_days: conint(ge=1) = 5
+    recorded_dir: Optional[Path] = None
+    batch_latency: confloat(ge=0.0) = 5.0
+    bucket_dir: Optional[Path] = None
+
+    model_config = SettingsConfigDict(env_prefix='SENTINELHUB_STUB_')
+
+
+def create_app(settings: Optional[StubSettings] = None) -> FastAPI:
+    """
+    A stand-in for the SentinelHub authentication, Process, Catalog and Batch Processing APIs to load test the utility
+    without consuming PUs. Process requests are answered with recorded responses of the same area and size if available
+    in the `recorded_dir` (a SentinelHub cache directory) or random data otherwise. Batch jobs write random tiles on a
+    UTM grid to the `bucket_dir`, which stands in for the S3 bucket of their delivery URL, and are done `batch_latency`
+    seconds after they were started. The latency and the share of failed requests are configurable via
+    `SENTINELHUB_STUB_*` environment variables.
+
+    :param settings: the stub configuration, read from the environment if `None`
+    :return: the stub application, e.g. to be run via `uvicorn --factory test.load.sentinelhub_stub:create_app`
+    """
+    # noinspection PyArgumentList
+    settings = settings or StubSettings()
+    recorded_responses = _load_recorded_responses(settings.recorded_dir)
+    app = FastAPI(title='SentinelHub Stub')
+
+    @app.post('/auth/realms/main/protocol/openid-connect/token')
+    async def token() -> dict:
+        return {'access_token': 'stub', 'token_type': 'Bearer', 'expires_in': 3600}
+
+    @app.post('/api/v1/catalog/1.0.0/search')
+    async def catalog_search(request: Request) -> Response:
+        await asyncio.sleep(settings.catalog_latency)
+        if error := _random_error(settings.error_rate):
+            return error
+
+        body = await request.json()
+        acquisitions = _acquisitions(body['datetime'].split('/'), revisit_days=settings.revisit_days)
+        offset = int(body.get('next') or 0)
+        limit = int(body.get('limit') or 100)
+        page = acquisitions[offset : offset + limit]
+        context = {'limit': limit, 'returned': len(page)}
+        if offset + limit < len(acquisitions):
+            context['next'] = offset + limit
+
+        return JSONResponse(
+            {
+                'type': 'FeatureCollection',
+                'features': [
+                    {
+                        'type': 'Feature',
+                        'id': f'stub_{acquisition:%Y%m%dT%H%M%S}',
+                        'properties': {'datetime': acquisition.isoformat().replace('+00:00', 'Z')},
+                    }
+                    for acquisition in page
+                ],
+                'context': context,
+            }
+        )
+
+    @app.post('/api/v1/process')
+    async def process(request: Request) -> Response:
+        payload = await request.json()
+        width, height = payload['output']['width'], payload['output']['height']
+
+        latency = (
+            settings.latency
+            + settings.latency_per_megapixel * width * height / 1e6
+            + abs(random.gauss(0.0, settings.latency_jitter))
+        )
+        await asyncio.sleep(latency)
+        if error := _random_error(settings.error_rate):
+            return error
+
+        recorded = recorded_responses.get(_recording_key(payload))
+        if recorded is not None:
+            content, processing_units = recorded
+        else:
+            time_range = payload['input']['data'][0]['dataFilter']['timeRange']
+            acquisitions = _acquisitions((time_range['from'], time_range['to']), revisit_days=settings.revisit_days)
+            content = _synthetic_tiff(
+                payload['evalscript'], bbox=payload['input']['bounds']['bbox'], width=width, height=height
+            )
+            processing_units = max(width * height / (512 * 512), 0.01) * len(acquisitions)
+
+        return Response(
+            content=content,
+            media_type='image/tiff',
+            headers={'x-processingunits-spent': str(max(processing_units, 0.005))},
+        )
+
+    batch_jobs: Dict[str, dict] = {}
+    batch_done_at: Dict[str, float] = {}
+
+    @app.post('/api/v2/batch/process')
+    async def batch_create(request: Request) -> Response:
+        if error := _random_error(settings.error_rate):
+            return error
+        job_id = str(uuid.uuid4())
+        batch_jobs[job_id] = {
+            'id': job_id,
+            'request': await request.json(),
+            'domainAccountId': 'stub',
+            'status': 'CREATED',
+        }
+        return JSONResponse(batch_jobs[job_id], status_code=201)
+
+    @app.post('/api/v2/batch/process/{job_id}/start')
+    async def batch_start(job_id: str) -> Response:
+        if job_id not in batch_jobs:
+            return JSONResponse({'error': {'status': 404, 'reason': 'Unknown batch job'}}, status_code=404)
+        if settings.bucket_dir is None:
+            return JSONResponse({'error': {'status': 400, 'reason': 'The stub has no bucket'}}, status_code=400)
+
+        job = batch_jobs[job_id]
+        job['status'] = 'PROCESSING'
+        job['costPU'] = await asyncio.to_thread(
+            _batch_tiles, job, bucket_dir=settings.bucket_dir, revisit_days=settings.revisit_days
+        )
+        batch_done_at[job_id] = time.monotonic() + settings.batch_latency
+        return Response(status_code=204)
+
+    @app.get('/api/v2/batch/process/{job_id}')
+    async def batch_status(job_id: str) -> Response:
+        if job_id not in batch_jobs:
+            return JSONResponse({'error': {'status': 404, 'reason': 'Unknown batch job'}}, status_code=404)
+
+        job = batch_jobs[job_id]
+        if job['status'] == 'PROCESSING' and time.monotonic() >= batch_done_at[job_id]:
+            job['status'] = 'DONE'
+        return JSONResponse(job)
+
+    return app
+
+
+def _batch_tiles(job: dict, bucket_dir: Path, revisit_days: int, tile_extent: int = 20_000) -> float:
+    """
+    Write the output of the job as tiles of `tile_extent` meters in the UTM zone of the area.
+
+    :return: the PUs of the job
+    """
+    process_request = job['request']['processRequest']
+    resolution = job['request']['input']['resolution']
+    output_id = process_request['output']['responses'][0]['identifier']
+    time_range = process_request['input']['data'][0]['dataFilter']['timeRange']
+    acquisitions = _acquisitions((time_range['from'], time_range['to']), revisit_days=revisit_days)
+
+    bounds = process_request['input']['bounds']
+    # the CRS of the bounds is given by its URL, e.g. http://www.opengis.net/def/crs/EPSG/0/32632
+    bounds_crs = f'EPSG:{bounds.get("properties", {}).get("crs", "4326").rsplit("/", 1)[-1]}'
+    west, south, east, north = transform_bounds(bounds_crs, 'EPSG:4326', *bounds['bbox'])
+    zone = int(((west + east) / 2 + 180) // 6) + 1
+    crs = f'EPSG:{(32600 if north + south >= 0 else 32700) + zone}'
+    left, bottom, right, top = transform_bounds('EPSG:4326', crs, west, south, east, north)
+
+    # the delivery URL s3://<bucket>/<path> is written to <bucket_dir>/<path>
+    _, _, template = job['request']['output']['delivery']['s3']['url'].removeprefix('s3://').partition('/')
+    pixels = 0
+    for tile_left in range(int(left // tile_extent) * tile_extent, math.ceil(right), tile_extent):
+        for tile_bottom in range(int(bottom // tile_extent) * tile_extent, math.ceil(top), tile_extent):
+            tile_bounds = (tile_left, tile_bottom, tile_left + tile_extent, tile_bottom + tile_extent)
+            size = tile_extent // resolution
+            tile_file = bucket_dir / (
+                template.replace('<requestId>', job['id'])
+                .replace('<tileName>', f'{zone}_{tile_left // tile_extent}_{tile_bottom // tile_extent}')
+                .replace('<outputId>', output_id)
+            )
+            tile_file.parent.mkdir(parents=True, exist_ok=True)
+            tile_file.write_bytes(
+                _synthetic_tiff(process_request['evalscript'], bbox=tile_bounds, width=size, height=size, crs=crs)
+            )
+            pixels += size * size
+    # batch jobs are charged a third of the PUs of process requests
+    return max(pixels / (512 * 512), 0.01) * len(acquisitions) / 3
+
+
+def _random_error(error_rate: float) -> Optional[Response]:
+    if random.random() >= error_rate:
+        return None
+    status_code = random.choice([429, 500, 503])
+    return JSONResponse(
+        {'error': {'status': status_code, 'reason': 'Simulated failure of the SentinelHub stub'}},
+        status_code=status_code,
+        headers={'Retry-After': '1'} if status_code == 429 else None,
+    )
+
+
+def _acquisitions(time_interval: Tuple[str, str], revisit_days: int) -> List[datetime]:
+    start, end = parse_time_interval(time_interval)
+    start, end = start.replace(tzinfo=UTC), end.replace(tzinfo=UTC)
+    revisit = timedelta(days=revisit_days)
+
+    acquisition = FIRST_ACQUISITION + max((start - FIRST_ACQUISITION) // revisit, 0) * revisit
+    acquisitions = []
+    while acquisition <= end:
+        if acquisition >= start:
+            acquisitions.append(acquisition)
+        acquisition += revisit
+    return acquisitions
+
+
+def _synthetic_tiff(evalscript: str, bbox: List[float], width: int, height: int, crs: str = 'EPSG:4326') -> bytes:
+    sample_type = re.search(r'sampleType:\s*"(\w+)"', evalscript)
+    dtype = SAMPLE_TYPES[sample_type.group(1) if sample_type else 'UINT8']
+
+    rng = np.random.default_rng()
+    if np.issubdtype(dtype, np.integer):
+        data = rng.integers(np.iinfo(dtype).min + 1, np.iinfo(dtype).max, size=(height, width), dtype=dtype)
+    else:
+        data = rng.uniform(-1.0, 1.0, size=(height, width)).astype(dtype)
+
+    with MemoryFile() as memory_file:
+        with memory_file.open(
+            driver='GTiff',
+            width=width,
+            height=height,
+            count=1,
+            dtype=data.dtype,
+            crs=crs,
+            transform=rasterio.transform.from_bounds(*bbox, width=width, height=height),
+        ) as dataset:
+            dataset.write(data, 1)
+        return memory_file.read()
+
+
+def _recording_key(payload: dict) -> Tuple:
+    """Recordings are matched by output, area and size; the time range varies with the acquisitions of the stub"""
+    return (
+        tuple(response['identifier'] for response in payload['output']['responses']),
+        tuple(payload['input']['bounds']['bbox']),
+        payload['output']['width'],
+        payload['output']['height'],
+    )
+
+
+def _load_recorded_responses(recorded_dir: Optional[Path]) -> Dict[Tuple, Tuple[bytes, float]]:
+    recorded_responses = {}
+    if recorded_dir is None:
+        return recorded_responses
+
+    for request_file in recorded_dir.glob('*/request.json'):
+        response_file = request_file.parent / 'response.tiff'
+        if not response_file.exists():
+            continue
+        recording = json.loads(request_file.read_text())
+        recorded_responses[_recording_key(recording['request']['payload'])] = (
+            response_file.read_bytes(),
+            float(recording['response']['headers']['x-processingunits-spent']),
+        )
+    log.info(f'Loaded {len(recorded_responses)} recorded responses from {recorded_dir}')
+    return recorded_responses
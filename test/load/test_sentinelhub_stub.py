@@ -0,0 +1,262 @@
+import json
+import socket
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+import uvicorn
+from starlette.testclient import TestClient
+
+from naturalness.batch import BatchImageryStore
+from naturalness.cache import FileSystemCacheBackend
+from naturalness.imagery_store_operator import Index, SentinelHubOperator
+from naturalness.prefetch import PrefetchTarget, prefetch
+from naturalness.projection import WGS84, project_bbox
+from test.load.sentinelhub_stub import StubSettings, create_app
+
+
+@pytest.fixture
+def bucket_dir(tmp_path_factory) -> Path:
+    return tmp_path_factory.mktemp('bucket')
+
+
+@pytest.fixture
+def stub_url(monkeypatch, bucket_dir) -> str:
+    # the stub is served via plain http
+    monkeypatch.setenv('OAUTHLIB_INSECURE_TRANSPORT', '1')
+
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        port = free_socket.getsockname()[1]
+
+    app = create_app(
+        StubSettings(
+            latency=0.0,
+            latency_per_megapixel=0.0,
+            latency_jitter=0.0,
+            catalog_latency=0.0,
+            error_rate=0.0,
+            batch_latency=0.0,
+            bucket_dir=bucket_dir,
+        )
+    )
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+
+    yield f'http://127.0.0.1:{port}'
+
+    server.should_exit = True
+    thread.join()
+
+
+def test_catalog_search_pages():
+    client = TestClient(create_app(StubSettings(catalog_latency=0.0)))
+
+    first_page = client.post(
+        '/api/v1/catalog/1.0.0/search', json={'datetime': '2024-01-01T00:00:00Z/2024-12-31T23:59:59Z', 'limit': 50}
+    ).json()
+    second_page = client.post(
+        '/api/v1/catalog/1.0.0/search',
+        json={'datetime': '2024-01-01T00:00:00Z/2024-12-31T23:59:59Z', 'limit': 50, 'next': 50},
+    ).json()
+
+    assert len(first_page['features']) == 50
+    assert first_page['context']['next'] == 50
+    assert len(second_page['features']) == 24
+    assert 'next' not in second_page['context']
+
+
+def test_process_fails_at_error_rate():
+    client = TestClient(create_app(StubSettings(latency=0.0, latency_jitter=0.0, error_rate=1.0)))
+
+    response = client.post('/api/v1/process', json={'output': {'width': 1, 'height': 1}})
+
+    assert response.status_code in (429, 500, 503)
+
+
+def test_operator_against_stub(stub_url, tmp_path):
+    operator = SentinelHubOperator(
+        api_id='stub',
+        api_secret='stub',
+        script_path=Path('conf/eval_scripts'),
+        cache_dir=tmp_path,
+        base_url=stub_url,
+    )
+
+    result = operator.imagery(
+        index=Index.NDVI, bbox=(8.70, 49.41, 8.71, 49.42), start_date='2024-09-01', end_date='2024-09-10'
+    )
+
+    assert result.index_data.shape == (12, 8)
+    assert np.all((result.index_data >= -1.0) & (result.index_data <= 1.0))
+    assert result.pus.consumed == pytest.approx(0.01 * 2)
+
+
+def test_operator_in_utm_zone_against_stub(stub_url, tmp_path):
+    operator = SentinelHubOperator(
+        api_id='stub',
+        api_secret='stub',
+        script_path=Path('conf/eval_scripts'),
+        cache_dir=tmp_path,
+        base_url=stub_url,
+    )
+
+    result = operator.imagery(
+        index=Index.NDVI,
+        bbox=(478230, 5473070, 478970, 5474200),
+        start_date='2024-09-01',
+        end_date='2024-09-10',
+        resolution=10,
+        crs=32632,
+    )
+
+    assert result.crs == 32632
+    assert result.index_data.shape == (113, 74)
+    assert result.pus.estimated == pytest.approx(result.pus.consumed)
+
+
+def test_operator_mosaic_against_stub(stub_url, tmp_path):
+    operator = SentinelHubOperator(
+        api_id='stub',
+        api_secret='stub',
+        script_path=Path('conf/eval_scripts'),
+        cache_dir=tmp_path,
+        base_url=stub_url,
+    )
+
+    mosaic = operator.mosaic(
+        index=Index.NDVI,
+        bbox=(8.70, 49.41, 8.71, 49.42),
+        start_date='2024-09-01',
+        end_date='2024-09-10',
+        tile_edge=5,
+    )
+    tiles = list(mosaic.tiles)
+
+    assert (mosaic.height, mosaic.width, mosaic.tile_count) == (12, 8, 6)
+    assert [(tile.row_offset, tile.column_offset) for tile in tiles] == [
+        (0, 0),
+        (0, 5),
+        (5, 0),
+        (5, 5),
+        (10, 0),
+        (10, 5),
+    ]
+    assert [tile.result.index_data.shape for tile in tiles] == [(5, 5), (5, 3), (5, 5), (5, 3), (2, 5), (2, 3)]
+    assert tiles[0].result.bbox[0] == 8.70
+    assert tiles[-1].result.bbox[1:3] == (49.41, 8.71)
+    assert tiles[1].result.bbox[0] == pytest.approx(8.70 + 5 / 8 * 0.01)
+
+
+def test_prefetch_area_exceeding_a_request_against_stub(stub_url, tmp_path):
+    operator = SentinelHubOperator(
+        api_id='stub',
+        api_secret='stub',
+        script_path=Path('conf/eval_scripts'),
+        cache_dir=tmp_path,
+        base_url=stub_url,
+    )
+    target = PrefetchTarget(
+        index=Index.NDVI,
+        bbox=(8.40, 49.41, 8.76, 49.412),
+        start_date='2024-09-01',
+        end_date='2024-09-10',
+        resolution=10,
+    )
+
+    report = prefetch(imagery_store=operator, targets=[target])
+
+    assert report.downloaded == 1
+    assert len(list(tmp_path.glob('*/response.tiff'))) == 2
+    assert prefetch(imagery_store=operator, targets=[target]).cached == 1
+
+
+def test_process_replays_recorded_response():
+    recorded_dir = Path('test/resources/sentinelhub_cache')
+    recording = json.loads(next(recorded_dir.glob('*/request.json')).read_text())
+    client = TestClient(
+        create_app(StubSettings(latency=0.0, latency_per_megapixel=0.0, latency_jitter=0.0, recorded_dir=recorded_dir))
+    )
+
+    response = client.post('/api/v1/process', json=recording['request']['payload'])
+
+    assert response.status_code == 200
+    assert response.headers['x-processingunits-spent'] == recording['response']['headers']['x-processingunits-spent']
+
+
+@pytest.mark.parametrize('crs, shape', [(WGS84, (74, 121)), (32632, (76, 122))])
+def test_batch_store_against_stub(stub_url, bucket_dir, tmp_path, crs, shape):
+    operator = SentinelHubOperator(
+        api_id='stub',
+        api_secret='stub',
+        script_path=Path('conf/eval_scripts'),
+        cache_dir=tmp_path,
+        base_url=stub_url,
+    )
+    store = BatchImageryStore(
+        operator=operator,
+        bucket=FileSystemCacheBackend(root=bucket_dir / 'batch'),
+        output_url='s3://naturalness/batch',
+        min_pixels=1,
+        poll_interval=0.01,
+    )
+    # the area crosses the edge of two tiles of the stub at 480 km east in UTM zone 32
+    bbox = project_bbox(bbox=(8.70, 49.41, 8.80, 49.45), crs=crs, resolution=60)
+
+    mosaic = store.mosaic(
+        index=Index.NDVI, bbox=bbox, start_date='2024-09-01', end_date='2024-09-10', resolution=60, crs=crs
+    )
+    (tile,) = list(mosaic.tiles)
+
+    assert tile.result.index_data.shape == (mosaic.height, mosaic.width) == shape
+    assert np.all((tile.result.index_data >= -1.0) & (tile.result.index_data <= 1.0))
+    # nearly no pixel is left at the no data value, i.e. the tiles cover the area without gaps
+    assert np.mean(tile.result.index_data == -999 / (2**16 / 2 - 1)) < 0.01
+    assert tile.result.pus.consumed > 0.0
+    (job_dir,) = (bucket_dir / 'batch').iterdir()
+    assert len(list(job_dir.glob('*-NDVI.tif'))) == 2
+
+    cached = store.mosaic(
+        index=Index.NDVI, bbox=bbox, start_date='2024-09-01', end_date='2024-09-10', resolution=60, crs=crs
+    )
+
+    np.testing.assert_array_equal(next(cached.tiles).result.index_data, tile.result.index_data)
+    assert len(list((bucket_dir / 'batch').iterdir())) == 1
+
+
+def test_batch_store_passes_small_requests(stub_url, bucket_dir, tmp_path):
+    operator = SentinelHubOperator(
+        api_id='stub',
+        api_secret='stub',
+        script_path=Path('conf/eval_scripts'),
+        cache_dir=tmp_path,
+        base_url=stub_url,
+    )
+    store = BatchImageryStore(
+        operator=operator,
+        bucket=FileSystemCacheBackend(root=bucket_dir / 'batch'),
+        output_url='s3://naturalness/batch',
+        min_pixels=1000,
+    )
+
+    result = store.imagery(
+        index=Index.NDVI, bbox=(8.70, 49.41, 8.71, 49.42), start_date='2024-09-01', end_date='2024-09-10'
+    )
+
+    assert result.index_data.shape == (12, 8)
+    assert list((bucket_dir / 'batch').iterdir()) == []
+    assert len(list(tmp_path.glob('*/response.tiff'))) == 1
+
+
+@pytest.mark.parametrize(
+    'tiling_grid, resolution, grid_resolution', [(1, 90, 60), (1, 20, 20), (1, 5, 10), (2, 90, 60), (2, 500, 360)]
+)
+def test_batch_grid_resolution(tiling_grid, resolution, grid_resolution):
+    store = BatchImageryStore(operator=None, bucket=None, output_url='s3://naturalness/batch', tiling_grid=tiling_grid)
+
+    assert store.grid_resolution(resolution) == grid_resolution
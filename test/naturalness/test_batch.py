@@ -0,0 +1,93 @@
+import math
+from datetime import datetime
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_bounds
+
+from naturalness.batch import BatchImageryStore, BatchJob
+from naturalness.imagery_store_operator import NO_DATA_VALUES, Index, ProcessingUnitStats
+
+
+@pytest.mark.parametrize(
+    'index, dtype, raw_value, value',
+    [
+        (Index.NATURALNESS, np.uint16, 2**16 - 1, 1.0),
+        (Index.NDVI, np.int16, 2**15 - 1, 1.0),
+        (Index.WATER, np.uint8, 1, 1),
+    ],
+)
+def test_read_area_partly_covered_by_tiles(tmp_path, index, dtype, raw_value, value):
+    tile_file = tmp_path / f'tile-{index}.tif'
+    # the tile covers the western half of the area
+    with rasterio.open(
+        tile_file,
+        'w',
+        driver='GTiff',
+        width=4,
+        height=4,
+        count=1,
+        dtype=dtype,
+        crs='EPSG:4326',
+        transform=from_bounds(8.0, 49.0, 8.5, 49.5, width=4, height=4),
+    ) as dst:
+        dst.write(np.full((4, 4), raw_value, dtype=dtype), 1)
+    job = BatchJob(request_id='job', tile_files=(tile_file,), processing_units=1.0)
+
+    result = BatchImageryStore._read(
+        job=job,
+        index=index,
+        bbox=(8.0, 49.0, 9.0, 49.5),
+        width=8,
+        height=4,
+        pus=ProcessingUnitStats(estimated=1.0, consumed=1.0),
+    )
+
+    np.testing.assert_array_equal(result.index_data[:, :4], value)
+    np.testing.assert_array_equal(result.index_data[:, 4:], NO_DATA_VALUES[index])
+
+
+class CatalogOperator:
+    def __init__(self, acquisitions: int):
+        self.acquisitions = acquisitions
+        self.config = SimpleNamespace(sh_base_url='https://services.sentinel-hub.com')
+        self.searches = 0
+
+    def _available_timestamps(self, index, bbox_obj, time_interval):
+        self.searches += 1
+        return [datetime(2024, 9, 1)] * self.acquisitions
+
+
+@pytest.mark.parametrize(
+    'edge, acquisitions, estimated_pus, searches',
+    [
+        # at most 40 acquisitions within the 10 days do not reach the threshold
+        (100, 40, None, 0),
+        # a single acquisition exceeds the threshold
+        (5120, 1, math.nan, 0),
+        (1024, 30, 120.0, 1),
+        (1024, 5, None, 1),
+    ],
+)
+def test_batch_estimate_searches_catalog_near_threshold(edge, acquisitions, estimated_pus, searches):
+    operator = CatalogOperator(acquisitions=acquisitions)
+    store = BatchImageryStore(
+        operator=operator, bucket=None, output_url='s3://naturalness/batch', min_pixels=None, min_pus=100.0
+    )
+
+    estimate = store._batch_estimate(
+        index=Index.NDVI,
+        bbox=(8.0, 49.0, 9.0, 50.0),
+        start_date='2024-09-01',
+        end_date='2024-09-10',
+        width=edge,
+        height=edge,
+    )
+
+    if estimated_pus is None:
+        assert estimate is None
+    else:
+        assert estimate == pytest.approx(estimated_pus, nan_ok=True)
+    assert operator.searches == searches
@@ -0,0 +1,118 @@
+import os
+import socket
+import time
+from pathlib import Path
+
+import boto3
+import numpy as np
+import pytest
+from moto.server import ThreadedMotoServer
+from prometheus_client import REGISTRY
+
+from naturalness.cache import FileSystemCacheBackend, ReadThroughCache, S3CacheBackend
+
+
+@pytest.fixture
+def s3_endpoint(monkeypatch) -> str:
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'test')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'test')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        port = free_socket.getsockname()[1]
+
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    endpoint = f'http://127.0.0.1:{port}'
+    boto3.client('s3', endpoint_url=endpoint).create_bucket(Bucket='naturalness')
+    yield endpoint
+    server.stop()
+
+
+def write_entry(entry_dir: Path, content: bytes = b'tiff') -> Path:
+    entry_dir.mkdir(parents=True)
+    (entry_dir / 'request.json').write_text('{}')
+    (entry_dir / 'response.tiff').write_bytes(content)
+    return entry_dir
+
+
+def test_file_system_backend(tmp_path):
+    backend = FileSystemCacheBackend(root=tmp_path / 'shared')
+    source = write_entry(tmp_path / 'local' / 'abc') / 'response.tiff'
+
+    backend.upload(key='abc', file_name='response.tiff', source=source)
+
+    assert backend.fetch(key='abc', file_name='response.tiff', target=tmp_path / 'fetched.tiff')
+    assert (tmp_path / 'fetched.tiff').read_bytes() == b'tiff'
+    assert not backend.fetch(key='def', file_name='response.tiff', target=tmp_path / 'missing.tiff')
+    assert backend.list_files(key='abc') == ['response.tiff']
+    assert backend.list_files(key='def') == []
+
+
+def test_s3_backend(tmp_path, s3_endpoint):
+    backend = S3CacheBackend(bucket='naturalness', prefix='imagery', endpoint_url=s3_endpoint)
+    source = write_entry(tmp_path / 'local' / 'abc') / 'response.tiff'
+
+    backend.upload(key='abc', file_name='response.tiff', source=source)
+
+    objects = boto3.client('s3', endpoint_url=s3_endpoint).list_objects_v2(Bucket='naturalness')['Contents']
+    assert [item['Key'] for item in objects] == ['imagery/abc/response.tiff']
+    assert backend.fetch(key='abc', file_name='response.tiff', target=tmp_path / 'fetched.tiff')
+    assert (tmp_path / 'fetched.tiff').read_bytes() == b'tiff'
+    assert not backend.fetch(key='def', file_name='response.tiff', target=tmp_path / 'missing.tiff')
+    assert backend.list_files(key='abc') == ['response.tiff']
+    assert backend.list_files(key='ab') == []
+
+
+def test_read_through_fetches_shared_entries(tmp_path):
+    shared = FileSystemCacheBackend(root=tmp_path / 'shared')
+    ReadThroughCache(local_dir=tmp_path / 'replica_a', shared=shared).store(
+        entry_dir=write_entry(tmp_path / 'replica_a' / 'abc')
+    )
+    cache = ReadThroughCache(local_dir=tmp_path / 'replica_b', shared=shared)
+    (tmp_path / 'replica_b').mkdir()
+
+    assert cache.contains(entry_dir=tmp_path / 'replica_b' / 'abc')
+    assert (tmp_path / 'replica_b' / 'abc' / 'response.tiff').read_bytes() == b'tiff'
+    assert not cache.contains(entry_dir=tmp_path / 'replica_b' / 'def')
+    assert sorted(path.name for path in (tmp_path / 'replica_b').iterdir()) == ['abc']
+
+
+def test_read_through_evicts_least_recently_used(tmp_path):
+    cache = ReadThroughCache(local_dir=tmp_path, max_bytes=30)
+    evictions_before = REGISTRY.get_sample_value('naturalness_cache_evictions_total', {'cache': 'imagery'}) or 0.0
+
+    for age, key in enumerate(['used', 'old', 'new']):
+        entry_dir = write_entry(tmp_path / key, content=b'0123456789')
+        os.utime(entry_dir / 'response.tiff', (time.time() - 100 + age, time.time() - 100 + age))
+    cache.contains(entry_dir=tmp_path / 'used')
+    cache.store(entry_dir=write_entry(tmp_path / 'latest', content=b'0123456789'))
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['latest', 'used']
+    evictions = REGISTRY.get_sample_value('naturalness_cache_evictions_total', {'cache': 'imagery'})
+    assert evictions - evictions_before == 2
+
+
+def test_read_through_decoded_by_dtype(tmp_path):
+    cache = ReadThroughCache(local_dir=tmp_path)
+    entry_dir = write_entry(tmp_path / 'abc')
+
+    cache.store_decoded(entry_dir=entry_dir, index_data=np.ones((2, 2), dtype=np.float32))
+
+    np.testing.assert_array_equal(cache.load_decoded(entry_dir=entry_dir, dtype=np.dtype(np.float32)), 1.0)
+    assert cache.load_decoded(entry_dir=entry_dir, dtype=np.dtype(np.uint8)) is None
+
+
+def test_read_through_evicts_including_decoded(tmp_path):
+    cache = ReadThroughCache(local_dir=tmp_path, max_bytes=300)
+    old_entry_dir = write_entry(tmp_path / 'old', content=b'0123456789')
+    os.utime(old_entry_dir / 'response.tiff', (time.time() - 100, time.time() - 100))
+    entry_dir = write_entry(tmp_path / 'new', content=b'0123456789')
+
+    cache.store(entry_dir=entry_dir)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['new', 'old']
+    # the decoded raster of the new entry exceeds the limit
+    cache.store_decoded(entry_dir=entry_dir, index_data=np.zeros((8, 8), dtype=np.float32))
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['new']
@@ -0,0 +1,26 @@
+import pytest
+
+from naturalness.deadline import Deadline
+from naturalness.exception import DeadlineExceededError, RequestCancelledError
+
+
+def test_deadline_without_timeout():
+    deadline = Deadline()
+
+    deadline.check()
+    assert deadline.remaining() == float('inf')
+
+
+def test_deadline_exceeded():
+    deadline = Deadline(timeout=0.0)
+
+    with pytest.raises(DeadlineExceededError):
+        deadline.check()
+
+
+def test_deadline_cancelled():
+    deadline = Deadline(timeout=60.0)
+    deadline.cancel()
+
+    with pytest.raises(RequestCancelledError):
+        deadline.check()
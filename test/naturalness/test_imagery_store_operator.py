@@ -1,3 +1,5 @@
+import json
+import shutil
 import tempfile
 from pathlib import Path
 from typing import Tuple
@@ -10,8 +12,11 @@ from sentinelhub.constants import CRS
 from sentinelhub.download.models import DownloadResponse
 
 from app.api import Settings
-from naturalness.exception import OperatorValidationError
+from naturalness.cache import FileSystemCacheBackend
+from naturalness.deadline import DEADLINE, Deadline
+from naturalness.exception import OperatorValidationError, RequestCancelledError
 from naturalness.imagery_store_operator import Index, OutputFormat, SentinelHubOperator
+from naturalness.pu_calibration import PuCalibration
 
 
 def test_fail_early_when_invalid_dimensions_requested():
@@ -194,6 +199,56 @@ def test_pu_estimation_benchmark():
     np.testing.assert_almost_equal(actual=pu_estimate.estimated, desired=0.04)
 
 
+def test_pu_estimation_calibrated(tmp_path):
+    pu_calibration = PuCalibration(calibration_dir=tmp_path / 'calibration', min_observations=1)
+    pu_calibration.record(key='NDVI/BIT_16/3', estimated=0.04, consumed=0.06)
+    operator = SentinelHubOperator(
+        api_id='api_id',
+        api_secret='api_secret',
+        script_path=Path('conf/eval_scripts'),
+        cache_dir=tmp_path / 'cache',
+        pu_calibration=pu_calibration,
+    )
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as request_mock:
+        request_mock.post(
+            'https://services.sentinel-hub.com/auth/realms/main/protocol/openid-connect/token',
+            json={'access_token': 'foo', 'expires_in': '99999999'},
+        )
+        request_mock.post(
+            'https://services.sentinel-hub.com/api/v1/catalog/1.0.0/search',
+            json={
+                'context': {'next': None},
+                'features': [
+                    {'type': 'Feature', 'properties': {'datetime': '2024-09-02'}},
+                    {'type': 'Feature', 'properties': {'datetime': '2024-09-05'}},
+                    {'type': 'Feature', 'properties': {'datetime': '2024-09-07'}},
+                    {'type': 'Feature', 'properties': {'datetime': '2024-09-09'}},
+                ],
+            },
+        )
+        request = SentinelHubRequest(
+            data_folder=str(tmp_path / 'cache'),
+            evalscript='',
+            input_data=[
+                SentinelHubRequest.input_data(
+                    data_collection=DataCollection.SENTINEL2_L2A,
+                    time_interval=('2024-09-01', '2024-09-10'),
+                ),
+            ],
+            responses=[
+                SentinelHubRequest.output_response(identifier=Index.NDVI, response_format=MimeType.TIFF),
+            ],
+            bbox=BBox(
+                bbox=(8.70, 49.41, 8.71, 49.42),
+                crs=CRS('EPSG:4326'),
+            ),
+            size=(8, 12),
+        )
+        pu_estimate = operator.estimate_pus(index=Index.NDVI, request=request)
+    np.testing.assert_almost_equal(actual=pu_estimate.estimated, desired=0.06)
+    np.testing.assert_almost_equal(actual=pu_estimate.correction_factor, desired=1.5)
+
+
 def test_pu_estimation_cached():
     operator = SentinelHubOperator(
         api_id='api_id', api_secret='api_secret', script_path=Path('conf/eval_scripts'), cache_dir=Path('/tmp')
@@ -275,3 +330,221 @@ def test_pu_consumption_on_live_call(index: Index, result_stats: Tuple[float, fl
         actual=np.nanpercentile(raster_output.index_data, (0, 25, 50, 75, 100)), desired=result_stats
     )
     np.testing.assert_almost_equal(actual=raster_output.pus.consumed, desired=pus)
+
+
+@pytest.fixture
+def operator_with_recorded_cache(tmp_path) -> SentinelHubOperator:
+    shutil.copytree('test/resources/sentinelhub_cache', tmp_path / 'cache')
+    return SentinelHubOperator(
+        api_id='api_id', api_secret='api_secret', script_path=Path('conf/eval_scripts'), cache_dir=tmp_path / 'cache'
+    )
+
+
+def test_imagery_no_acquisitions(operator_with_recorded_cache):
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as request_mock:
+        request_mock.post(
+            'https://services.sentinel-hub.com/auth/realms/main/protocol/openid-connect/token',
+            json={'access_token': 'foo', 'expires_in': '99999999'},
+        )
+        request_mock.post(
+            'https://services.sentinel-hub.com/api/v1/catalog/1.0.0/search',
+            json={'context': {'next': None}, 'features': []},
+        )
+        raster_output = operator_with_recorded_cache.imagery(
+            index=Index.WATER, bbox=(8.70, 49.41, 8.71, 49.42), start_date='2024-08-01', end_date='2024-08-02'
+        )
+
+    assert raster_output.pus.consumed == 0.0
+    assert raster_output.index_data.shape == (12, 8)
+    np.testing.assert_array_equal(raster_output.index_data, 255)
+
+
+def test_imagery_trims_time_interval_to_acquisitions(operator_with_recorded_cache, monkeypatch):
+    probed = []
+    contains = operator_with_recorded_cache.cache.contains
+    monkeypatch.setattr(
+        operator_with_recorded_cache.cache,
+        'contains',
+        lambda entry_dir: probed.append(entry_dir) or contains(entry_dir=entry_dir),
+    )
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as request_mock:
+        request_mock.post(
+            'https://services.sentinel-hub.com/auth/realms/main/protocol/openid-connect/token',
+            json={'access_token': 'foo', 'expires_in': '99999999'},
+        )
+        request_mock.post(
+            'https://services.sentinel-hub.com/api/v1/catalog/1.0.0/search',
+            json={
+                'context': {'next': None},
+                'features': [
+                    {'type': 'Feature', 'properties': {'datetime': '2024-08-09T10:00:00Z'}},
+                    {'type': 'Feature', 'properties': {'datetime': '2024-08-02T10:00:00Z'}},
+                ],
+            },
+        )
+        request_mock.post(
+            'https://services.sentinel-hub.com/api/v1/process',
+            body=next(Path('test/resources/sentinelhub_cache').glob('*/response.tiff')).read_bytes(),
+            headers={'x-processingunits-spent': '0.02'},
+            content_type='image/tiff',
+        )
+        raster_output = operator_with_recorded_cache.imagery(
+            index=Index.NDVI, bbox=(8.70, 49.41, 8.71, 49.42), start_date='2024-08-01', end_date='2024-08-31'
+        )
+        process_call = next(call for call in request_mock.calls if call.request.url.endswith('/process'))
+
+    time_range = json.loads(process_call.request.body)['input']['data'][0]['dataFilter']['timeRange']
+    assert time_range == {'from': '2024-08-02T00:00:00Z', 'to': '2024-08-09T23:59:59Z'}
+    np.testing.assert_almost_equal(actual=raster_output.pus.estimated, desired=0.02)
+    np.testing.assert_almost_equal(actual=raster_output.pus.consumed, desired=0.02)
+    # the requested and the trimmed time interval are probed once each
+    assert len(probed) == len(set(probed)) == 2
+
+
+def test_imagery_cached_without_catalog_lookup(operator_with_recorded_cache):
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as request_mock:
+        raster_output = operator_with_recorded_cache.imagery(
+            index=Index.WATER, bbox=(8.70, 49.41, 8.71, 49.42), start_date='2024-09-01', end_date='2024-09-10'
+        )
+        assert len(request_mock.calls) == 0
+
+    assert raster_output.pus.estimated == 0.0
+    assert raster_output.index_data.shape == (12, 8)
+
+
+def test_estimate_without_download(operator_with_recorded_cache):
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as request_mock:
+        request_mock.post(
+            'https://services.sentinel-hub.com/auth/realms/main/protocol/openid-connect/token',
+            json={'access_token': 'foo', 'expires_in': '99999999'},
+        )
+        request_mock.post(
+            'https://services.sentinel-hub.com/api/v1/catalog/1.0.0/search',
+            json={
+                'context': {'next': None},
+                'features': [
+                    {'type': 'Feature', 'properties': {'datetime': '2024-08-09T10:00:00Z'}},
+                    {'type': 'Feature', 'properties': {'datetime': '2024-08-02T10:00:00Z'}},
+                ],
+            },
+        )
+        estimate = operator_with_recorded_cache.estimate(
+            index=Index.NDVI, bbox=(8.70, 49.41, 8.71, 49.42), start_date='2024-08-01', end_date='2024-08-31'
+        )
+        assert not any(call.request.url.endswith('/process') for call in request_mock.calls)
+
+    np.testing.assert_almost_equal(actual=estimate.estimated, desired=0.02)
+
+
+def test_estimate_cached(operator_with_recorded_cache):
+    estimate = operator_with_recorded_cache.estimate(
+        index=Index.WATER, bbox=(8.70, 49.41, 8.71, 49.42), start_date='2024-09-01', end_date='2024-09-10'
+    )
+
+    assert estimate.estimated == 0.0
+
+
+def test_imagery_from_shared_cache(tmp_path):
+    shutil.copytree('test/resources/sentinelhub_cache', tmp_path / 'shared')
+    operator = SentinelHubOperator(
+        api_id='api_id',
+        api_secret='api_secret',
+        script_path=Path('conf/eval_scripts'),
+        cache_dir=tmp_path / 'local',
+        cache_backend=FileSystemCacheBackend(root=tmp_path / 'shared'),
+    )
+
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as request_mock:
+        raster_output = operator.imagery(
+            index=Index.WATER, bbox=(8.70, 49.41, 8.71, 49.42), start_date='2024-09-01', end_date='2024-09-10'
+        )
+        assert len(request_mock.calls) == 0
+
+    assert raster_output.pus.estimated == 0.0
+    assert raster_output.index_data.shape == (12, 8)
+    assert len(list((tmp_path / 'local').glob('*/response.tiff'))) == 1
+
+
+def test_imagery_cached_decoded_memory_mapped(operator_with_recorded_cache):
+    first_output = operator_with_recorded_cache.imagery(
+        index=Index.NDVI, bbox=(8.70, 49.41, 8.71, 49.42), start_date='2024-09-01', end_date='2024-09-10'
+    )
+    second_output = operator_with_recorded_cache.imagery(
+        index=Index.NDVI, bbox=(8.70, 49.41, 8.71, 49.42), start_date='2024-09-01', end_date='2024-09-10'
+    )
+
+    assert len(list(operator_with_recorded_cache.data_folder.glob('*/decoded.*.npy'))) == 1
+    assert isinstance(second_output.index_data, np.memmap)
+    assert not second_output.index_data.flags.writeable
+    np.testing.assert_array_equal(second_output.index_data, first_output.index_data)
+    assert second_output.pus == first_output.pus
+
+
+def test_imagery_cancelled_during_download_is_cached(operator_with_recorded_cache):
+    deadline = Deadline()
+    cached_entries = len(list(operator_with_recorded_cache.data_folder.glob('*/response.tiff')))
+
+    def disconnect_while_downloading(request):
+        deadline.cancel()
+        body = next(Path('test/resources/sentinelhub_cache').glob('*/response.tiff')).read_bytes()
+        return 200, {'x-processingunits-spent': '0.02', 'content-type': 'image/tiff'}, body
+
+    token = DEADLINE.set(deadline)
+    try:
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as request_mock:
+            request_mock.post(
+                'https://services.sentinel-hub.com/auth/realms/main/protocol/openid-connect/token',
+                json={'access_token': 'foo', 'expires_in': '99999999'},
+            )
+            request_mock.post(
+                'https://services.sentinel-hub.com/api/v1/catalog/1.0.0/search',
+                json={
+                    'context': {'next': None},
+                    'features': [{'type': 'Feature', 'properties': {'datetime': '2024-08-02T10:00:00Z'}}],
+                },
+            )
+            request_mock.add_callback(
+                responses.POST,
+                'https://services.sentinel-hub.com/api/v1/process',
+                callback=disconnect_while_downloading,
+            )
+            with pytest.raises(RequestCancelledError):
+                operator_with_recorded_cache.imagery(
+                    index=Index.NDVI, bbox=(8.70, 49.41, 8.71, 49.42), start_date='2024-08-01', end_date='2024-08-31'
+                )
+    finally:
+        DEADLINE.reset(token)
+
+    assert len(list(operator_with_recorded_cache.data_folder.glob('*/response.tiff'))) == cached_entries + 1
+    assert list(operator_with_recorded_cache.data_folder.glob('*/decoded.*.npy')) == []
+
+
+def test_imagery_retries_rate_limited_download(operator_with_recorded_cache):
+    body = next(Path('test/resources/sentinelhub_cache').glob('*/response.tiff')).read_bytes()
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as request_mock:
+        request_mock.post(
+            'https://services.sentinel-hub.com/auth/realms/main/protocol/openid-connect/token',
+            json={'access_token': 'foo', 'expires_in': '99999999'},
+        )
+        request_mock.post(
+            'https://services.sentinel-hub.com/api/v1/catalog/1.0.0/search',
+            json={
+                'context': {'next': None},
+                'features': [{'type': 'Feature', 'properties': {'datetime': '2024-08-02T10:00:00Z'}}],
+            },
+        )
+        rate_limited = request_mock.post(
+            'https://services.sentinel-hub.com/api/v1/process', status=429, headers={'Retry-After': '0.1'}
+        )
+        succeeded = request_mock.post(
+            'https://services.sentinel-hub.com/api/v1/process',
+            body=body,
+            headers={'x-processingunits-spent': '0.02'},
+            content_type='image/tiff',
+        )
+        raster_output = operator_with_recorded_cache.imagery(
+            index=Index.NDVI, bbox=(8.70, 49.41, 8.71, 49.42), start_date='2024-08-01', end_date='2024-08-31'
+        )
+
+    assert rate_limited.call_count == succeeded.call_count == 1
+    assert raster_output.pus.consumed == 0.02
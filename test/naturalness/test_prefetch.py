@@ -0,0 +1,193 @@
+import json
+import math
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import pytest
+
+from naturalness.exception import OperatorInteractionError
+from naturalness.imagery_store_operator import (
+    Index,
+    MosaicEstimate,
+    ProcessingUnitStats,
+    RemoteSensingMosaic,
+    RemoteSensingResult,
+    RemoteSensingTile,
+)
+from naturalness.prefetch import PrefetchTarget, PuBudget, load_targets, prefetch
+from naturalness.projection import WGS84
+
+
+class RecordingImageryStore:
+    def __init__(
+        self,
+        estimated: float = 1.0,
+        consumed: float = 1.0,
+        failing: Tuple[float, ...] = (),
+        tile_count: int = 1,
+        cached: int = 0,
+        without_acquisitions: int = 0,
+    ):
+        self.estimated = estimated
+        self.consumed = consumed
+        self.failing = failing
+        self.tile_count = tile_count
+        self.cached = cached
+        self.without_acquisitions = without_acquisitions
+        self.downloaded: List[Tuple[float, float, float, float]] = []
+
+    def estimate_mosaic(self, index, bbox, start_date, end_date, resolution=90, crs=WGS84) -> MosaicEstimate:
+        return MosaicEstimate(
+            pus=ProcessingUnitStats(estimated=self.estimated * self.tile_count, consumed=math.nan),
+            tile_count=self.tile_count,
+            cached=self.cached,
+            without_acquisitions=self.without_acquisitions,
+        )
+
+    def mosaic(self, index, bbox, start_date, end_date, resolution=90, crs=WGS84) -> RemoteSensingMosaic:
+        def tiles() -> Iterator[RemoteSensingTile]:
+            for column_offset in range(self.tile_count):
+                if bbox in self.failing and column_offset > 0:
+                    raise OperatorInteractionError('SentinelHub operator interaction not possible.')
+                yield RemoteSensingTile(
+                    row_offset=0,
+                    column_offset=column_offset,
+                    result=RemoteSensingResult(
+                        index_data=np.zeros((1, 1)),
+                        height=1,
+                        width=1,
+                        bbox=bbox,
+                        pus=ProcessingUnitStats(estimated=self.estimated, consumed=self.consumed),
+                    ),
+                )
+            self.downloaded.append(bbox)
+
+        return RemoteSensingMosaic(
+            height=1, width=self.tile_count, bbox=bbox, tile_count=self.tile_count, tiles=tiles()
+        )
+
+
+def targets(n: int) -> List[PrefetchTarget]:
+    return [
+        PrefetchTarget(
+            index=Index.NDVI,
+            bbox=(float(i), 0.0, i + 0.01, 0.01),
+            start_date='2024-01-01',
+            end_date='2024-12-31',
+            crs=WGS84,
+        )
+        for i in range(n)
+    ]
+
+
+def test_pu_budget():
+    budget = PuBudget(limit=2.0)
+
+    assert budget.reserve(1.5)
+    assert not budget.reserve(1.0)
+    budget.settle(reserved=1.5, consumed=0.5)
+    assert budget.reserve(1.0)
+    assert budget.used == pytest.approx(1.5)
+
+
+def test_load_targets(tmp_path):
+    targets_file = tmp_path / 'targets.geojson'
+    targets_file.write_text(
+        json.dumps(
+            {
+                'type': 'FeatureCollection',
+                'features': [
+                    {
+                        'type': 'Feature',
+                        'properties': {},
+                        'geometry': {'type': 'Point', 'coordinates': [8.7, 49.4]},
+                    },
+                    {
+                        'type': 'Feature',
+                        'properties': {'indices': ['WATER'], 'end_date': '2024-06-30', 'resolution': 30},
+                        'geometry': {
+                            'type': 'Polygon',
+                            'coordinates': [[[8.7, 49.4], [8.8, 49.4], [8.8, 49.5], [8.7, 49.4]]],
+                        },
+                    },
+                ],
+            }
+        )
+    )
+
+    loaded_targets = load_targets(
+        targets_file=targets_file, start_date='2024-01-01', end_date='2024-12-31', indices=[Index.NDVI, Index.WATER]
+    )
+
+    assert loaded_targets == [
+        PrefetchTarget(index=Index.NDVI, bbox=(8.7, 49.4, 8.7, 49.4), start_date='2024-01-01', end_date='2024-12-31'),
+        PrefetchTarget(index=Index.WATER, bbox=(8.7, 49.4, 8.7, 49.4), start_date='2024-01-01', end_date='2024-12-31'),
+        PrefetchTarget(
+            index=Index.WATER,
+            bbox=(8.7, 49.4, 8.8, 49.5),
+            start_date='2024-01-01',
+            end_date='2024-06-30',
+            resolution=30,
+        ),
+    ]
+
+
+def test_prefetch_within_budget():
+    imagery_store = RecordingImageryStore(estimated=1.0, consumed=1.0)
+
+    report = prefetch(imagery_store=imagery_store, targets=targets(4), max_workers=1, pu_budget=2.5)
+
+    assert report.downloaded == 2
+    assert report.over_budget == 2
+    assert report.consumed_pus == 2.0
+    assert imagery_store.downloaded == [(0.0, 0.0, 0.01, 0.01), (1.0, 0.0, 1.01, 0.01)]
+
+
+def test_prefetch_budget_settled_with_consumed_pus():
+    imagery_store = RecordingImageryStore(estimated=1.0, consumed=0.5)
+
+    report = prefetch(imagery_store=imagery_store, targets=targets(4), max_workers=1, pu_budget=2.5)
+
+    assert report.downloaded == 4
+    assert report.consumed_pus == 2.0
+
+
+def test_prefetch_skips_cached_and_counts_failures():
+    report = prefetch(imagery_store=RecordingImageryStore(cached=1), targets=targets(2))
+    assert report.cached == 2
+    assert report.downloaded == 0
+
+    report = prefetch(
+        imagery_store=RecordingImageryStore(failing=((0.0, 0.0, 0.01, 0.01),), tile_count=2), targets=targets(2)
+    )
+    assert report.failed == 1
+    assert report.downloaded == 1
+
+
+def test_prefetch_without_acquisitions_is_not_cached():
+    report = prefetch(imagery_store=RecordingImageryStore(estimated=0.0, without_acquisitions=1), targets=targets(2))
+
+    assert report.without_acquisitions == 2
+    assert report.cached == 0
+
+
+def test_prefetch_mosaic_settles_consumed_pus_of_its_tiles():
+    imagery_store = RecordingImageryStore(estimated=1.0, consumed=0.5, failing=((0.0, 0.0, 0.01, 0.01),), tile_count=3)
+
+    report = prefetch(imagery_store=imagery_store, targets=targets(2), max_workers=1, pu_budget=5.0)
+
+    # the first tile of the failed mosaic was downloaded before the failure
+    assert report.failed == 1
+    assert report.downloaded == 1
+    assert report.consumed_pus == 2.0
+
+
+def test_prefetch_in_utm_zone_of_target():
+    imagery_store = RecordingImageryStore()
+    target = PrefetchTarget(
+        index=Index.NDVI, bbox=(8.70, 49.41, 8.71, 49.42), start_date='2024-01-01', end_date='2024-12-31'
+    )
+
+    prefetch(imagery_store=imagery_store, targets=[target])
+
+    assert imagery_store.downloaded == [(478170, 5472990, 478980, 5474250)]
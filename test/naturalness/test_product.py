@@ -0,0 +1,137 @@
+from typing import Tuple
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.warp import transform_bounds
+from sentinelhub import CRS, BBox, bbox_to_dimensions
+
+from naturalness.imagery_store_operator import (
+    ImageryStore,
+    Index,
+    ProcessingUnitStats,
+    RemoteSensingResult,
+    decoded_dtype,
+)
+from naturalness.product import ProductImageryStore, build_product
+from naturalness.projection import WGS84, project_bbox
+
+REGION = (8.60, 49.35, 8.75, 49.45)
+START_DATE, END_DATE = '2024-01-01', '2024-12-31'
+
+
+class LongitudeImageryStore(ImageryStore):
+    """Pixel values are the longitude of the pixel center, i.e. reads from products can be checked for alignment"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def imagery(
+        self,
+        index: Index,
+        bbox: Tuple[float, float, float, float],
+        start_date: str,
+        end_date: str,
+        resolution: int = 90,
+        crs: int = WGS84,
+    ) -> RemoteSensingResult:
+        self.calls += 1
+        width, height = bbox_to_dimensions(BBox(bbox=bbox, crs=CRS.WGS84), resolution=resolution)
+        west, _, east, _ = bbox
+        centers = west + (np.arange(width) + 0.5) * (east - west) / width
+        return RemoteSensingResult(
+            index_data=np.tile(centers, (height, 1)),
+            height=height,
+            width=width,
+            bbox=bbox,
+            pus=ProcessingUnitStats(estimated=1.0, consumed=1.0),
+        )
+
+
+@pytest.fixture
+def product_dir(tmp_path):
+    build_product(
+        imagery_store=LongitudeImageryStore(),
+        output_dir=tmp_path,
+        name='heidelberg',
+        index=Index.NDVI,
+        bbox=REGION,
+        start_date=START_DATE,
+        end_date=END_DATE,
+        resolution=10,
+    )
+    return tmp_path
+
+
+def test_build_product_cloud_optimized(product_dir):
+    (product_file,) = product_dir.glob('*.tif')
+
+    assert product_file.name == 'heidelberg_NDVI_2024-01-01_2024-12-31_10m.tif'
+    with rasterio.open(product_file) as src:
+        assert src.profile['tiled']
+        assert src.overviews(1)
+        assert src.tags()['index'] == 'NDVI'
+        assert src.bounds == pytest.approx(REGION)
+
+
+def test_product_store_reads_covered_request(product_dir):
+    fallback = LongitudeImageryStore()
+    store = ProductImageryStore(product_dir=product_dir, fallback=fallback)
+    bbox = (8.70, 49.41, 8.71, 49.42)
+
+    result = store.imagery(index=Index.NDVI, bbox=bbox, start_date=START_DATE, end_date=END_DATE, resolution=30)
+    expected = fallback.imagery(index=Index.NDVI, bbox=bbox, start_date=START_DATE, end_date=END_DATE, resolution=30)
+
+    assert fallback.calls == 1
+    assert result.pus.consumed == 0.0
+    assert result.index_data.dtype == decoded_dtype(index=Index.NDVI)
+    assert result.index_data.shape == expected.index_data.shape
+    # the request is read from an overview of the 10m product, a 30m pixel is about 0.0004 degrees wide
+    np.testing.assert_allclose(result.index_data, expected.index_data, atol=0.0004)
+
+
+def test_product_store_reads_request_in_utm_zone(product_dir):
+    fallback = LongitudeImageryStore()
+    store = ProductImageryStore(product_dir=product_dir, fallback=fallback)
+    bbox = project_bbox(bbox=(8.70, 49.41, 8.71, 49.42), crs=32632, resolution=30)
+
+    result = store.imagery(
+        index=Index.NDVI, bbox=bbox, start_date=START_DATE, end_date=END_DATE, resolution=30, crs=32632
+    )
+
+    assert fallback.calls == 0
+    assert result.crs == 32632
+    assert result.index_data.shape == (39, 25)
+    # the pixel values are the longitudes of the WGS 84 pixels the UTM pixels are warped from
+    west, _, east, _ = transform_bounds('EPSG:32632', 'EPSG:4326', *bbox)
+    assert result.index_data.min() == pytest.approx(west, abs=0.0005)
+    assert result.index_data.max() == pytest.approx(east, abs=0.0005)
+
+
+def test_product_store_mosaic_from_product(product_dir):
+    fallback = LongitudeImageryStore()
+    store = ProductImageryStore(product_dir=product_dir, fallback=fallback)
+
+    mosaic = store.mosaic(index=Index.NDVI, bbox=REGION, start_date=START_DATE, end_date=END_DATE, resolution=90)
+    tiles = list(mosaic.tiles)
+
+    assert fallback.calls == 0
+    assert len(tiles) == mosaic.tile_count == 1
+    assert tiles[0].result.index_data.shape == (mosaic.height, mosaic.width)
+
+
+@pytest.mark.parametrize(
+    'index, bbox, start_date',
+    [
+        (Index.NDVI, (8.70, 49.41, 8.80, 49.42), START_DATE),
+        (Index.NDVI, (8.70, 49.41, 8.71, 49.42), '2024-02-01'),
+        (Index.NATURALNESS, (8.70, 49.41, 8.71, 49.42), START_DATE),
+    ],
+)
+def test_product_store_falls_back(product_dir, index, bbox, start_date):
+    fallback = LongitudeImageryStore()
+    store = ProductImageryStore(product_dir=product_dir, fallback=fallback)
+
+    store.imagery(index=index, bbox=bbox, start_date=start_date, end_date=END_DATE, resolution=30)
+
+    assert fallback.calls == 1
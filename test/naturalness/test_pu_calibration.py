@@ -0,0 +1,94 @@
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from naturalness.pu_calibration import PuCalibration
+
+
+def test_key_buckets_by_pixel_count():
+    assert PuCalibration.key(index='NDVI', output_format='BIT_16', width=8, height=12) == 'NDVI/BIT_16/3'
+    assert PuCalibration.key(index='NDVI', output_format='BIT_16', width=512, height=512) == 'NDVI/BIT_16/9'
+    assert PuCalibration.key(index='NDVI', output_format='BIT_16', width=0, height=0) == 'NDVI/BIT_16/0'
+
+
+def test_factor_defaults_to_one(tmp_path):
+    calibration = PuCalibration(calibration_dir=tmp_path)
+
+    assert calibration.factor('NDVI/BIT_16/3') == 1.0
+
+
+def test_factor_requires_min_observations(tmp_path):
+    calibration = PuCalibration(calibration_dir=tmp_path, min_observations=3)
+
+    calibration.record('NDVI/BIT_16/3', estimated=0.04, consumed=0.08)
+    calibration.record('NDVI/BIT_16/3', estimated=0.04, consumed=0.08)
+    assert calibration.factor('NDVI/BIT_16/3') == 1.0
+
+    calibration.record('NDVI/BIT_16/3', estimated=0.04, consumed=0.08)
+    np.testing.assert_almost_equal(actual=calibration.factor('NDVI/BIT_16/3'), desired=2.0)
+    assert calibration.factor('WATER/BIT_8/3') == 1.0
+
+
+def test_record_skips_cached_results(tmp_path):
+    calibration = PuCalibration(calibration_dir=tmp_path, min_observations=1)
+
+    calibration.record('NDVI/BIT_16/3', estimated=0.0, consumed=float('nan'))
+
+    assert not calibration.observation_file.exists()
+    assert calibration.factor('NDVI/BIT_16/3') == 1.0
+
+
+def test_table_is_reloaded_on_change(tmp_path):
+    calibration = PuCalibration(calibration_dir=tmp_path, min_observations=1)
+    calibration.record('NDVI/BIT_16/3', estimated=1.0, consumed=1.0)
+
+    calibration.table_file.write_text(
+        json.dumps({'NDVI/BIT_16/3': {'observations': 10, 'estimated': 1.0, 'consumed': 0.5}})
+    )
+    stat = calibration.table_file.stat()
+    os.utime(calibration.table_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+    np.testing.assert_almost_equal(actual=calibration.factor('NDVI/BIT_16/3'), desired=0.5)
+
+
+def test_table_is_fitted_from_observation_log(tmp_path):
+    with open(tmp_path / 'observations.jsonl', mode='w') as observation_log:
+        observation_log.write(json.dumps({'key': 'WATER/BIT_8/3', 'estimated': 0.01, 'consumed': 0.015}) + '\n')
+        observation_log.write(json.dumps({'key': 'WATER/BIT_8/3', 'estimated': 0.01, 'consumed': 0.025}) + '\n')
+
+    calibration = PuCalibration(calibration_dir=tmp_path, min_observations=2)
+
+    assert calibration.table_file.exists()
+    np.testing.assert_almost_equal(actual=calibration.factor('WATER/BIT_8/3'), desired=2.0)
+
+
+def _record_observations(calibration_dir, n):
+    calibration = PuCalibration(calibration_dir=calibration_dir)
+    for _ in range(n):
+        calibration.record('NDVI/BIT_16/3', estimated=0.04, consumed=0.05)
+
+
+def test_record_from_several_processes(tmp_path):
+    workers = [multiprocessing.Process(target=_record_observations, args=(tmp_path, 25)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    table = json.loads((tmp_path / 'calibration.json').read_text())
+    assert table['NDVI/BIT_16/3']['observations'] == 100
+    assert len((tmp_path / 'observations.jsonl').read_text().splitlines()) == 100
+
+
+def test_record_picks_up_updates_of_other_instances(tmp_path):
+    calibration = PuCalibration(calibration_dir=tmp_path)
+    other_calibration = PuCalibration(calibration_dir=tmp_path)
+
+    calibration.record('NDVI/BIT_16/3', estimated=0.04, consumed=0.05)
+    other_calibration.record('NDVI/BIT_16/3', estimated=0.04, consumed=0.05)
+    calibration.record('NDVI/BIT_16/3', estimated=0.04, consumed=0.05)
+
+    table = json.loads(calibration.table_file.read_text())
+    assert table['NDVI/BIT_16/3']['observations'] == 3
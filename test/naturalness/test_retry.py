@@ -0,0 +1,120 @@
+import threading
+import time
+from datetime import UTC, datetime, timedelta
+from email.utils import format_datetime
+
+import pytest
+import requests
+from prometheus_client import REGISTRY
+from sentinelhub import DownloadFailedException
+
+from naturalness.retry import Hedger, RetryPolicy
+
+
+def failure(status_code: int, headers: dict = None) -> DownloadFailedException:
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return DownloadFailedException('failed', request_exception=requests.HTTPError(response=response))
+
+
+class FlakyCall:
+    def __init__(self, *failures: Exception):
+        self.failures = list(failures)
+        self.calls = 0
+
+    def __call__(self) -> str:
+        self.calls += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        return 'ok'
+
+
+def test_retry_transient_failures():
+    call = FlakyCall(failure(503), DownloadFailedException('reset', request_exception=requests.ConnectionError()))
+    retries_before = REGISTRY.get_sample_value(
+        'naturalness_upstream_retries_total', {'operation': 'test', 'reason': '503'}
+    )
+
+    assert RetryPolicy(max_attempts=3, base_delay=0.01).call(call, operation='test') == 'ok'
+    assert call.calls == 3
+    retries = REGISTRY.get_sample_value('naturalness_upstream_retries_total', {'operation': 'test', 'reason': '503'})
+    assert retries - (retries_before or 0.0) == 1
+
+
+@pytest.mark.parametrize('status_code', [400, 401, 404])
+def test_retry_not_client_errors(status_code):
+    call = FlakyCall(failure(status_code))
+
+    with pytest.raises(DownloadFailedException):
+        RetryPolicy(base_delay=0.01).call(call, operation='test')
+    assert call.calls == 1
+
+
+def test_retry_gives_up_after_max_attempts():
+    call = FlakyCall(failure(500), failure(500), failure(500))
+
+    with pytest.raises(DownloadFailedException):
+        RetryPolicy(max_attempts=2, base_delay=0.01).call(call, operation='test')
+    assert call.calls == 2
+
+
+def test_retry_honors_retry_after():
+    call = FlakyCall(failure(429, headers={'Retry-After': '0.2'}))
+
+    started = time.monotonic()
+    RetryPolicy(base_delay=0.01).call(call, operation='test')
+
+    assert time.monotonic() - started >= 0.2
+
+
+def test_retry_gives_up_beyond_max_delay():
+    call = FlakyCall(failure(429, headers={'Retry-After': '120'}))
+
+    with pytest.raises(DownloadFailedException):
+        RetryPolicy(max_delay=30.0).call(call, operation='test')
+    assert call.calls == 1
+
+
+def test_retry_after_http_date():
+    retry_at = datetime.now(UTC) + timedelta(seconds=60)
+
+    retry_after = RetryPolicy.retry_after(failure(503, headers={'Retry-After': format_datetime(retry_at, usegmt=True)}))
+
+    assert retry_after == pytest.approx(60, abs=2)
+
+
+def test_hedge_slow_download():
+    hedger = Hedger(percentile=0.5, min_samples=3)
+    for latency in (0.01, 0.01, 0.01):
+        hedger.record(latency)
+    hedges_before = REGISTRY.get_sample_value('naturalness_hedged_requests_total', {'winner': 'hedge'})
+    release = threading.Event()
+    calls = []
+
+    def download() -> str:
+        calls.append(threading.current_thread().name)
+        if len(calls) == 1:
+            # the primary request hangs until the hedge completed
+            release.wait(timeout=5)
+            return 'primary'
+        return 'hedge'
+
+    assert hedger.call(download) == 'hedge'
+    release.set()
+    assert len(calls) == 2
+    hedges = REGISTRY.get_sample_value('naturalness_hedged_requests_total', {'winner': 'hedge'})
+    assert hedges - (hedges_before or 0.0) == 1
+
+
+def test_hedge_not_before_enough_samples():
+    hedger = Hedger(min_samples=3)
+    calls = []
+
+    def download() -> str:
+        calls.append(1)
+        return 'primary'
+
+    assert hedger.call(download) == 'primary'
+    assert hedger.threshold() is None
+    assert len(calls) == 1
@@ -0,0 +1,54 @@
+import json
+
+import pytest
+from opentelemetry import trace
+from opentelemetry.util._once import Once
+
+from naturalness import tracing
+from naturalness.imagery_store_operator import Index
+from naturalness.tracing import TracingExporter, configure_tracing
+
+
+@pytest.fixture
+def reset_tracer_provider():
+    """Restore the unconfigured global tracer provider, it can otherwise only be set once per process"""
+
+    def reset():
+        trace._TRACER_PROVIDER_SET_ONCE = Once()
+        trace._TRACER_PROVIDER = None
+        # the proxy caches the tracer of the first registered provider
+        tracing.tracer._real_tracer = None
+
+    reset()
+    yield
+    reset()
+
+
+def test_configure_tracing_disabled(reset_tracer_provider, tmp_path, mocked_client, default_vector_request):
+    span_file = tmp_path / 'spans.jsonl'
+
+    assert configure_tracing(exporter=None, file_path=span_file) is None
+
+    response = mocked_client.post(f'/{Index.NDVI}/vector', json=default_vector_request)
+    with tracing.tracer.start_as_current_span('probe') as span:
+        assert not span.is_recording()
+
+    assert response.status_code == 200
+    assert not span_file.exists()
+
+
+def test_file_exporter_records_request_path(reset_tracer_provider, tmp_path, mocked_client, default_vector_request):
+    span_file = tmp_path / 'spans.jsonl'
+    provider = configure_tracing(exporter=TracingExporter.FILE, file_path=span_file)
+
+    mocked_client.post(f'/{Index.NDVI}/vector', json=default_vector_request)
+    provider.shutdown()
+
+    spans = {span['name']: span for span in map(json.loads, span_file.read_text().splitlines())}
+    assert {'index_compute_vector', 'get_bbox', 'compute_vector_response'} <= spans.keys()
+    assert spans['index_compute_vector']['attributes'] == {
+        'naturalness.index': 'NDVI',
+        'naturalness.resolution': 90,
+        'naturalness.feature_count': 1,
+    }
+    assert spans['get_bbox']['parent_id'] == spans['index_compute_vector']['context']['span_id']